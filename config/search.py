@@ -102,6 +102,15 @@ class Search:
         """
         return self.folder_name
     
+    def get_hyperparameters(self) -> dict[str, list[str]]:
+        """
+        Get the searched hyperparameters, with their keys path in the configuration.
+        """
+        hyperparameters: dict[str, list[str]] = {}
+        for item in self.items:
+            hyperparameters[item.keys[-1]] = item.keys
+        return hyperparameters
+
     def compare_experiments(self) -> None:
         """
         Compare the experiments based on the specified hyperparameters.
@@ -110,10 +119,7 @@ class Search:
             ValueError: If the end of the traversal is reached.
         """
 
-        hyperparameters: dict[str, list[str]] = {}
-        for item in self.items:
-            hyperparameters[item.keys[-1]] = item.keys
-
+        hyperparameters = self.get_hyperparameters()
         print(hyperparameters)
 
         compare_experiments(csv_output='compare',
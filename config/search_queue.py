@@ -0,0 +1,306 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import threading
+from typing import Any
+from easydict import EasyDict
+from os.path import dirname as up
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from config.compare_experiments import compare_experiments
+
+
+QUEUE_NAME = 'search_queue.json'
+LOCK_NAME = 'search_queue.lock'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+
+
+class FileLock:
+    def __init__(self,
+                 lock_path: str,
+                 poll_interval: float = 0.1,
+                 stale_lock: float = 60
+                 ) -> None:
+        """
+        Lock based on the atomic creation of a file, so it works on every OS
+        and on a shared filesystem. The file contains a token of the holder: a holder
+        whose lock was removed as stale (and taken by another process) does not remove
+        the lock of the new holder.
+
+        Args:
+            lock_path (str): The path of the lock file.
+            poll_interval (float, optional): Waiting time between two tries, in seconds.
+                Defaults to 0.1.
+            stale_lock (float, optional): A lock older than stale_lock seconds was left
+                by a crashed process and is removed. Defaults to 60.
+        """
+        self.lock_path = lock_path
+        self.poll_interval = poll_interval
+        self.stale_lock = stale_lock
+        self.token: str | None = None
+
+    def __enter__(self) -> None:
+        token = f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex}'
+        while True:
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, token.encode('utf8'))
+                os.close(fd)
+                self.token = token
+                return None
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_path) > self.stale_lock:
+                        os.remove(self.lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                time.sleep(self.poll_interval)
+
+    def __exit__(self, *args: Any) -> None:
+        token, self.token = self.token, None
+        try:
+            with open(self.lock_path, 'r', encoding='utf8') as f:
+                if f.read() != token:
+                    print(f'the lock {self.lock_path} was taken by another process '
+                          '(stale lock)')
+                    return None
+            os.remove(self.lock_path)
+        except FileNotFoundError:
+            print(f'the lock {self.lock_path} was removed by another process '
+                  '(stale lock)')
+
+
+class SearchQueue:
+    def __init__(self,
+                 search_path: str,
+                 stale_timeout: float = 600
+                 ) -> None:
+        """
+        Queue of the experiments of a random or grid search, shared between several
+        workers through the search folder (no external broker needed).
+
+        Args:
+            search_path (str): The search folder which contains the queue.
+            stale_timeout (float, optional): A running experiment without heartbeat
+                since stale_timeout seconds is put back in the queue. Defaults to 600.
+
+        Raises:
+            FileNotFoundError: If the search folder does not exist.
+        """
+        if not os.path.exists(search_path):
+            raise FileNotFoundError(f"{search_path} wasn't found")
+
+        self.search_path = search_path
+        self.queue_path = os.path.join(search_path, QUEUE_NAME)
+        self.lock = FileLock(os.path.join(search_path, LOCK_NAME))
+        self.stale_timeout = stale_timeout
+        self.worker_name = f'{socket.gethostname()}_{os.getpid()}'
+
+    def create(self,
+               configs: list[EasyDict],
+               hyperparameters: dict[str, list[str]],
+               model_name: str
+               ) -> None:
+        """
+        Create the queue with all the experiments to run.
+
+        Args:
+            configs (list[EasyDict]): The configuration of each experiment.
+            hyperparameters (dict[str, list[str]]): The hyperparameters to compare at
+                the end of the search.
+            model_name (str): The name of the model.
+
+        Raises:
+            FileExistsError: If a queue already exists in the search folder.
+        """
+        if os.path.exists(self.queue_path):
+            raise FileExistsError(f'a queue already exists in {self.search_path}')
+
+        queue = {'model_name': model_name,
+                 'hyperparameters': hyperparameters,
+                 'compared': False,
+                 'trials': [{'id': i,
+                             'status': PENDING,
+                             'worker': None,
+                             'heartbeat': None,
+                             'logging_path': None,
+                             'config': json.loads(json.dumps(config))}
+                            for i, config in enumerate(configs)]}
+        with self.lock:
+            self.__write(queue)
+        print(f'create a queue of {len(configs)} experiments in {self.queue_path}')
+
+    def claim(self) -> tuple[int, EasyDict] | None:
+        """
+        Claim the next pending experiment. The stale experiments are put back in the
+        queue before.
+
+        Returns:
+            tuple[int, EasyDict] | None: The id and the config of the experiment,
+                or None if there are no more pending experiments.
+        """
+        with self.lock:
+            queue = self.__read()
+            now = time.time()
+            claimed: tuple[int, EasyDict] | None = None
+            for trial in queue['trials']:
+                if trial['status'] == RUNNING \
+                        and now - trial['heartbeat'] > self.stale_timeout:
+                    print(f"experiment n°{trial['id']} of {trial['worker']} is stale: "
+                          "requeue it")
+                    trial['status'] = PENDING
+
+            for trial in queue['trials']:
+                if trial['status'] == PENDING:
+                    trial['status'] = RUNNING
+                    trial['worker'] = self.worker_name
+                    trial['heartbeat'] = now
+                    claimed = trial['id'], EasyDict(trial['config'])
+                    break
+
+            self.__write(queue)
+
+        return claimed
+
+    def heartbeat(self, trial_id: int) -> None:
+        """
+        Tell the other workers that the experiment is still running.
+
+        Args:
+            trial_id (int): The id of the experiment.
+        """
+        with self.lock:
+            queue = self.__read()
+            trial = queue['trials'][trial_id]
+            if trial['status'] == RUNNING and trial['worker'] == self.worker_name:
+                trial['heartbeat'] = time.time()
+                self.__write(queue)
+
+    def mark_done(self, trial_id: int, logging_path: str) -> bool:
+        """
+        Mark the experiment as done. An experiment put back in the queue as stale and
+        claimed again by another worker belongs to the other worker, which is still
+        writing its logs: the call is ignored and this run is not counted.
+
+        Args:
+            trial_id (int): The id of the experiment.
+            logging_path (str): The log folder of the experiment.
+
+        Returns:
+            bool: True if all the experiments are done and the comparison was not done
+                yet (the caller must compare the experiments).
+        """
+        with self.lock:
+            queue = self.__read()
+            trial = queue['trials'][trial_id]
+            if trial['worker'] != self.worker_name:
+                print(f"experiment n°{trial_id} was claimed by {trial['worker']} "
+                      f"after being stale: the run of {logging_path} is not counted")
+                return False
+            trial['status'] = DONE
+            trial['worker'] = self.worker_name
+            trial['logging_path'] = logging_path
+
+            must_compare = all(map(lambda t: t['status'] == DONE, queue['trials'])) \
+                and not queue['compared']
+            queue['compared'] = queue['compared'] or must_compare
+            self.__write(queue)
+
+        return must_compare
+
+    def has_unfinished(self) -> bool:
+        """
+        Returns True if some experiments are not done.
+        """
+        with self.lock:
+            queue = self.__read()
+        return any(map(lambda t: t['status'] != DONE, queue['trials']))
+
+    def compare_experiments(self) -> None:
+        """
+        Compare the experiments of the search (see Search.compare_experiments).
+        """
+        with self.lock:
+            queue = self.__read()
+
+        compare_experiments(csv_output='compare',
+                            logs_path=self.search_path,
+                            hyperparameters=queue['hyperparameters'],
+                            compare_on='val',
+                            model_name=queue['model_name'])
+
+    def __read(self) -> dict[str, Any]:
+        """
+        Read the queue file (the lock must be held).
+
+        Raises:
+            FileNotFoundError: If there are no queue in the search folder.
+        """
+        if not os.path.exists(self.queue_path):
+            raise FileNotFoundError(f"{self.queue_path} wasn't found")
+        with open(self.queue_path, 'r', encoding='utf8') as f:
+            return json.load(f)
+
+    def __write(self, queue: dict[str, Any]) -> None:
+        """
+        Write the queue file atomically (the lock must be held).
+        """
+        tmp_path = f'{self.queue_path}.{self.worker_name}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump(queue, f, indent=2)
+        os.replace(tmp_path, self.queue_path)
+
+
+class Heartbeat:
+    def __init__(self,
+                 queue: SearchQueue,
+                 trial_id: int,
+                 interval: float = 60
+                 ) -> None:
+        """
+        Background thread sending heartbeats for a running experiment.
+
+        Args:
+            queue (SearchQueue): The search queue.
+            trial_id (int): The id of the running experiment.
+            interval (float, optional): Time between two heartbeats, in seconds.
+                Defaults to 60.
+        """
+        self.queue = queue
+        self.trial_id = trial_id
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __enter__(self) -> None:
+        self.thread.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop_event.set()
+        self.thread.join()
+
+    def __run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            self.queue.heartbeat(self.trial_id)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    search_path = tempfile.mkdtemp()
+    queue = SearchQueue(search_path=search_path, stale_timeout=0)
+    queue.create(configs=[EasyDict({'learning': {'learning_rate': lr}})
+                          for lr in [0.1, 0.01]],
+                 hyperparameters={'learning_rate': ['learning', 'learning_rate']},
+                 model_name='resnet')
+    print(queue.claim())
+    print(queue.claim())    # the first one is stale, because stale_timeout=0
+    print(queue.mark_done(trial_id=0, logging_path='logs/resnet_img256_0'))
@@ -50,9 +50,15 @@ def train_logger(config: EasyDict,
     """
     if not os.path.exists(logspath):
         os.makedirs(logspath)
-    folder_name = number_folder(logspath, name=f'{get_config_name(config)}_')
-    logging_path = os.path.join(logspath, folder_name)
-    os.mkdir(logging_path)
+    while True:
+        # several search workers can create a folder at the same time in logspath
+        folder_name = number_folder(logspath, name=f'{get_config_name(config)}_')
+        logging_path = os.path.join(logspath, folder_name)
+        try:
+            os.mkdir(logging_path)
+            break
+        except FileExistsError:
+            continue
     print(f'{logging_path = }')
 
     if metrics_name is None:
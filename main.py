@@ -1,13 +1,19 @@
 import os
+import copy
+import time
 import argparse
 
 from config.utils import load_config, find_config
 from config.search import Search
-from src.train import train_resnet, train_adversarial
+from config.search_queue import SearchQueue, Heartbeat
+from src.train import train_resnet, train_adversarial, distributed
 from src import test
+from src.ood import fit_ood
+from src.similarity_index import build_index, EMBEDDINGS
 
 
-MODE_IMPLEMENTED = ['train', 'test', 'random_search', 'grid_search']
+MODE_IMPLEMENTED = ['train', 'test', 'random_search', 'grid_search', 'search-worker',
+                    'fit-ood', 'build-index']
 MODEL_IMPLEMENTED = ['resnet', 'adversarial']
 
 
@@ -35,7 +41,12 @@ def main(options: dict) -> None:
             raise ValueError(f'Expected model name in {MODEL_IMPLEMENTED} but found {config.model.name}.')
         print(f'train {config.model.name}')
 
-        if config.model.name == 'resnet':
+        if config.model.name == 'resnet' and options['num_process'] > 1:
+            distributed.launch(train_resnet.train,
+                               world_size=options['num_process'],
+                               config=config)
+
+        elif config.model.name == 'resnet':
             train_resnet.train(config)
         
         if config.model.name == 'adversarial':
@@ -51,6 +62,19 @@ def main(options: dict) -> None:
 
         print(f"{options['mode']} with {num_run = } runs.")
 
+        if options['queue']:
+            queue = SearchQueue(search_path=search.get_directory(),
+                                stale_timeout=options['stale_timeout'])
+            queue.create(configs=[copy.deepcopy(search.get_new_config())
+                                  for _ in range(num_run)],
+                         hyperparameters=search.get_hyperparameters(),
+                         model_name=search.model_name)
+            print('other workers can join the search with:')
+            print('python main.py --mode search-worker '
+                  f'--path {search.get_directory()}')
+            run_search_worker(queue)
+            num_run = 0
+
         for n_run in range(num_run):
             print(f"\n- - - experiment n°{n_run + 1}/{num_run} - - -\n")
             config = search.get_new_config()
@@ -66,7 +90,17 @@ def main(options: dict) -> None:
             else:
                 raise NotImplementedError
         
-        search.compare_experiments()
+        if not options['queue']:
+            search.compare_experiments()
+
+    # SEARCH WORKER
+    if options['mode'] == 'search-worker':
+        if options['path'] is None:
+            raise ValueError('Please specify the path to the search folder')
+
+        queue = SearchQueue(search_path=options['path'],
+                            stale_timeout=options['stale_timeout'])
+        run_search_worker(queue)
     
     # TESTING
     if options['mode'] == 'test':
@@ -79,7 +113,73 @@ def main(options: dict) -> None:
         test.test(config=config,
                   logging_path=options['path'],
                   run_real_data=options['run_on_real_data'],
-                  run_silancy_metrics=options['run_saliency_metics'])
+                  run_silancy_metrics=options['run_saliency_metics'],
+                  run_perturbation_metrics=options['run_perturbation_metrics'],
+                  num_perturbation_steps=options['perturbation_steps'])
+
+    # OUT-OF-DISTRIBUTION STATISTICS
+    if options['mode'] == 'fit-ood':
+        if options['path'] is None:
+            raise ValueError('Please specify the path to the experiments')
+
+        config = load_config(find_config(experiment_path=options['path']))
+        fit_ood(config=config,
+                logging_path=options['path'],
+                run_real_data=options['run_on_real_data'],
+                image_size=options['ood_image_size'])
+
+    # SIMILARITY INDEX
+    if options['mode'] == 'build-index':
+        if options['path'] is None:
+            raise ValueError('Please specify the path to the experiments')
+
+        config = load_config(find_config(experiment_path=options['path']))
+        build_index(config=config,
+                    logging_path=options['path'],
+                    embedding=options['index_embedding'],
+                    num_subquantizers=options['index_subquantizers'])
+
+
+def run_search_worker(queue: SearchQueue, poll_interval: float = 10) -> None:
+    """
+    Claim and train the experiments of a search queue until all experiments are done.
+    The worker which finishes the last experiment compares the experiments.
+
+    Args:
+        queue (SearchQueue): The queue of the search.
+        poll_interval (float, optional): Waiting time, in seconds, when all the
+            remaining experiments are claimed by other workers. Defaults to 10.
+
+    Raises:
+        ValueError: If the model name specified in the configuration is not implemented.
+    """
+    heartbeat_interval = min(60, queue.stale_timeout / 4)
+
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            if not queue.has_unfinished():
+                break
+            # some experiments are running on other workers and can become stale
+            time.sleep(poll_interval)
+            continue
+
+        trial_id, config = claimed
+        print(f"\n- - - experiment n°{trial_id} (worker {queue.worker_name}) - - -\n")
+        if config.model.name not in MODEL_IMPLEMENTED:
+            raise ValueError(f'Expected model name in {MODEL_IMPLEMENTED} but found {config.model.name}.')
+
+        with Heartbeat(queue=queue, trial_id=trial_id, interval=heartbeat_interval):
+            if config.model.name == 'resnet':
+                logging_path = train_resnet.train(config, logspath=queue.search_path)
+            else:
+                logging_path = train_adversarial.train(config,
+                                                       logspath=queue.search_path)
+
+        if queue.mark_done(trial_id=trial_id, logging_path=logging_path):
+            queue.compare_experiments()
+
+    print('all the experiments of the search are done')
 
 
 def get_options() -> dict:
@@ -96,12 +196,32 @@ def get_options() -> dict:
         --num_run, -n: int, default=10
             Number of experiments for random search.
 
+        --num_process, -w: int, default=1
+            Number of local processes for the CPU data-parallel training (resnet only).
+
         --path, -p: str
-            Experiment path (for test and infer).
+            Experiment path (for test, infer, fit-ood and build-index), or search folder
+            (for search-worker).
+
+        --queue, -q: str, default='false'
+            Put the experiments of random_search or grid_search in a queue shared with
+            search-worker processes.
+
+        --stale_timeout: float, default=600
+            Time in seconds after which an experiment of a crashed worker is put back in
+            the queue.
 
         --run_on_real_data, -r: str, default='false'
             Run on the real data or not.
 
+        --index_embedding: str, default='features'
+            Embedding of the similarity index: 'features' (backbone) or 'fc1'
+            (for build-index).
+
+        --index_subquantizers: int, default=0
+            Number of sub-vectors of the product quantizer of the similarity index
+            (0: no PQ).
+
     Returns:
         dict: A dictionary of options.
     """
@@ -115,19 +235,54 @@ def get_options() -> dict:
                         type=str, help="path to config (for training)")
     parser.add_argument('--num_run', '-n', default=10, type=int,
                         help='number of experiment for random search')
+    parser.add_argument('--num_process', '-w', default=1, type=int,
+                        help='number of processes for the CPU data-parallel training \
+                            (resnet only)')
+
+    # For search
+    parser.add_argument('--queue', '-q', type=str, default='false',
+                        help='share the experiments of the search with search-worker \
+                            processes')
+    parser.add_argument('--stale_timeout', default=600, type=float,
+                        help='time (in seconds) after which a crashed experiment is \
+                            requeued')
     
     # For testing
     parser.add_argument('--path', '-p', type=str,
-                        help="experiment path (for test and infer)")
+                        help="experiment path (for test and infer) or search folder \
+                            (for search-worker)")
     parser.add_argument('--run_on_real_data', '-r', type=str, default='false',
                         help='run on the real data or not')
     parser.add_argument('--run_saliency_metics', '-s', type=str, default='false',
                         help='run the saliency metrics or not')
+    parser.add_argument('--run_perturbation_metrics', type=str, default='false',
+                        help='run the deletion and insertion metrics of the saliency \
+                            maps or not')
+    parser.add_argument('--perturbation_steps', type=int, default=20,
+                        help='number of steps of the deletion and insertion curves')
+
+    # For the out-of-distribution statistics
+    parser.add_argument('--ood_image_size', type=int, default=None,
+                        help='fit the OOD statistics of the images resized to this \
+                            size, for the first stage of a cascade of the inference \
+                            (-ct). default: the image size of the model')
+
+    # For the similarity index
+    parser.add_argument('--index_embedding', type=str, default='features',
+                        choices=EMBEDDINGS,
+                        help='embedding of the similarity index: backbone features or \
+                            fc1')
+    parser.add_argument('--index_subquantizers', type=int, default=0,
+                        help='number of sub-vectors of the product quantizer of the \
+                            index (0: no PQ)')
     args = parser.parse_args()
     options = vars(args)
 
     options['run_on_real_data'] = (options['run_on_real_data'].lower() == 'true')
+    options['queue'] = (options['queue'].lower() == 'true')
     options['run_saliency_metics'] = (options['run_saliency_metics'].lower() == 'true')
+    options['run_perturbation_metrics'] = \
+        (options['run_perturbation_metrics'].lower() == 'true')
 
     return options
 
@@ -3,25 +3,122 @@ import argparse
 
 from config.utils import load_config, find_config
 from src.infer import infer
+from src.tiled_infer import tiled_infer
+from src.multi_head_infer import multi_head_infer
+from src.sharded_infer import sharded_infer
+from src.watch_infer import watch_infer
+from src.gradcam import SALIENCY_METHODS, SMOOTH_PRESETS
+from src.saliency_store import SALIENCY_OUTPUTS
+from src.infer_cache import CACHE_NAME
+from src.columnar_writer import COLUMNAR_OUTPUTS
+from src.dataloader.infer_dataloader import is_archive
 
 MODEL_IMPLEMENTED = ['resnet', 'adversarial']
+HEADS_OUTPUTS = ['both', 'side-by-side', 'ensemble']
+# the options of the default mode which are not used by the other modes
+INFER_OPTIONS = {'saliency_output': '-so', 'saliency_topk': '-sk', 'cache': '-c',
+                 'columnar_output': '-co', 'cascade_threshold': '-ct',
+                 'cascade_size': '-cs', 'cascade_model': '-cm', 'ood_gate': '-ood',
+                 'ood_threshold': '-oodt', 'similar': '-sim'}
 
 
-def main(options: dict) -> None:    
+def main(options: dict) -> None:
     config = load_config(find_config(experiment_path=options['modelpath']))
     if config.model.name not in MODEL_IMPLEMENTED:
         raise ValueError(f'Expected model name in {MODEL_IMPLEMENTED} but',
                          f' found {config.model.name}.')
-    
+
+    if options['watch']:
+        watch_infer(watch_path=options['datapath'],
+                    logging_path=options['modelpath'],
+                    dstpath=options['dstpath'],
+                    filename='inference_results.csv',
+                    plot_saliency=options['plot_saliency'],
+                    saliency_method=options['saliency_method'],
+                    saliency_smooth=options['saliency_smooth'],
+                    poll_interval=options['watch_interval'],
+                    sep=';')
+        return None
+
+    if options['heads'] is not None:
+        if options['plot_saliency']:
+            print('the saliency maps are not computed with several heads')
+        multi_head_infer(infer_datapath=options['datapath'],
+                         logging_paths=[options['modelpath']] + options['heads'],
+                         dstpath=options['dstpath'],
+                         filename='inference_results.csv',
+                         run_temperature_optimization=True,
+                         sep=';',
+                         side_by_side=options['heads_output'] in ['both',
+                                                                  'side-by-side'],
+                         ensemble=options['heads_output'] in ['both', 'ensemble'])
+        return None
+
+    if options['tile_stride'] is not None or options['stains']:
+        if options['plot_saliency']:
+            print('the saliency maps are not computed on crops (see the class maps)')
+        if options['similar'] > 0:
+            print('the similar cases are not searched on crops')
+
+    if options['stains']:
+        # needs opencv and scikit-image (src.explainable), only imported in this mode
+        from src.stain_infer import stain_infer
+        stain_infer(infer_datapath=options['datapath'],
+                    logging_path=options['modelpath'],
+                    config=config,
+                    dstpath=options['dstpath'],
+                    filename='inference_results.csv',
+                    run_temperature_optimization=True,
+                    sep=';')
+        return None
+
+    if options['tile_stride'] is not None:
+        tiled_infer(infer_datapath=options['datapath'],
+                    logging_path=options['modelpath'],
+                    config=config,
+                    dstpath=options['dstpath'],
+                    filename='inference_results.csv',
+                    stride=options['tile_stride'],
+                    run_temperature_optimization=True,
+                    sep=';')
+        return None
+
+    infer_options = dict(plot_saliency=options['plot_saliency'],
+                         run_temperature_optimization=True,
+                         saliency_method=options['saliency_method'],
+                         saliency_smooth=options['saliency_smooth'],
+                         saliency_output=options['saliency_output'],
+                         saliency_topk=options['saliency_topk'],
+                         cache_path=os.path.join(options['dstpath'], CACHE_NAME)
+                         if options['cache'] else None,
+                         columnar_output=options['columnar_output'],
+                         cascade_threshold=options['cascade_threshold'],
+                         cascade_image_size=options['cascade_size'],
+                         cascade_logging_path=options['cascade_model'],
+                         ood_gate=options['ood_gate'],
+                         ood_threshold=options['ood_threshold'],
+                         similar_k=options['similar'])
+
+    if options['num_process'] > 1:
+        sharded_infer(infer_datapath=options['datapath'],
+                      logging_path=options['modelpath'],
+                      config=config,
+                      dstpath=options['dstpath'],
+                      filename='inference_results.csv',
+                      num_process=options['num_process'],
+                      threads_per_process=options['threads_per_process'],
+                      sep=';',
+                      **infer_options)
+        return None
+
     infer(infer_images_path=None,
           infer_datapath=options['datapath'],
           logging_path=options['modelpath'],
-          plot_saliency=options['plot_saliency'],
           config=config,
           dstpath=options['dstpath'],
           filename='inference_results.csv',
-          run_temperature_optimization=True,
-          sep=';')
+          sep=';',
+          **infer_options)
 
 
 def get_and_prosses_options() -> dict:
@@ -38,23 +135,150 @@ def get_and_prosses_options() -> dict:
                             default: logs/retrain_resnet_allw_img256_2")
     parser.add_argument('--datapath', '-d', type=str,
                         help="path to the folder witch contains the images to run \
-                            the inference on.")
+                            the inference on (or to a zip or tar archive of images).")
     parser.add_argument('--dstpath', '-o', type=str,
-                        help="path to the folder where the inference results will be saved. \
-                            default: <datapath>/inference_results")
+                        help="path to the folder where the inference results will be \
+                            saved. default: <datapath>/inference_results")
     parser.add_argument('--plot_saliency', '-s', type=str, default='true',
                         choices=['true', 'false'],
                         help="plot the saliency map. default: true")
+    parser.add_argument('--saliency_method', '-sm', type=str, default='gradcam',
+                        choices=SALIENCY_METHODS,
+                        help="method of the saliency map: gradcam, or fastcam which \
+                            reuses the prediction forward (faster). default: gradcam")
+    parser.add_argument('--saliency_smooth', '-ss', type=str, default='full',
+                        choices=list(SMOOTH_PRESETS),
+                        help="quality of the gradcam smoothing: off, fast (flips) or \
+                            full (flips, intensities and eigen smoothing). default: \
+                            full")
+    parser.add_argument('--saliency_output', '-so', type=str, default='png',
+                        choices=SALIENCY_OUTPUTS,
+                        help="save the saliency maps as png images, as raw low \
+                            resolution maps in one saliency_maps.npz file, or both. \
+                            default: png")
+    parser.add_argument('--saliency_topk', '-sk', type=int, default=1,
+                        choices=[1, 2, 3],
+                        help="number of predicted classes to explain with a saliency \
+                            map (computed in one batched pass). default: 1")
+    parser.add_argument('--cache', '-c', type=str, default='false',
+                        choices=['true', 'false'],
+                        help="reuse the results of the images already inferred (stored \
+                            in <dstpath>/infer_cache.sqlite). default: false")
+    parser.add_argument('--columnar_output', '-co', type=str, default=None,
+                        choices=COLUMNAR_OUTPUTS,
+                        help="also save the probabilities, the logits and the \
+                            embedding of each image in parquet, arrow or jsonl format. \
+                            default: None")
+    parser.add_argument('--cascade_threshold', '-ct', type=float, default=None,
+                        help="cascade mode: keep the prediction of a cheap first stage \
+                            when its top-1 probability is at least this threshold, and \
+                            only run the full model (and the saliency map) on the \
+                            other images. default: None")
+    parser.add_argument('--cascade_size', '-cs', type=int, default=128,
+                        help="image size of the first stage of the cascade (same model \
+                            at a lower resolution). default: 128")
+    parser.add_argument('--cascade_model', '-cm', type=str, default=None,
+                        help="path to a smaller model for the first stage of the \
+                            cascade (its image size is used). default: None (the same \
+                            model)")
+    parser.add_argument('--ood_gate', '-ood', type=str, default='false',
+                        choices=['true', 'false'],
+                        help="flag the images which are far from the training set \
+                            (e.g. rulers, overview shots) with an OOD score, and skip \
+                            their saliency maps. The statistics are fitted with: \
+                            python main.py --mode fit-ood --path <modelpath>. default: \
+                            false")
+    parser.add_argument('--ood_threshold', '-oodt', type=float, default=None,
+                        help="threshold of the OOD score. default: the threshold \
+                            fitted with the statistics (99%% of the training images \
+                            are below)")
+    parser.add_argument('--similar', '-sim', type=int, default=0,
+                        help="write the k most similar labelled images of each image \
+                            (from the similarity index built with: python main.py \
+                            --mode build-index --path <modelpath>). default: 0")
+    parser.add_argument('--heads', '-mh', type=str, nargs='+', default=None,
+                        help="multi-head mode: other models (log folders) whose resnet \
+                            is frozen like the one of --modelpath. The resnet runs \
+                            once per batch and each model only adds its head. default: \
+                            None")
+    parser.add_argument('--heads_output', '-ho', type=str, default='both',
+                        choices=HEADS_OUTPUTS,
+                        help="results of the multi-head mode: one file per model \
+                            (side-by-side), the mean of the models (ensemble) or both. \
+                            default: both")
+    parser.add_argument('--num_process', '-np', type=int, default=1,
+                        help="number of inference processes: the images are split into \
+                            shards, the weights are loaded once in shared memory, and \
+                            the results of the shards are merged in the order of the \
+                            images. default: 1")
+    parser.add_argument('--threads_per_process', '-tp', type=int, default=None,
+                        help="number of torch threads of each inference process. \
+                            default: the cpu count divided by the number of processes")
+    parser.add_argument('--watch', '-w', type=str, default='false',
+                        choices=['true', 'false'],
+                        help="daemon mode: watch the datapath folder and classify the \
+                            new images as they arrive (the saliency maps on a lower \
+                            priority lane), until Ctrl+C. A restarted daemon skips the \
+                            images already classified. default: false")
+    parser.add_argument('--watch_interval', '-wi', type=float, default=5,
+                        help="time between two polls of the watched folder, in \
+                            seconds. default: 5")
+    parser.add_argument('--tile_stride', '-t', type=int, default=None,
+                        help="tiled mode for high resolution images: cut each image \
+                            into overlapping tiles of the image size of the model, \
+                            spaced by this stride in pixels, and save a class map per \
+                            image. default: None")
+    parser.add_argument('--stains', '-st', type=str, default='false',
+                        choices=['true', 'false'],
+                        help="only classify the stains: find them with a red mask at \
+                            low resolution and classify their crops of the full \
+                            resolution image. default: false")
     args = parser.parse_args()
     options = vars(args)
+    infer_options = [flag for name, flag in INFER_OPTIONS.items()
+                     if options[name] != parser.get_default(name)]
 
     options['plot_saliency'] = (options['plot_saliency'] == 'true')
+    options['cache'] = (options['cache'] == 'true')
+    options['stains'] = (options['stains'] == 'true')
+    options['ood_gate'] = (options['ood_gate'] == 'true')
+    options['watch'] = (options['watch'] == 'true')
 
     if options['datapath'] is None:
         raise ValueError('Please specify the path to the data')
-    
+
+    if options['stains'] and options['tile_stride'] is not None:
+        raise ValueError('Please choose between the tiles (-t) and the stains (-st)')
+
+    if options['heads'] is not None and (options['stains']
+                                         or options['tile_stride'] is not None):
+        raise ValueError('Please choose between the heads (-mh) and the crops '
+                         '(-t or -st)')
+
+    if options['num_process'] > 1 and (options['heads'] is not None or options['stains']
+                                       or options['tile_stride'] is not None):
+        raise ValueError('Several processes (-np) are only available for the default '
+                         'mode')
+
+    if options['watch'] and (options['num_process'] > 1
+                             or options['heads'] is not None
+                             or options['stains']
+                             or options['tile_stride'] is not None):
+        raise ValueError('The watch mode (-w) is only available for the default mode')
+
+    if options['heads'] is not None and infer_options != []:
+        raise ValueError(f"The options {', '.join(infer_options)} are not available in "
+                         f"the multi-head mode (-mh)")
+
+    if options['watch'] and infer_options != []:
+        raise ValueError(f"The options {', '.join(infer_options)} are not available in "
+                         f"the watch mode (-w)")
+
     if options['dstpath'] is None:
-        options['dstpath'] = os.path.join(options['datapath'], 'inference_results')
+        # the results of an archive are saved next to it
+        datafolder = os.path.dirname(options['datapath']) \
+            if is_archive(options['datapath']) else options['datapath']
+        options['dstpath'] = os.path.join(datafolder, 'inference_results')
         os.makedirs(options['dstpath'], exist_ok=True)
         print('The inference results will be saved at', options['dstpath'])
 
@@ -63,4 +287,4 @@ def get_and_prosses_options() -> dict:
 
 if __name__ == "__main__":
     options = get_and_prosses_options()
-    main(options)
\ No newline at end of file
+    main(options)
@@ -0,0 +1,61 @@
+import os
+import argparse
+
+from config.utils import load_config, find_config
+from src.predictor import Predictor
+from src.server import InferenceService, serve
+from src.gradcam import SALIENCY_METHODS, SMOOTH_PRESETS
+
+MODEL_IMPLEMENTED = ['resnet', 'adversarial']
+
+
+def main(options: dict) -> None:
+    config = load_config(find_config(experiment_path=options['modelpath']))
+    if config.model.name not in MODEL_IMPLEMENTED:
+        raise ValueError(f'Expected model name in {MODEL_IMPLEMENTED} but'
+                         f' found {config.model.name}.')
+
+    predictor = Predictor(logging_path=options['modelpath'],
+                          max_batch_size=options['max_batch_size'],
+                          max_latency=options['max_latency'])
+    service = InferenceService(predictor=predictor,
+                               saliency_method=options['saliency_method'],
+                               saliency_smooth=options['saliency_smooth'])
+    serve(service=service, host=options['host'], port=options['port'])
+
+
+def get_and_prosses_options() -> dict:
+    """
+    Get and process the command line options.
+
+    Return:
+        options (dict): A dictionary containing the processed options.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modelpath', '-m', type=str,
+                        default=os.path.join('logs', 'retrain_resnet_allw_img256_2'),
+                        help="path to the model to serve. \
+                            default: logs/retrain_resnet_allw_img256_2")
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help="host of the server. default: 127.0.0.1")
+    parser.add_argument('--port', '-p', type=int, default=8000,
+                        help="port of the server. default: 8000")
+    parser.add_argument('--max_batch_size', '-b', type=int, default=16,
+                        help="maximum number of images classified together. \
+                            default: 16")
+    parser.add_argument('--max_latency', '-l', type=float, default=10,
+                        help="maximum time (in ms) an image waits for other images \
+                            before its batch is run. default: 10")
+    parser.add_argument('--saliency_method', '-sm', type=str, default='gradcam',
+                        choices=SALIENCY_METHODS,
+                        help="method of the saliency map. default: gradcam")
+    parser.add_argument('--saliency_smooth', '-ss', type=str, default='fast',
+                        choices=list(SMOOTH_PRESETS),
+                        help="quality of the gradcam smoothing. default: fast")
+    args = parser.parse_args()
+    return vars(args)
+
+
+if __name__ == "__main__":
+    options = get_and_prosses_options()
+    main(options)
@@ -0,0 +1,279 @@
+import os
+import json
+import glob
+import numpy as np
+from typing import Any
+
+
+COLUMNAR_OUTPUTS = ['parquet', 'arrow', 'jsonl']
+PART_NAME = 'part_{:05d}'
+
+
+class ColumnarWriter:
+    def __init__(self,
+                 path: str,
+                 output_format: str,
+                 resume: bool = False,
+                 rows_per_file: int = 8192
+                 ) -> None:
+        """
+        Write the full outputs of the model for each image: the probabilities (float32),
+        the top-k indices, the raw logits and the embedding (fc1 activations).
+            - parquet / arrow: a folder of part files (path.parquet or path.arrow), with
+              one row group (or record batch) per batch. It can be read at once with
+              pandas.read_parquet or pyarrow.dataset. A part is renamed from .tmp when
+              it has rows_per_file rows or at close, so a crash only loses the open
+              part.
+            - jsonl: one JSON object per line in path.jsonl.
+
+        Args:
+            path (str): The path of the output, without extension.
+            output_format (str): The format, in COLUMNAR_OUTPUTS.
+            resume (bool, optional): Keep the rows of the existing output.
+                Defaults to False.
+            rows_per_file (int, optional): The number of rows of a part
+                (parquet and arrow). Defaults to 8192.
+
+        Raises:
+            ValueError: If output_format is not in COLUMNAR_OUTPUTS.
+            ImportError: If pyarrow is not installed (parquet and arrow).
+        """
+        if output_format not in COLUMNAR_OUTPUTS:
+            raise ValueError(f'Expected output_format in {COLUMNAR_OUTPUTS} '
+                             f'but found {output_format}')
+        if output_format != 'jsonl':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError as error:
+                raise ImportError(f'pyarrow is needed to write {output_format} files: '
+                                  'pip install pyarrow') from error
+
+        self.output_format = output_format
+        self.path = f'{path}.{output_format}'
+        self.rows_per_file = rows_per_file
+        self.part_rows: list[int] = []
+        self.part_writer = None
+        self.num_open_rows: int = 0
+
+        if output_format == 'jsonl':
+            self.__init_jsonl(resume=resume)
+        else:
+            self.__init_parts(resume=resume)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of rows which would survive a crash.
+        """
+        if self.output_format == 'jsonl':
+            return self.num_rows
+        return sum(self.part_rows)
+
+    def write(self,
+              images_paths: list[str],
+              probabilities: np.ndarray,
+              topk_indices: np.ndarray,
+              logits: np.ndarray,
+              embeddings: np.ndarray,
+              scalars: dict[str, np.ndarray] | None = None
+              ) -> None:
+        """
+        Append the outputs of a batch.
+
+        Args:
+            images_paths (list[str]): The paths of the images.
+            probabilities (np.ndarray): The probabilities with shape (B, num_classes).
+            topk_indices (np.ndarray): The indices of the top-k classes with shape
+                (B, k).
+            logits (np.ndarray): The logits with shape (B, num_classes).
+            embeddings (np.ndarray): The fc1 activations with shape (B, hidden_size).
+            scalars (dict[str, np.ndarray] | None, optional): Columns with one value per
+                image, with shape (B), e.g. {'stage': stages}. Defaults to None.
+        """
+        columns = {'probabilities': probabilities.astype(np.float32),
+                   'topk_indices': topk_indices.astype(np.int32),
+                   'logits': logits.astype(np.float32),
+                   'embedding': embeddings.astype(np.float32)}
+        scalar_columns = scalars or {}
+
+        if self.output_format == 'jsonl':
+            lines = [json.dumps({'image': image_path,
+                                 **{name: column[i].tolist()
+                                    for name, column in columns.items()},
+                                 **{name: None if np.isnan(column[i])
+                                    else column[i].item()
+                                    for name, column in scalar_columns.items()}})
+                     for i, image_path in enumerate(images_paths)]
+            self.file.write(''.join(map(lambda line: line + '\n', lines)))
+            self.file.flush()
+            self.num_rows += len(lines)
+            return None
+
+        import pyarrow as pa
+        arrays = [pa.array(images_paths, type=pa.string())]
+        for column in columns.values():
+            values = pa.array(column.reshape(-1))
+            arrays.append(pa.FixedSizeListArray.from_arrays(values, column.shape[1]))
+        # the NaN values are written as nulls
+        arrays += [pa.array(column, from_pandas=True)
+                   for column in scalar_columns.values()]
+        names = ['image'] + list(columns) + list(scalar_columns)
+        batch = pa.RecordBatch.from_arrays(arrays, names=names)
+
+        if self.part_writer is None:
+            self.__open_part(batch.schema)
+        # one row group (parquet) or record batch (arrow) per batch
+        self.part_writer.write_batch(batch)
+        self.num_open_rows += len(images_paths)
+        if self.num_open_rows >= self.rows_per_file:
+            self.__close_part()
+        return None
+
+    def truncate(self, num_rows: int) -> None:
+        """
+        Keep only the first num_rows rows (to call after a resume, before writing).
+
+        Args:
+            num_rows (int): The number of rows to keep.
+        """
+        if num_rows >= len(self):
+            return None
+
+        if self.output_format == 'jsonl':
+            self.file.close()
+            with open(self.path, 'r', encoding='utf8') as f:
+                lines = [next(f) for _ in range(num_rows)]
+            with open(self.path, 'w', encoding='utf8') as f:
+                f.writelines(lines)
+            self.num_rows = num_rows
+            self.file = open(self.path, 'a', encoding='utf8')
+            return None
+
+        kept = 0
+        for i, part_rows in enumerate(self.part_rows):
+            part_path = self.__get_part_path(i)
+            if kept + part_rows <= num_rows:
+                kept += part_rows
+                continue
+            if kept < num_rows:
+                table = self.__read_part(part_path).slice(0, num_rows - kept)
+                self.__write_table(table, part_path)
+                self.part_rows[i] = num_rows - kept
+                kept = num_rows
+            else:
+                os.remove(part_path)
+                self.part_rows[i] = 0
+        self.part_rows = [part_rows for part_rows in self.part_rows if part_rows > 0]
+        return None
+
+    def close(self) -> None:
+        """
+        Close the output.
+        """
+        if self.output_format == 'jsonl':
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        else:
+            self.__close_part()
+        print(f'Columnar results saved at {self.path}')
+
+    def __init_jsonl(self, resume: bool) -> None:
+        """ Open the JSON Lines file, and count its complete rows if it is resumed """
+        self.num_rows = 0
+        if resume and os.path.exists(self.path):
+            with open(self.path, 'rb+') as f:
+                content = f.read()
+                end = content.rfind(b'\n') + 1
+                f.truncate(end)
+                self.num_rows = content[:end].count(b'\n')
+            self.file = open(self.path, 'a', encoding='utf8')
+        else:
+            self.file = open(self.path, 'w', encoding='utf8')
+
+    def __init_parts(self, resume: bool) -> None:
+        """ Create the folder of the parts, and find the closed parts on a resume """
+        os.makedirs(self.path, exist_ok=True)
+        for tmp_path in glob.glob(os.path.join(self.path, '*.tmp')):
+            os.remove(tmp_path)
+        parts = sorted(glob.glob(os.path.join(self.path, f'*.{self.output_format}')))
+        if not resume:
+            for part_path in parts:
+                os.remove(part_path)
+            return None
+
+        for i in range(len(parts)):
+            part_path = self.__get_part_path(i)
+            if not os.path.exists(part_path):
+                break
+            self.part_rows.append(self.__read_part(part_path).num_rows)
+        return None
+
+    def __get_part_path(self, index: int) -> str:
+        """ Get the path of a closed part """
+        return os.path.join(self.path,
+                            f'{PART_NAME.format(index)}.{self.output_format}')
+
+    def __open_part(self, schema: Any) -> None:
+        """ Open a new part (.tmp until it is closed) """
+        import pyarrow.ipc
+        import pyarrow.parquet as pq
+        tmp_path = self.__get_part_path(len(self.part_rows)) + '.tmp'
+        if self.output_format == 'parquet':
+            self.part_writer = pq.ParquetWriter(tmp_path, schema=schema)
+        else:
+            self.part_writer = pyarrow.ipc.new_file(tmp_path, schema=schema)
+        self.num_open_rows = 0
+
+    def __close_part(self) -> None:
+        """ Close the open part and make it visible """
+        if self.part_writer is None:
+            return None
+        self.part_writer.close()
+        part_path = self.__get_part_path(len(self.part_rows))
+        os.replace(part_path + '.tmp', part_path)
+        self.part_rows.append(self.num_open_rows)
+        self.part_writer = None
+        self.num_open_rows = 0
+        return None
+
+    def __read_part(self, part_path: str) -> Any:
+        """ Read a part into a pyarrow Table """
+        import pyarrow.ipc
+        import pyarrow.parquet as pq
+        if self.output_format == 'parquet':
+            return pq.read_table(part_path)
+        with pyarrow.ipc.open_file(part_path) as reader:
+            return reader.read_all()
+
+    def __write_table(self, table: Any, part_path: str) -> None:
+        """ Write a pyarrow Table into a part """
+        import pyarrow.ipc
+        import pyarrow.parquet as pq
+        if self.output_format == 'parquet':
+            pq.write_table(table, part_path)
+        else:
+            with pyarrow.ipc.new_file(part_path, schema=table.schema) as writer:
+                writer.write_table(table)
+
+    def __enter__(self) -> 'ColumnarWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'inference_results')
+    for output_format in COLUMNAR_OUTPUTS:
+        with ColumnarWriter(path=path,
+                            output_format=output_format,
+                            rows_per_file=64) as writer:
+            for i in range(5):
+                writer.write(images_paths=[f'image_{i}_{j}.jpg' for j in range(32)],
+                             probabilities=np.random.rand(32, 18),
+                             topk_indices=np.random.randint(18, size=(32, 3)),
+                             logits=np.random.randn(32, 18),
+                             embeddings=np.random.rand(32, 64))
+        print(f'{output_format}: {len(writer)} rows')
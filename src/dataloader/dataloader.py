@@ -7,12 +7,13 @@ from os.path import dirname as up
 
 import torch
 from torch import Tensor
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 
 sys.path.append(up(up(up(os.path.abspath(__file__)))))
 
 from src.dataloader.transforms import get_transforms
 from src.dataloader.labels import LABELS, BACKGROUND
+from src.dataloader.sampler import get_loss_based_sampler
 
 
 class DataGenerator(Dataset):
@@ -90,7 +91,7 @@ class DataGenerator(Dataset):
 
         Returns:
             dict[str, Tensor]: A dictionary containing the retrieved item 
-            with the following keys: 'image', 'label', and 'background'.
+            with the following keys: 'image', 'label', 'background' and 'index'.
 
         Raises:
             ValueError: If the label or background is not found in the predefined lists.
@@ -100,6 +101,7 @@ class DataGenerator(Dataset):
         image:      (3, image_size, image_size)     torch.float32
         label:      (1)                             torch.int64
         background: (1)                             torch.int64
+        index:      (1)                             torch.int64
         """
         image_path, label, background = self.data[index]
 
@@ -122,12 +124,17 @@ class DataGenerator(Dataset):
             item['background'] = torch.tensor(BACKGROUND.index(background),
                                               dtype=torch.int64)
 
+        # Get index (to track the loss of each sample)
+        item['index'] = torch.tensor(index, dtype=torch.int64)
+
         return item
 
 
 def create_dataloader(config: EasyDict,
                       mode: Literal['train', 'val', 'test'],
-                      run_real_data: bool = False
+                      run_real_data: bool = False,
+                      num_replicas: int = 1,
+                      rank: int = 0
                       ) -> DataLoader:
     """
     Create a DataLoader object for loading data.
@@ -136,9 +143,18 @@ def create_dataloader(config: EasyDict,
         config (EasyDict): Configuration object containing data and learning settings.
         mode (Literal['train', 'val', 'test']): Mode of operation ('train', 'val', 'test').
         run_real_data (bool, optional): Flag indicating whether to run with real data. Defaults to False.
+        num_replicas (int, optional): Number of processes for distributed training.
+            Defaults to 1.
+        rank (int, optional): Rank of the current process (each rank gets its own
+            shard). Defaults to 0.
+
+    Raises:
+        ValueError: If the data pruning is used with distributed training.
 
     Returns:
-        DataLoader: DataLoader object for loading data.
+        DataLoader: DataLoader object for loading data. In train mode, if
+            learning.data_pruning.do_pruning is true, the sampler is a LossBasedSampler.
+            If num_replicas > 1, the sampler is a DistributedSampler.
     """
 
     if not run_real_data:
@@ -162,10 +178,24 @@ def create_dataloader(config: EasyDict,
         print(f'Change batch size to {config_info.batch_size} from {len(generator)}')
         config_info.batch_size = len(generator)
 
+    sampler = None
+    if mode == 'train':
+        sampler = get_loss_based_sampler(config=config, num_samples=len(generator))
+
+    if num_replicas > 1:
+        if sampler is not None:
+            raise ValueError('data pruning is not available with distributed training')
+        sampler = DistributedSampler(dataset=generator,
+                                     num_replicas=num_replicas,
+                                     rank=rank,
+                                     shuffle=config_info.shuffle,
+                                     drop_last=config_info.drop_last)
+
     dataloader = DataLoader(
         dataset=generator,
         batch_size=config_info.batch_size,
-        shuffle=config_info.shuffle,
+        shuffle=config_info.shuffle if sampler is None else False,
+        sampler=sampler,
         drop_last=config_info.drop_last,
         num_workers=config_info.num_workers,
     )
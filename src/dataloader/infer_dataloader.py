@@ -1,10 +1,15 @@
+import io
 import os
+import tarfile
+import zipfile
 from PIL import Image
+from typing import Iterator
 from easydict import EasyDict
 
+import torch
 from torch import Tensor
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, IterableDataset, DataLoader, get_worker_info
 
 
 class InferDataGenerator(Dataset):
@@ -59,7 +64,7 @@ class InferDataGenerator(Dataset):
                 and its corresponding path.
         """
         image_path = self.data[index]
-        image = Image.open(image_path)
+        image = open_image(image_path)
         x = self.transform(image)
         return x, image_path
 
@@ -84,13 +89,18 @@ def get_image_from_path(datapath: str) -> list[str]:
     Get a list of image file paths from a given datapath.
 
     Args:
-        datapath (str): The path to the directory containing the images or the path to a single image file.
+        datapath (str): The path to the directory containing the images, the path
+            to a single image file or the path to a zip or tar archive (whose
+            images are given as 'archive!member', in the order of the archive).
 
     Returns:
         list[str]: A list of image file paths.
     """
     data: list[str] = []
-    if not is_image(datapath):
+    if is_archive(datapath) and os.path.isfile(datapath):
+        names = get_archive_reader(datapath).get_names()
+        data = [f'{datapath}!{name}' for name in names if is_image(name)]
+    elif not is_image(datapath):
         for dirpath, _, filenames in os.walk(datapath):
             if filenames != []:
                 good_files = filter(is_image, filenames)
@@ -103,6 +113,161 @@ def get_image_from_path(datapath: str) -> list[str]:
     return data
 
 
+class ArchiveReader:
+    def __init__(self, path: str) -> None:
+        """
+        Read the members of a zip or tar archive without extracting it. The zip
+        archives and the uncompressed tar archives are read in any order. A
+        compressed tar archive can only be decompressed from its start, so it is
+        read as a stream which moves forward: its members must be read in the order
+        of the archive (reading a member before the current position restarts the
+        stream), which is the case of the workers of an infer dataloader.
+
+        Args:
+            path (str): The path of the archive.
+        """
+        self.path = path
+        self.is_zip = path.lower().endswith('.zip')
+        self.is_stream = not self.is_zip and not path.lower().endswith('.tar')
+
+        self.archive: zipfile.ZipFile | tarfile.TarFile | None = None
+        self.members: dict[str, tarfile.TarInfo] = {}
+        if self.is_zip:
+            self.archive = zipfile.ZipFile(path)
+        elif not self.is_stream:
+            self.archive = tarfile.open(path, 'r:')
+            self.members = {member.name: member
+                            for member in self.archive.getmembers()
+                            if member.isfile()}
+        self.stream: Iterator[tarfile.TarInfo] | None = None
+
+    def get_names(self) -> list[str]:
+        """
+        Get the names of the files of the archive, in the order of the archive.
+        """
+        if self.is_zip:
+            return [info.filename for info in self.archive.infolist()
+                    if not info.is_dir()]
+        if not self.is_stream:
+            return list(self.members)
+        with tarfile.open(self.path, 'r|*') as archive:
+            return [member.name for member in archive if member.isfile()]
+
+    def read(self, name: str) -> bytes:
+        """
+        Read the content of a member of the archive.
+
+        Args:
+            name (str): The name of the member.
+
+        Raises:
+            KeyError: If the archive has no file with this name.
+
+        Returns:
+            bytes: The content of the member.
+        """
+        if self.is_zip:
+            return self.archive.read(name)
+        if not self.is_stream:
+            return self.archive.extractfile(self.members[name]).read()
+
+        # look forward from the current position, then once from the start of the
+        # archive
+        for _ in range(2):
+            if self.stream is None:
+                self.archive = tarfile.open(self.path, 'r|*')
+                self.stream = iter(self.archive)
+            for member in self.stream:
+                if member.name == name and member.isfile():
+                    return self.archive.extractfile(member).read()
+            self.archive.close()
+            self.stream = None
+        raise KeyError(f'{name} was not found in {self.path}')
+
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2',
+                      '.tar.xz', '.txz')
+# the readers of each process: the dataloader workers open their own file handles
+_ARCHIVE_READERS: dict[tuple[int, str], ArchiveReader] = {}
+
+
+def is_archive(path: str) -> bool:
+    """ Check if a path has the extension of a zip or tar archive """
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def get_archive_reader(path: str) -> ArchiveReader:
+    """ Get the reader of an archive, opened once per process """
+    key = (os.getpid(), path)
+    if key not in _ARCHIVE_READERS:
+        _ARCHIVE_READERS[key] = ArchiveReader(path)
+    return _ARCHIVE_READERS[key]
+
+
+def split_archive_path(image_path: str) -> tuple[str, str] | None:
+    """
+    Split the path of an archive member, 'archive!member', into the path of the
+    archive and the name of the member.
+
+    Args:
+        image_path (str): The path of the image.
+
+    Returns:
+        tuple[str, str] | None: The archive path and the member name, or None if
+            image_path is not in an archive.
+    """
+    index = image_path.find('!')
+    while index != -1:
+        archive_path = image_path[:index]
+        if is_archive(archive_path) and os.path.isfile(archive_path):
+            return archive_path, image_path[index + 1:]
+        index = image_path.find('!', index + 1)
+    return None
+
+
+def open_image(image_path: str) -> Image.Image:
+    """
+    Open an image file or an image of an archive ('archive!member', see
+    get_image_from_path).
+
+    Args:
+        image_path (str): The path of the image.
+
+    Returns:
+        Image.Image: The image.
+    """
+    archive_member = split_archive_path(image_path)
+    if archive_member is None:
+        return Image.open(image_path)
+    archive_path, name = archive_member
+    return Image.open(io.BytesIO(get_archive_reader(archive_path).read(name)))
+
+
+def get_output_name(image_name: str) -> str:
+    """
+    Get the name of the files of an image output (saliency map, class map): the
+    relative path of the image without its extension, with '_' instead of the path
+    separators. For an image of an archive, the name of the archive (without its
+    extension) and the path of the member (without a leading './') are joined by
+    '_'.
+
+    Args:
+        image_name (str): The relative path of the image.
+
+    Returns:
+        str: The name, without extension.
+    """
+    archive_name, is_member, member = image_name.partition('!')
+    if is_member and is_archive(archive_name):
+        extension = next(extension for extension in ARCHIVE_EXTENSIONS
+                         if archive_name.lower().endswith(extension))
+        member_name = os.path.splitext(os.path.normpath(member))[0]
+        name = f'{archive_name[:-len(extension)]}_{member_name}'
+    else:
+        name = os.path.splitext(image_name)[0]
+    return name.replace(os.sep, '_').replace('/', '_')
+
+
 def create_infer_dataloader(config: EasyDict,
                             data: list[str],
                             datapath: str
@@ -132,6 +297,139 @@ def create_infer_dataloader(config: EasyDict,
     return dataloader
 
 
+class TileDataGenerator(IterableDataset):
+    def __init__(self,
+                 data: list[str],
+                 tile_size: int,
+                 stride: int
+                 ) -> None:
+        """
+        Stream of the overlapping tiles of the images, at their native resolution. The
+        tiles of all the images follow each other, so a batch is filled with the tiles
+        of the next image instead of ending at an image boundary. With several workers,
+        each worker streams the tiles of a share of the images.
+
+        Args:
+            data (list[str]): A list of image paths.
+            tile_size (int): The size of the square tiles, in pixels.
+            stride (int): The distance between two neighbouring tiles, in pixels.
+
+        Raises:
+            ValueError: If stride is not between 1 and tile_size.
+        """
+        if not 0 < stride <= tile_size:
+            raise ValueError(f'Expected stride between 1 and {tile_size} '
+                             f'but found {stride}')
+        self.data = data
+        self.tile_size = tile_size
+        self.stride = stride
+        print('number of images:', len(self.data))
+
+    def __iter__(self) -> Iterator[tuple[Tensor, Tensor]]:
+        """
+        Yields the tiles of the images.
+
+        Yields:
+            (tile, info): tuple[Tensor, Tensor], the tile with shape
+                (3, tile_size, tile_size) and its info: the index of its image, its box
+                (top, left, bottom, right), the number of tiles of its image and the
+                height and width of its image (after the resize of the images smaller
+                than a tile).
+        """
+        worker_info = get_worker_info()
+        indexes = range(len(self.data))
+        if worker_info is not None:
+            indexes = indexes[worker_info.id::worker_info.num_workers]
+
+        for index in indexes:
+            image = load_tile_image(self.data[index], tile_size=self.tile_size)
+            height, width = image.shape[-2:]
+            positions = get_tile_positions(height, width,
+                                           tile_size=self.tile_size,
+                                           stride=self.stride)
+            for top, left in positions:
+                tile = image[:, top: top + self.tile_size, left: left + self.tile_size]
+                yield tile, torch.tensor([index, top, left,
+                                          top + self.tile_size, left + self.tile_size,
+                                          len(positions), height, width])
+
+
+def load_tile_image(image_path: str, tile_size: int) -> Tensor:
+    """
+    Load an image at its native resolution. An image smaller than a tile is resized
+    (keeping its aspect ratio) so that it contains at least one tile.
+
+    Args:
+        image_path (str): The path of the image.
+        tile_size (int): The size of the tiles.
+
+    Returns:
+        Tensor: The image with shape (3, H, W), H and W >= tile_size.
+    """
+    image = open_image(image_path).convert('RGB')
+    if min(image.size) < tile_size:
+        scale = tile_size / min(image.size)
+        image = image.resize((max(tile_size, round(image.width * scale)),
+                              max(tile_size, round(image.height * scale))))
+    return transforms.functional.to_tensor(image)
+
+
+def get_tile_positions(height: int,
+                       width: int,
+                       tile_size: int,
+                       stride: int
+                       ) -> list[tuple[int, int]]:
+    """
+    Get the top-left corners of the tiles which cover an image. The tiles are spaced by
+    stride, and the last row and column are aligned on the borders of the image.
+
+    Args:
+        height (int): The height of the image (>= tile_size).
+        width (int): The width of the image (>= tile_size).
+        tile_size (int): The size of the tiles.
+        stride (int): The distance between two neighbouring tiles.
+
+    Returns:
+        list[tuple[int, int]]: The (top, left) position of each tile, row by row.
+    """
+    def get_starts(length: int) -> list[int]:
+        starts = list(range(0, length - tile_size + 1, stride))
+        if starts[-1] != length - tile_size:
+            starts.append(length - tile_size)
+        return starts
+
+    return [(top, left) for top in get_starts(height) for left in get_starts(width)]
+
+
+def create_tile_dataloader(config: EasyDict,
+                           data: list[str],
+                           stride: int
+                           ) -> DataLoader:
+    """
+    Create a dataloader of the tiles of the images (see TileDataGenerator). The tiles
+    have the size of the images seen by the model during the training
+    (config.data.image_size).
+
+    Args:
+        config (EasyDict): The configuration object.
+        data (list[str]): The list of image paths.
+        stride (int): The distance between two neighbouring tiles, in pixels.
+
+    Returns:
+        DataLoader: The dataloader of the tiles, yielding (tiles, infos).
+    """
+    generator = TileDataGenerator(data=data,
+                                  tile_size=config.data.image_size,
+                                  stride=stride)
+    dataloader = DataLoader(
+        dataset=generator,
+        batch_size=config.test.batch_size,
+        num_workers=min(config.test.num_workers, len(data)),
+    )
+
+    return dataloader
+
+
 if __name__ == "__main__":
     datapath = r"data\data_labo\test_512"
     infer_generator = InferDataGenerator(data=None, datapath=datapath, image_size=512)
@@ -1,4 +1,5 @@
 import torch
+import numpy as np
 
 LABELS = [
     "1- Modèle Traces passives",
@@ -21,6 +22,8 @@ LABELS = [
     "18- Modèle Sang expiré",
 ]
 BACKGROUND = ["carrelage", "papier", "bois", "lino"]
+# to get the labels of an array of indices at once
+LABELS_ARRAY = np.array(LABELS, dtype=object)
 
 
 def get_label_prediction(y_pred: torch.Tensor) -> list[tuple[int, str]]:
@@ -40,11 +43,34 @@ def get_label_prediction(y_pred: torch.Tensor) -> list[tuple[int, str]]:
         raise ValueError(f'Expected y_pred with shape of {len(LABELS)}'
                          f'but found {y_pred.shape}')
     
-    pred = torch.argmax(y_pred, dim=-1)
-    output: list[tuple[int, str]] = []
-    for i in range(len(pred)):
-        output.append((pred[i].item(), LABELS[pred[i].item()]))
-    return output
+    pred = torch.argmax(y_pred, dim=-1).cpu().numpy()
+    return list(zip(pred.tolist(), LABELS_ARRAY[pred].tolist()))
+
+
+def get_topk_arrays(y_pred: torch.Tensor,
+                    k: int = 3
+                    ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Get the top-k predictions as arrays, with one transfer to the host for the whole
+    batch.
+
+    Args:
+        y_pred (torch.Tensor): The predictions with shape (B, num_classes).
+        k (int, optional): The number of top predictions to retrieve. Defaults to 3.
+
+    Raises:
+        ValueError: If k is not between 1 and the number of classes.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The indices (int64) and the values (float32) of
+            the top-k predictions, both with shape (B, k). Use LABELS_ARRAY[indices] to
+            get the labels.
+    """
+    if not 1 <= k <= y_pred.shape[-1]:
+        raise ValueError(f'Expected k between 1 and {y_pred.shape[-1]} but found {k}')
+
+    topk_values, topk_indices = torch.topk(y_pred.detach(), k=k, dim=-1)
+    return topk_indices.cpu().numpy(), topk_values.float().cpu().numpy()
 
 
 def get_topk_prediction(y_pred: torch.Tensor,
@@ -62,16 +88,28 @@ def get_topk_prediction(y_pred: torch.Tensor,
         representing the top-k predictions for each input in y_pred. Each tuple contains the index,
         label, and value of the prediction.
     """
-    topk_values, topk_indices = torch.topk(y_pred, k=3)
-
-    output: list[list[tuple[int, str, float]]] = []
-    for i in range(len(y_pred)):
-        pred_i: list[tuple[int, str, float]] = []
-        for j in range(k):
-            pred_i.append((topk_indices[i, j].item(), LABELS[topk_indices[i, j].item()], topk_values[i, j].item()))
-        output.append(pred_i)
-    
-    return output
+    topk_indices, topk_values = get_topk_arrays(y_pred, k=k)
+    return get_topk_records(topk_indices, topk_values)
+
+
+def get_topk_records(topk_indices: np.ndarray,
+                     topk_values: np.ndarray
+                     ) -> list[list[tuple[int, str, float]]]:
+    """
+    Build the (index, label, value) records of the arrays given by get_topk_arrays.
+
+    Args:
+        topk_indices (np.ndarray): The indices of the top-k predictions with shape
+            (B, k).
+        topk_values (np.ndarray): The values of the top-k predictions with shape (B, k).
+
+    Returns:
+        list[list[tuple[int, str, float]]]: The top-k predictions, like
+            get_topk_prediction.
+    """
+    labels = LABELS_ARRAY[topk_indices].tolist()
+    return [list(zip(*row))
+            for row in zip(topk_indices.tolist(), labels, topk_values.tolist())]
 
 
 if __name__ == '__main__':
@@ -80,3 +118,4 @@ if __name__ == '__main__':
 
     print(get_label_prediction(y_pred))
     print(get_topk_prediction(y_pred))
+    print(get_topk_prediction(y_pred, k=1))
@@ -0,0 +1,156 @@
+import numpy as np
+from typing import Iterator
+from easydict import EasyDict
+
+from torch import Tensor
+from torch.utils.data import Sampler
+
+
+class LossBasedSampler(Sampler[int]):
+    """
+    Sampler witch tracks the loss of each training sample across the epochs and
+    only keeps the hard and uncertain samples plus a random fraction of the easy ones.
+    """
+    def __init__(self,
+                 num_samples: int,
+                 easy_loss: float = 0.05,
+                 easy_fraction: float = 0.2,
+                 warmup_epochs: int = 2,
+                 refresh_every: int = 5,
+                 shuffle: bool = True,
+                 seed: int = 0
+                 ) -> None:
+        """
+        Initialize the LossBasedSampler.
+
+        Args:
+            num_samples (int): The number of samples in the dataset.
+            easy_loss (float, optional): Samples with a loss below this threshold are
+                easy. Defaults to 0.05.
+            easy_fraction (float, optional): Fraction of the easy samples kept at each
+                epoch. Defaults to 0.2.
+            warmup_epochs (int, optional): Number of first epochs running on the full
+                dataset. Defaults to 2.
+            refresh_every (int, optional): Run on the full dataset every refresh_every
+                epochs (0 to never refresh). Defaults to 5.
+            shuffle (bool, optional): Whether to shuffle the selected samples.
+                Defaults to True.
+            seed (int, optional): The seed of the random generator. Defaults to 0.
+
+        Raises:
+            ValueError: If easy_fraction is not between 0 and 1.
+        """
+        if not (0 <= easy_fraction <= 1):
+            raise ValueError('Expected easy_fraction between 0 and 1 '
+                             f'but found {easy_fraction}')
+
+        self.num_samples = num_samples
+        self.easy_loss = easy_loss
+        self.easy_fraction = easy_fraction
+        self.warmup_epochs = warmup_epochs
+        self.refresh_every = refresh_every
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+
+        # samples never seen have an infinite loss, so they are always hard
+        self.losses = np.full(num_samples, np.inf, dtype=np.float32)
+        self.epoch: int = 1
+        self.indexes: np.ndarray = np.arange(num_samples)
+
+    def set_epoch(self, epoch: int) -> None:
+        """
+        Select the samples used during the given epoch.
+        Must be call before iterating on the dataloader.
+
+        Args:
+            epoch (int): The current epoch (starting at 1).
+        """
+        self.epoch = epoch
+        if self.is_full_epoch():
+            self.indexes = np.arange(self.num_samples)
+            return None
+
+        is_easy = self.losses < self.easy_loss
+        easy_indexes = np.flatnonzero(is_easy)
+        num_kept = int(round(len(easy_indexes) * self.easy_fraction))
+        kept_easy = self.rng.choice(easy_indexes, size=num_kept, replace=False)
+        self.indexes = np.sort(np.concatenate((np.flatnonzero(~is_easy), kept_easy)))
+        return None
+
+    def is_full_epoch(self) -> bool:
+        """
+        Returns True if the current epoch must run on the full dataset.
+        """
+        if self.epoch <= self.warmup_epochs:
+            return True
+        return self.refresh_every > 0 and self.epoch % self.refresh_every == 0
+
+    def update(self, indexes: Tensor, losses: Tensor) -> None:
+        """
+        Update the tracked losses of the given samples.
+
+        Args:
+            indexes (Tensor): The index of the samples in the dataset with shape (B).
+            losses (Tensor): The loss of each sample (without reduction) with shape (B).
+        """
+        self.losses[indexes.cpu().numpy()] = losses.detach().cpu().numpy()
+
+    def get_ratio(self) -> float:
+        """
+        Get the fraction of the dataset used during the current epoch.
+        """
+        return len(self.indexes) / self.num_samples
+
+    def __iter__(self) -> Iterator[int]:
+        """
+        Iterate over the selected samples.
+        """
+        indexes = self.indexes
+        if self.shuffle:
+            indexes = self.rng.permutation(indexes)
+        return iter(indexes.tolist())
+
+    def __len__(self) -> int:
+        """
+        Returns the number of samples selected for the current epoch.
+        """
+        return len(self.indexes)
+
+
+def get_loss_based_sampler(config: EasyDict,
+                           num_samples: int
+                           ) -> LossBasedSampler | None:
+    """
+    Create a LossBasedSampler according to the configuration.
+
+    Args:
+        config (EasyDict): The configuration object.
+        num_samples (int): The number of samples in the training dataset.
+
+    Returns:
+        LossBasedSampler | None: The sampler, or None if the data pruning is disabled.
+    """
+    if 'data_pruning' not in config.learning.keys():
+        return None
+
+    pruning: EasyDict = config.learning.data_pruning
+    if not pruning.do_pruning:
+        return None
+
+    return LossBasedSampler(num_samples=num_samples,
+                            easy_loss=pruning.easy_loss,
+                            easy_fraction=pruning.easy_fraction,
+                            warmup_epochs=pruning.warmup_epochs,
+                            refresh_every=pruning.refresh_every,
+                            shuffle=config.learning.shuffle)
+
+
+if __name__ == '__main__':
+    import torch
+
+    sampler = LossBasedSampler(num_samples=100, warmup_epochs=1)
+    for epoch in range(1, 7):
+        sampler.set_epoch(epoch)
+        for index in torch.tensor(list(sampler)).split(10):
+            sampler.update(index, torch.rand(len(index)) * 0.1)
+        print(f'epoch {epoch}: {sampler.get_ratio() = :.2f}')
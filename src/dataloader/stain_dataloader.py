@@ -0,0 +1,210 @@
+import os
+import sys
+import cv2
+import numpy as np
+from PIL import Image
+from typing import Iterator
+from easydict import EasyDict
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+from torchvision import transforms
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+
+sys.path.append(up(up(up(os.path.abspath(__file__)))))
+
+from src.explainable.create_mask import mask_red_pixel
+from src.dataloader.infer_dataloader import open_image
+
+
+class StainCropDataGenerator(IterableDataset):
+    def __init__(self,
+                 data: list[str],
+                 image_size: int,
+                 mask_size: int = 256,
+                 min_area: int = 16,
+                 max_regions: int = 16,
+                 dilation: int = 2,
+                 margin: float = 0.1
+                 ) -> None:
+        """
+        Stream of the crops of the stains of the images: the red mask (mask_red_pixel)
+        is computed on a low resolution copy of each image, its connected regions are
+        cropped from the full resolution image, and only these crops are given to the
+        model, so the cost of an image depends on its stains and not on its number of
+        pixels. An image without stain gives one crop: the whole image (with a number of
+        stains of 0 in its info). The crops of all the images follow each other, so a
+        batch is filled with the crops of the next image (see TileDataGenerator).
+
+        Args:
+            data (list[str]): A list of image paths.
+            image_size (int): The size of the crops given to the model.
+            mask_size (int, optional): The size of the longest side of the mask.
+                Defaults to 256.
+            min_area (int, optional): The minimum number of red pixels of a region in
+                the mask. Defaults to 16.
+            max_regions (int, optional): The maximum number of regions of an image
+                (the largest ones). Defaults to 16.
+            dilation (int, optional): The dilation of the mask, in pixels of the mask,
+                which merges the drops of a pattern into one region. Defaults to 2.
+            margin (float, optional): The margin added around a region, relatively to
+                its size. Defaults to 0.1.
+        """
+        self.data = data
+        self.image_size = image_size
+        self.mask_size = mask_size
+        self.min_area = min_area
+        self.max_regions = max_regions
+        self.dilation = dilation
+        self.margin = margin
+        print('number of images:', len(self.data))
+
+    def __iter__(self) -> Iterator[tuple[Tensor, Tensor]]:
+        """
+        Yields the crops of the stains of the images.
+
+        Yields:
+            (crop, info): tuple[Tensor, Tensor], the crop with shape
+                (3, image_size, image_size) and its info: the index of its image, its
+                box (top, left, bottom, right), the number of crops of its image, the
+                height and width of its image and its number of stains.
+        """
+        worker_info = get_worker_info()
+        indexes = range(len(self.data))
+        if worker_info is not None:
+            indexes = indexes[worker_info.id::worker_info.num_workers]
+
+        for index in indexes:
+            # the low resolution copy is decoded at a reduced scale for the JPEG images
+            thumbnail = open_image(self.data[index])
+            thumbnail.thumbnail((self.mask_size, self.mask_size))
+            image = open_image(self.data[index]).convert('RGB')
+            width, height = image.size
+
+            boxes = get_stain_regions(thumbnail=np.array(thumbnail.convert('RGB')),
+                                      size=(height, width),
+                                      min_crop_size=self.image_size,
+                                      min_area=self.min_area,
+                                      max_regions=self.max_regions,
+                                      dilation=self.dilation,
+                                      margin=self.margin)
+            num_stains = len(boxes)
+            if boxes == []:
+                boxes = [(0, 0, height, width)]
+
+            for top, left, bottom, right in boxes:
+                crop = image.crop((left, top, right, bottom))
+                crop = crop.resize((self.image_size, self.image_size))
+                yield transforms.functional.to_tensor(crop), \
+                    torch.tensor([index, top, left, bottom, right,
+                                  len(boxes), height, width, num_stains])
+
+
+def get_stain_regions(thumbnail: np.ndarray,
+                      size: tuple[int, int],
+                      min_crop_size: int,
+                      min_area: int = 16,
+                      max_regions: int = 16,
+                      dilation: int = 2,
+                      margin: float = 0.1
+                      ) -> list[tuple[int, int, int, int]]:
+    """
+    Find the stains of an image on its low resolution copy, and get their square boxes
+    in the full resolution image.
+
+    Args:
+        thumbnail (np.ndarray): The low resolution RGB image with shape (h, w, 3).
+        size (tuple[int, int]): The (height, width) of the full resolution image.
+        min_crop_size (int): The minimum size of a box in the full resolution image (if
+            the image is large enough).
+        min_area (int, optional): The minimum number of red pixels of a region.
+            Defaults to 16.
+        max_regions (int, optional): The maximum number of regions (the largest ones).
+            Defaults to 16.
+        dilation (int, optional): The dilation of the mask, in pixels. Defaults to 2.
+        margin (float, optional): The margin added around a region, relatively to its
+            size. Defaults to 0.1.
+
+    Returns:
+        list[tuple[int, int, int, int]]: The (top, left, bottom, right) box of each
+            region in the full resolution image, from the largest region.
+    """
+    # int16 to avoid the overflow of g + b in mask_red_pixel
+    mask = mask_red_pixel(thumbnail.astype(np.int16))[..., 0]
+    regions_mask = mask.astype(np.uint8)
+    if dilation > 0:
+        kernel = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+        regions_mask = cv2.dilate(regions_mask, kernel, iterations=dilation)
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(regions_mask,
+                                                                    connectivity=8)
+
+    # the area of a region is its number of red pixels (before the dilation)
+    areas = np.bincount(labels[mask], minlength=num_labels)
+    regions = []
+    for i in range(1, num_labels):
+        if areas[i] >= min_area:
+            top, left = stats[i, cv2.CC_STAT_TOP], stats[i, cv2.CC_STAT_LEFT]
+            bbox = (top, left,
+                    top + stats[i, cv2.CC_STAT_HEIGHT],
+                    left + stats[i, cv2.CC_STAT_WIDTH])
+            regions.append((areas[i], bbox))
+    regions = sorted(regions, key=lambda region: region[0], reverse=True)[:max_regions]
+
+    height, width = size
+    scale_y, scale_x = height / thumbnail.shape[0], width / thumbnail.shape[1]
+    boxes = []
+    for _, (min_row, min_col, max_row, max_col) in regions:
+        center_y = (min_row + max_row) / 2 * scale_y
+        center_x = (min_col + max_col) / 2 * scale_x
+        side = max((max_row - min_row) * scale_y, (max_col - min_col) * scale_x) \
+            * (1 + 2 * margin)
+        side = round(min(max(side, min_crop_size), height, width))
+        top = int(np.clip(round(center_y - side / 2), 0, height - side))
+        left = int(np.clip(round(center_x - side / 2), 0, width - side))
+        boxes.append((top, left, top + side, left + side))
+    return boxes
+
+
+def create_stain_dataloader(config: EasyDict,
+                            data: list[str],
+                            mask_size: int = 256,
+                            min_area: int = 16
+                            ) -> DataLoader:
+    """
+    Create a dataloader of the crops of the stains of the images (see
+    StainCropDataGenerator).
+
+    Args:
+        config (EasyDict): The configuration object.
+        data (list[str]): The list of image paths.
+        mask_size (int, optional): The size of the longest side of the mask.
+            Defaults to 256.
+        min_area (int, optional): The minimum number of red pixels of a region in the
+            mask. Defaults to 16.
+
+    Returns:
+        DataLoader: The dataloader of the crops, yielding (crops, infos).
+    """
+    generator = StainCropDataGenerator(data=data,
+                                       image_size=config.data.image_size,
+                                       mask_size=mask_size,
+                                       min_area=min_area)
+    dataloader = DataLoader(
+        dataset=generator,
+        batch_size=config.test.batch_size,
+        num_workers=min(config.test.num_workers, len(data)),
+    )
+
+    return dataloader
+
+
+if __name__ == "__main__":
+    datapath = os.path.join('data', 'images_to_predict')
+    image_path = os.path.join(datapath, os.listdir(datapath)[0])
+    image = Image.open(image_path).convert('RGB')
+    thumbnail = image.copy()
+    thumbnail.thumbnail((256, 256))
+    print(get_stain_regions(np.array(thumbnail),
+                            size=image.size[::-1],
+                            min_crop_size=256))
@@ -2,55 +2,110 @@ import os
 import sys
 import cv2
 import numpy as np
+from typing import Any
 from os.path import dirname as up
 
 import torch
-from torch import Tensor
-from pytorch_grad_cam import GradCAM
-from pytorch_grad_cam.utils.image import show_cam_on_image
+from torch import Tensor, nn
+from torch.nn import functional as F
 
 sys.path.append(up(up(os.path.abspath(__file__))))
 
 from src.model.finetune_resnet import FineTuneResNet
-from src.model.resnet import get_original_resnet
 from utils import utils
 
 
-class GradCam:
-    def __init__(self, model: FineTuneResNet) -> None:
+SALIENCY_METHODS = ['gradcam', 'fastcam']
+
+# color of each saliency value between 0 and 255 (BGR, as show_cam_on_image)
+COLORMAP: np.ndarray = cv2.applyColorMap(np.arange(256, dtype=np.uint8),
+                                         cv2.COLORMAP_JET).reshape(256, 3)
+
+# augmentations: (horizontal flip, vertical flip, intensity factor)
+SMOOTH_PRESETS: dict[str, dict[str, Any]] = {
+    'off': {'augmentations': [(False, False, 1)],
+            'eigen_smooth': False},
+    'fast': {'augmentations': [(False, False, 1), (True, False, 1), (False, True, 1)],
+             'eigen_smooth': False},
+    'full': {'augmentations': [(hflip, False, factor)
+                               for hflip in [False, True] for factor in [0.9, 1, 1.1]],
+             'eigen_smooth': True},
+}
+
+
+class Saliency:
+    """ Base class of the saliency maps, with the methods to plot, save and evaluate """
+
+    def forward(self, image: Tensor) -> np.ndarray:
         """
-        Initialize the GradCAM object.
+        Computes the saliency maps of the input image and returns the visualizations.
 
         Args:
-            model (FineTuneResNet): The fine-tuned ResNet model.
+            image (Tensor): The input image tensor.
+
+        Returns:
+            np.ndarray: The visualizations of the input image with the saliency maps.
         """
-        true_resnet = get_original_resnet(model)
-        target_layer = true_resnet.layer4[1].conv2
-        self.cam = GradCAM(model=true_resnet, target_layers=[target_layer])
+        grayscale_cam = self.get_cam(image=image)
+        return self.get_visualizations(image=image, grayscale_cam=grayscale_cam)
 
-    def forward(self, image: Tensor) -> np.ndarray:
+    def get_cam(self, image: Tensor, targets: Tensor = None) -> np.ndarray:
         """
-        Applies Grad-CAM to the input image and returns the visualizations.
+        Computes the saliency maps of the input image at the resolution of the image.
 
         Args:
-            image (Tensor): The input image tensor.
+            image (Tensor): The input image tensor with shape (B, C, H, W).
+            targets (Tensor, optional): The class to explain for each image with shape
+                (B), or the k classes to explain for each image with shape (B, k).
+                Defaults to None (the predicted class).
 
         Returns:
-            np.ndarray: The visualizations of the input image after applying Grad-CAM.
-        """
-        batch_size, img_c, img_h, img_w = image.shape
-        grayscale_cam = self.cam(input_tensor=image,
-                                 targets=None,
-                                 aug_smooth=True,
-                                 eigen_smooth=True)
-        
-        visualizations = np.zeros((batch_size, img_h, img_w, img_c))
-        for b in range(batch_size):
-            rgb_img = utils.convert_tensor_to_rgb(image=image[b].cpu(), normelize=True)
-            visualizations[b] = show_cam_on_image(rgb_img, grayscale_cam[b])
-
-        return visualizations
-    
+            np.ndarray: The saliency maps with shape (B, H, W), or (B, k, H, W) if
+                targets has shape (B, k), and values in [0, 1].
+        """
+        cam = self.get_low_resolution_cam(image=image, targets=targets)
+        return upsample_cam(cam, size=image.shape[-2:]).cpu().numpy()
+
+    def get_low_resolution_cam(self, image: Tensor, targets: Tensor = None) -> Tensor:
+        """
+        Computes the saliency maps of the input image at the resolution of the layer4.
+
+        Args:
+            image (Tensor): The input image tensor with shape (B, C, H, W).
+            targets (Tensor, optional): The class to explain for each image with shape
+                (B), or the k classes to explain for each image with shape (B, k).
+                Defaults to None (the predicted class).
+
+        Returns:
+            Tensor: The saliency maps with shape (B, h, w), or (B, k, h, w) if targets
+                has shape (B, k), and values in [0, 1].
+        """
+        raise NotImplementedError
+
+    def get_visualizations(self,
+                           image: Tensor,
+                           grayscale_cam: np.ndarray
+                           ) -> np.ndarray:
+        """
+        Puts the saliency maps on the images.
+
+        Args:
+            image (Tensor): The input image tensor with shape (B, C, H, W).
+            grayscale_cam (np.ndarray): The saliency maps with shape (B, H, W) and
+                values in [0, 1].
+
+        Returns:
+            np.ndarray: The visualizations with shape (B, H, W, C) and dtype uint8.
+        """
+        # same result as pytorch_grad_cam show_cam_on_image on each image, but in uint8
+        # and for the whole batch at once
+        image = image.detach().float()
+        image_min = image.flatten(1).min(dim=1)[0].view(-1, 1, 1, 1)
+        image_max = image.flatten(1).max(dim=1)[0].view(-1, 1, 1, 1)
+        image = (image - image_min) / (image_max - image_min)
+        rgb_img = (image * 255).to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+        return overlay_cam(rgb_img=rgb_img, grayscale_cam=grayscale_cam)
+
     def save_saliency_maps(self,
                            visualizations: np.ndarray,
                            dstpath: str,
@@ -67,21 +122,22 @@ class GradCam:
         if not os.path.exists(dstpath):
             os.mkdir(dstpath)
             print(f"Directory {dstpath} created ")
-        
+
         for i, visualization in enumerate(visualizations):
             cv2.imwrite(os.path.join(dstpath, filenames[i]), visualization)
-    
+
     def get_probability_with_mask(self,
                                   model: FineTuneResNet,
                                   image: Tensor,
                                   ) -> Tensor:
         """
-        Calculates the probability of each class in the given image using a the saliency mask.
+        Calculates the probability of each class in the given image using a the saliency
+        mask.
 
         Args:
             model (FineTuneResNet): The model used for prediction.
             image (Tensor): The input image.
-        
+
         Returns:
             Tensor: The predicted probabilities for each class.
         """
@@ -95,9 +151,373 @@ class GradCam:
         return y_pred
 
 
+class GradCam(Saliency):
+    def __init__(self, model: FineTuneResNet, smooth: str = 'full') -> None:
+        """
+        Initialize the GradCAM object. It works directly on the modules of
+        model.resnet_begin (no copy of the resnet) and explains the classes of the
+        fine-tuned model. The smoothing augmentations of an image are stacked into one
+        batch, so a smoothed saliency map costs one forward and one backward.
+
+        Args:
+            model (FineTuneResNet): The fine-tuned ResNet model.
+            smooth (str, optional): The smoothing preset, in SMOOTH_PRESETS. Defaults to
+                'full'.
+                - off: no smoothing.
+                - fast: average over the image and its horizontal and vertical flips.
+                - full: average over the horizontal flips and 3 intensity factors (6
+                  copies) with the eigen smoothing, like pytorch_grad_cam aug_smooth and
+                  eigen_smooth.
+
+        Raises:
+            ValueError: If smooth is not in SMOOTH_PRESETS.
+        """
+        if smooth not in SMOOTH_PRESETS:
+            raise ValueError(f'Expected smooth in {list(SMOOTH_PRESETS)} '
+                             f'but found {smooth}')
+
+        self.model = model
+        self.augmentations: list[tuple[bool, bool, float]] = \
+            SMOOTH_PRESETS[smooth]['augmentations']
+        self.eigen_smooth: bool = SMOOTH_PRESETS[smooth]['eigen_smooth']
+
+        self.activations: Tensor = None
+        target_layer: nn.Module = model.resnet_begin[7][1].conv2
+        self.hook = target_layer.register_forward_hook(self.__save_activations)
+        self.is_recording = False
+
+    def get_low_resolution_cam(self, image: Tensor, targets: Tensor = None) -> Tensor:
+        """
+        Computes the smoothed Grad-CAM of the input image at the resolution of the
+        layer4.
+
+        Args:
+            image (Tensor): The input image tensor with shape (B, C, H, W).
+            targets (Tensor, optional): The class to explain for each image with shape
+                (B), or the k classes to explain for each image with shape (B, k).
+                Defaults to None (the predicted class).
+
+        Returns:
+            Tensor: The saliency maps with shape (B, h, w), or (B, k, h, w) if targets
+                has shape (B, k), and values in [0, 1].
+        """
+        batch_size = image.shape[0]
+        num_augmentations = len(self.augmentations)
+        augmented = torch.cat([augment(image, *augmentation)
+                               for augmentation in self.augmentations], dim=0)
+
+        self.is_recording = True
+        with torch.enable_grad():
+            logits = self.model.forward(augmented)
+            if targets is None:
+                # explain the class predicted on the original image for all the copies
+                targets = logits[:batch_size].argmax(dim=-1)
+            is_multi_class = targets.dim() == 2
+            targets = targets.view(batch_size, -1).to(logits.device)
+            targets = targets.repeat(num_augmentations, 1)
+            gradients = get_class_gradients(logits=logits,
+                                            targets=targets,
+                                            inputs=self.activations)
+        self.is_recording = False
+
+        # gradients shape: (A * B, k, C, h, w)
+        activations = self.activations.detach().unsqueeze(1)
+        weighted_activations = gradients.mean(dim=(3, 4), keepdim=True) * activations
+        weighted_activations = weighted_activations.flatten(0, 1)
+        if self.eigen_smooth:
+            cam = get_2d_projection(weighted_activations)
+        else:
+            cam = weighted_activations.sum(dim=1)
+        cam = scale_cam(F.relu(cam))
+
+        cams = cam.view(num_augmentations, batch_size, -1, *cam.shape[-2:])
+        cams = torch.stack([augment(cams[i], *augmentation[:2])
+                            for i, augmentation in enumerate(self.augmentations)])
+        cams = cams.mean(dim=0)
+        return cams if is_multi_class else cams.squeeze(1)
+
+    def remove_hooks(self) -> None:
+        """
+        Removes the hook from the model.
+        """
+        self.hook.remove()
+
+    def __save_activations(self,
+                           module: nn.Module,
+                           inputs: Any,
+                           output: Tensor
+                           ) -> Tensor:
+        """
+        Forward hook of the target layer: keep the activations. The resnet can be
+        frozen, so the activations are made differentiable here and the backward stops
+        at this layer.
+        """
+        if not self.is_recording:
+            return None
+        if not output.requires_grad:
+            output = output.detach().requires_grad_(True)
+        self.activations = output
+        return output
+
+
+class FastCam(Saliency):
+    def __init__(self, model: FineTuneResNet) -> None:
+        """
+        Initialize the FastCam object: a Grad-CAM on the output of the layer4 of the
+        resnet, computed from the classification forward of the model.
+        Hooks catch the layer4 feature map during model.forward, so the saliency map
+        only needs a backward through the small head (fc1 -> ReLU -> fc2).
+
+        Args:
+            model (FineTuneResNet): The fine-tuned ResNet model.
+        """
+        self.model = model
+        self.image: Tensor = None
+        self.features: Tensor = None
+
+        layer4: nn.Module = model.resnet_begin[7]
+        self.hooks = [model.resnet_begin.register_forward_pre_hook(self.__save_image),
+                      layer4.register_forward_hook(self.__save_features)]
+
+    def get_low_resolution_cam(self,
+                               image: Tensor,
+                               targets: Tensor = None,
+                               features: Tensor = None
+                               ) -> Tensor:
+        """
+        Computes the saliency maps at the resolution of the layer4 feature map.
+        If model.forward was just called on image, its layer4 feature map is reused.
+        The average pooling is linear, so the Grad-CAM weights of each channel are the
+        gradients of the class score with respect to the pooled features.
+
+        Args:
+            image (Tensor): The input image tensor with shape (B, C, H, W).
+            targets (Tensor, optional): The class to explain for each image with shape
+                (B), or the k classes to explain for each image with shape (B, k).
+                Defaults to None (the predicted class).
+            features (Tensor, optional): The layer4 feature maps of image with shape
+                (B, 512, h, w), see get_last_features. Defaults to None.
+
+        Returns:
+            Tensor: The saliency maps with shape (B, h, w), or (B, k, h, w) if targets
+                has shape (B, k), and values in [0, 1].
+        """
+        if features is None:
+            if self.image is not image:
+                with torch.no_grad():
+                    self.model.forward(image)
+            features = self.features
+
+        with torch.enable_grad():
+            pooled = features.mean(dim=(2, 3)).requires_grad_(True)
+            embedding = self.model.relu(self.model.fc1(pooled))
+            logits = self.model.fc2(self.model.dropout(embedding))
+            if targets is None:
+                targets = logits.argmax(dim=-1)
+            is_multi_class = targets.dim() == 2
+            targets = targets.view(len(features), -1).to(logits.device)
+            weights = get_class_gradients(logits=logits, targets=targets, inputs=pooled)
+
+        # weights shape: (B, k, C)
+        cam = F.relu(torch.einsum('bkc,bchw->bkhw', weights, features))
+        cam = scale_cam(cam.flatten(0, 1)).view(cam.shape)
+        return cam if is_multi_class else cam.squeeze(1)
+
+    def get_last_features(self,
+                          mask: Tensor,
+                          image_size: tuple[int, int]
+                          ) -> Tensor | None:
+        """
+        Get the layer4 feature maps of the last model.forward, for the images selected
+        by mask. The images are selected by their position in the batch of the forward,
+        so a caller which indexed the batch (a cascade, a gate) can still reuse the
+        forward.
+
+        Args:
+            mask (Tensor): The images to select with shape (B), B the size of the batch
+                of the last forward.
+            image_size (tuple[int, int]): The size (H, W) of the images.
+
+        Returns:
+            Tensor | None: The feature maps with shape (N, 512, h, w), or None if the
+                last forward was on another batch size or another image size.
+        """
+        if self.image is None or len(self.image) != len(mask) \
+                or tuple(self.image.shape[-2:]) != tuple(image_size):
+            return None
+        return self.features[mask.to(self.features.device)]
+
+    def remove_hooks(self) -> None:
+        """
+        Removes the hooks from the model.
+        """
+        for hook in self.hooks:
+            hook.remove()
+
+    def __save_image(self, module: nn.Module, inputs: tuple[Tensor]) -> None:
+        """ Forward pre-hook of the resnet: keep a reference of the input image """
+        self.image = inputs[0]
+
+    def __save_features(self, module: nn.Module, inputs: Any, output: Tensor) -> None:
+        """ Forward hook of the layer4: keep the feature map """
+        self.features = output.detach()
+
+
+def augment(image: Tensor, hflip: bool, vflip: bool, factor: float = 1) -> Tensor:
+    """
+    Flip and multiply a batch of images. Flipping twice gives back the original image,
+    so this function also de-augments the saliency maps.
+
+    Args:
+        image (Tensor): The images with shape (..., H, W).
+        hflip (bool): Whether to flip horizontally.
+        vflip (bool): Whether to flip vertically.
+        factor (float, optional): The intensity factor. Defaults to 1.
+
+    Returns:
+        Tensor: The augmented images.
+    """
+    dims = [-1] if hflip else []
+    dims += [-2] if vflip else []
+    if dims != []:
+        image = torch.flip(image, dims=dims)
+    if factor != 1:
+        image = image * factor
+    return image
+
+
+def get_class_gradients(logits: Tensor, targets: Tensor, inputs: Tensor) -> Tensor:
+    """
+    Computes the gradients of the score of k classes with respect to the inputs,
+    with one batched backward for the k classes.
+
+    Args:
+        logits (Tensor): The output of the model with shape (N, num_classes).
+        targets (Tensor): The k classes of each sample with shape (N, k).
+        inputs (Tensor): The tensor to differentiate, with shape (N, ...).
+
+    Returns:
+        Tensor: The gradients with shape (N, k, ...).
+    """
+    scores = logits.gather(dim=1, index=targets)
+    k = scores.shape[1]
+    if k == 1:
+        gradients, = torch.autograd.grad(scores.sum(), inputs)
+        return gradients.unsqueeze(1)
+
+    # one-hot grad_outputs: the j-th backward selects the j-th class of each sample
+    grad_outputs = torch.eye(k, device=scores.device, dtype=scores.dtype)
+    grad_outputs = grad_outputs.unsqueeze(1).expand(k, *scores.shape)
+    gradients, = torch.autograd.grad(scores, inputs,
+                                     grad_outputs=grad_outputs,
+                                     is_grads_batched=True)
+    return gradients.transpose(0, 1)
+
+
+def overlay_cam(rgb_img: np.ndarray, grayscale_cam: np.ndarray) -> np.ndarray:
+    """
+    Puts the saliency maps on the images with the JET colormap.
+
+    Args:
+        rgb_img (np.ndarray): The images with shape (B, H, W, 3) and dtype uint8.
+        grayscale_cam (np.ndarray): The saliency maps with shape (B, H, W) and values in
+            [0, 1].
+
+    Returns:
+        np.ndarray: The visualizations with shape (B, H, W, 3) and dtype uint8.
+    """
+    heatmap = COLORMAP[np.uint8(255 * np.clip(grayscale_cam, 0, 1))]
+    cam = (heatmap.astype(np.uint16) + rgb_img) // 2
+    cam_max = cam.reshape(len(cam), -1).max(axis=1).reshape(-1, 1, 1, 1)
+    return (cam * 255 // np.maximum(cam_max, 1)).astype(np.uint8)
+
+
+def upsample_cam(cam: Tensor, size: tuple[int, int]) -> Tensor:
+    """
+    Upsamples the saliency maps to the size of the image (bilinear interpolation).
+
+    Args:
+        cam (Tensor): The saliency maps with shape (B, h, w), or (B, k, h, w) for the k
+            classes explained of each image.
+        size (tuple[int, int]): The size (H, W) of the image.
+
+    Returns:
+        Tensor: The saliency maps with shape (B, H, W), or (B, k, H, W).
+    """
+    shape = cam.shape
+    cam = F.interpolate(cam.reshape(-1, 1, *shape[-2:]).float(), size=tuple(size),
+                        mode='bilinear', align_corners=False)
+    return cam.view(*shape[:-2], *size)
+
+
+def get_2d_projection(weighted_activations: Tensor) -> Tensor:
+    """
+    Projects the activations of each image on their first principal component (eigen
+    smoothing).
+
+    Args:
+        weighted_activations (Tensor): The activations with shape (B, C, h, w).
+
+    Returns:
+        Tensor: The projections with shape (B, h, w).
+    """
+    batch_size, channels, h, w = weighted_activations.shape
+    reshaped = weighted_activations.view(batch_size, channels, h * w).transpose(1, 2)
+    reshaped = reshaped - reshaped.mean(dim=1, keepdim=True)
+    _, _, vh = torch.linalg.svd(reshaped, full_matrices=False)
+    projection = torch.einsum('bnc,bc->bn', reshaped, vh[:, 0])
+
+    # the sign of a principal component is arbitrary: keep the one of the class map
+    sign = torch.sign((projection * reshaped.sum(dim=2)).sum(dim=1, keepdim=True))
+    sign[sign == 0] = 1
+    return (sign * projection).view(batch_size, h, w)
+
+
+def scale_cam(cam: Tensor) -> Tensor:
+    """
+    Scales each saliency map between 0 and 1.
+
+    Args:
+        cam (Tensor): The saliency maps with shape (B, h, w).
+
+    Returns:
+        Tensor: The scaled saliency maps.
+    """
+    cam_min = cam.flatten(1).min(dim=1)[0].view(-1, 1, 1)
+    cam_max = cam.flatten(1).max(dim=1)[0].view(-1, 1, 1)
+    return (cam - cam_min) / (cam_max - cam_min + 1e-7)
+
+
+def get_saliency(model: FineTuneResNet,
+                 method: str = 'gradcam',
+                 smooth: str = 'full'
+                 ) -> Saliency:
+    """
+    Get the saliency object of the given method.
+
+    Args:
+        model (FineTuneResNet): The fine-tuned ResNet model.
+        method (str, optional): The saliency method, in SALIENCY_METHODS. Defaults to
+            'gradcam'.
+        smooth (str, optional): The smoothing preset of gradcam, in SMOOTH_PRESETS.
+            Defaults to 'full'.
+
+    Raises:
+        ValueError: If the method is not in SALIENCY_METHODS.
+
+    Returns:
+        Saliency: The saliency object.
+    """
+    if method == 'gradcam':
+        return GradCam(model=model, smooth=smooth)
+    if method == 'fastcam':
+        return FastCam(model=model)
+    raise ValueError(f'Expected saliency method in {SALIENCY_METHODS} '
+                     f'but found {method}')
+
+
 if __name__ == '__main__':
     import yaml
-    import torch
     from easydict import EasyDict
     from src.model.finetune_resnet import get_finetuneresnet
 
@@ -107,7 +527,7 @@ if __name__ == '__main__':
         xi, _ = utils.get_random_img(image_type='torch')
         x[i] = xi
 
-    config_path = os.path.join('logs', 'retrain_resnet_allw_img256_2') 
+    config_path = os.path.join('logs', 'retrain_resnet_allw_img256_2')
     config = EasyDict(yaml.safe_load(open(os.path.join(config_path, 'config.yaml'))))
 
     model = get_finetuneresnet(config)
@@ -121,6 +541,11 @@ if __name__ == '__main__':
     gradcam.save_saliency_maps(visualizations,
                                'gradcam_images',
                                [f'gradcam_{i}.png' for i in range(batch_size)])
-    
+
     y_pred = gradcam.get_probability_with_mask(model=model, image=x)
     print("y_pred shape:", y_pred.shape)
+
+    fastcam = FastCam(model=model)
+    y_pred = model.forward(x)
+    visualizations = fastcam.forward(x)     # reuse the feature map of model.forward
+    print("fastcam visualizations shape:", visualizations.shape)
@@ -1,5 +1,6 @@
 import os
 import sys
+import numpy as np
 from tqdm import tqdm
 from typing import Callable
 from easydict import EasyDict
@@ -10,10 +11,19 @@ from torch import Tensor
 
 sys.path.append(up(up(os.path.abspath(__file__))))
 
-from src.dataloader.labels import get_topk_prediction
-from src.dataloader.infer_dataloader import create_infer_dataloader
+from config.utils import load_config, find_config
+from src.dataloader.labels import get_topk_arrays, get_topk_records
+from src.dataloader.infer_dataloader import create_infer_dataloader, \
+    get_image_from_path, get_output_name
 from src.model import finetune_resnet
-from src.gradcam import GradCam
+from src.gradcam import Saliency, FastCam, get_saliency, upsample_cam
+from src.saliency_store import SaliencyStoreWriter, SALIENCY_OUTPUTS
+from src.saliency_writer import SaliencyWriter
+from src.infer_cache import InferCache, get_run_key, get_file_hash, RESULT_COLUMNS
+from src.ood import MahalanobisOOD, load_ood, get_ood_name, OOD_NAME
+from src.similarity_index import SimilarityIndex, load_similarity_index, INDEX_NAME
+from src.columnar_writer import ColumnarWriter
+from src.result_writer import ResultWriter, get_infer_header, get_infer_line
 from utils import utils
 
 
@@ -25,79 +35,765 @@ def infer(infer_images_path: list[str],
           dstpath: str,
           filename: str,
           run_temperature_optimization: bool = True,
-          sep: str = ','
+          sep: str = ',',
+          saliency_method: str = 'gradcam',
+          saliency_smooth: str = 'full',
+          saliency_output: str = 'png',
+          saliency_topk: int = 1,
+          cache_path: str | None = None,
+          columnar_output: str | None = None,
+          cascade_threshold: float | None = None,
+          cascade_image_size: int = 128,
+          cascade_logging_path: str | None = None,
+          ood_gate: bool = False,
+          ood_threshold: float | None = None,
+          similar_k: int = 0,
+          model: finetune_resnet.FineTuneResNet | None = None
           ) -> None:
     """
     Perform inference using the provided dataloader and model.
+    The results are appended to dstpath/filename batch by batch. If the previous run
+    with the same model and options was interrupted, the images already written are
+    skipped (see src.result_writer). Each batch goes through the stages classify,
+    OODGate and get_saliency_maps, and its rows are written in the order of the images
+    by OrderedRows.
 
     Args:
-        infer_dataloader (DataLoader): The dataloader for inference (can be None if infer_datapath is specify).
-        infer_datapath (str): The path to the inference data (only in the case of infer_dataloader is None).
+        infer_dataloader (DataLoader): The dataloader for inference
+            (can be None if infer_datapath is specify).
+        infer_datapath (str): The path to the inference data
+            (only in the case of infer_dataloader is None).
         logging_path (str): The path to the logging directory.
-        config (EasyDict): The configuration object (most of times, in the logging_path).
+        config (EasyDict): The configuration object (most of times, in the
+            logging_path).
         dstpath (str): The destination path for saving the inference results.
         filename (str): The filename for saving the inference results.
-        run_temperature_optimization (bool, optional): Whether to run temperature optimization. Defaults to True.
-        sep (str, optional): The separator for saving the inference results. Defaults to ','.
+        run_temperature_optimization (bool, optional): Whether to run temperature
+            optimization. Defaults to True.
+        sep (str, optional): The separator for saving the inference results.
+            Defaults to ','.
+        saliency_method (str, optional): The saliency method, 'gradcam' or 'fastcam'
+            (reuses the feature map of the prediction forward). Defaults to 'gradcam'.
+        saliency_smooth (str, optional): The smoothing preset of gradcam: 'off', 'fast'
+            or 'full'. Defaults to 'full'.
+        saliency_output (str, optional): How to save the saliency maps: 'png' (one image
+            per input), 'raw' (all the low resolution maps in dstpath/saliency_maps.npz,
+            see src.saliency_store) or 'both'. Defaults to 'png'.
+        saliency_topk (int, optional): The number of predicted classes to explain (from
+            the most likely one). The k maps are computed with one forward and one
+            batched backward. Defaults to 1.
+        cache_path (str | None, optional): The path of the result cache (see
+            src.infer_cache). The images already inferred with the same checkpoint and
+            options are not decoded nor given to the model. Defaults to None (no cache).
+        columnar_output (str | None, optional): Also write the probabilities, the top-k
+            indices, the logits and the embedding of each image in dstpath, in a format
+            of COLUMNAR_OUTPUTS: 'parquet', 'arrow' or 'jsonl' (see
+            src.columnar_writer). Defaults to None.
+        cascade_threshold (float | None, optional): Run a cheap first stage on each
+            image and keep its result if its top-1 probability (with the temperature) is
+            at least this threshold; only the other images go through the model at full
+            resolution and get saliency maps (the raw maps of the images decided by the
+            first stage are zeros). The results get a 'Stage' column (1 or 2), and the
+            logits, the embedding and the features of the images decided by the first
+            stage come from the first stage. Defaults to None (no cascade).
+        cascade_image_size (int, optional): The image size of the first stage, when it
+            is the same model at a lower resolution. Defaults to 128.
+        cascade_logging_path (str | None, optional): The logging directory of the model
+            of the first stage (its own image size is used). Defaults to None (the same
+            model).
+        ood_gate (bool, optional): Score each image with the Mahalanobis distance of its
+            backbone features to the training set (logging_path/ood_stats.npz, see
+            src.ood). The images above the threshold are flagged and get no saliency
+            map. The results get an 'OOD score' and an 'OOD' (yes or no) columns. In
+            the cascade, the images decided by the first stage are scored on the
+            features of the first stage, with the statistics of its model and
+            resolution (see OODGate). Defaults to False.
+        ood_threshold (float | None, optional): The threshold of the OOD score (of the
+            second stage in the cascade: the first stage keeps the threshold fitted with
+            its statistics). Defaults to None (the threshold fitted with the
+            statistics).
+        similar_k (int, optional): Find the similar_k most similar labelled images of
+            each image in the similarity index of the model
+            (logging_path/similarity_index.npz, see src.similarity_index) and write them
+            in a 'Similar cases' column, as 'path (label, similarity)' separated by
+            ' | ' (not with a cascade, whose first stage gives other features).
+            Defaults to 0 (no search).
+        model (FineTuneResNet | None, optional): The model, already loaded with the
+            weights of logging_path (e.g. in shared memory, see src.sharded_infer).
+            Defaults to None (loaded from logging_path).
 
     Raises:
-        ValueError: If both infer_dataloader and infer_datapath are None.
+        FileNotFoundError: If ood_gate and the OOD statistics were not fitted (in the
+            cascade, also the statistics of the first stage).
+        FileNotFoundError: If similar_k > 0 and the similarity index was not built.
+        ValueError: If both infer_images_path and infer_datapath are None.
+        ValueError: If saliency_output is not in SALIENCY_OUTPUTS.
+        ValueError: If saliency_topk is not between 1 and 3.
+        ValueError: If cascade_threshold is not between 0 and 1.
+        ValueError: If the cascade model has another number of classes or hidden size.
+        ValueError: If similar_k > 0 and the similarity index was built with another
+            checkpoint.
+        ValueError: If similar_k > 0 with a cascade whose first stage is another model
+            or another image size (its features are not those of the index).
     """
     device = utils.get_device(device_config=config.learning.device)
     if device.type == 'cpu':
         config.test.batch_size = 32
 
-    infer_dataloader = create_infer_dataloader(config=config,
-                                               data=infer_images_path,
-                                               datapath=infer_datapath)
-
-    # Get model
-    model = finetune_resnet.get_finetuneresnet(config)
-    weight = utils.load_weights(logging_path, device=device, model_name='res')
-    model.load_dict_learnable_parameters(state_dict=weight, strict=True)
-    model = model.to(device)
-    del weight
+    if infer_images_path is None:
+        if infer_datapath is None:
+            raise ValueError("infer_images_path and infer_datapath cannot be both None")
+        infer_images_path = get_image_from_path(infer_datapath)
 
     get_image_name: Callable[[str], str] = \
         lambda img_name: utils.get_relatif_image_path(img_name, infer_datapath)
-    temperature: float = 1.5
-    output: list[list[tuple[int, str, float]]] = []
-    image_names: list[str] = []
+    temperature: float = 1.5 if run_temperature_optimization else 1
+    save_png = save_raw = False
 
     # GradCAM
     if plot_saliency:
-        gradcam = GradCam(model=model)
-        saliency_path = os.path.join(dstpath, 'saliency_maps')
-        saliency_fun_name: Callable[[str], str] = \
-            lambda img_name: get_image_name(img_name).split('.')[0].replace(os.sep, '_') + '_saliency.png'
-
-    model.eval()
-    # with torch.no_grad():
-    for x, image_path in tqdm(infer_dataloader, desc='Infering'):
-        image_name = list(map(get_image_name, image_path))
-        x: Tensor = x.to(device)
-        y_pred = model.forward(x)
+        if saliency_output not in SALIENCY_OUTPUTS:
+            raise ValueError(f'Expected saliency_output in {SALIENCY_OUTPUTS} '
+                             f'but found {saliency_output}')
+        if not 1 <= saliency_topk <= 3:
+            raise ValueError(f'Expected saliency_topk between 1 and 3 '
+                             f'but found {saliency_topk}')
+        save_png = saliency_output in ['png', 'both']
+        save_raw = saliency_output in ['raw', 'both']
+        if save_png:
+            saliency_path = os.path.join(dstpath, 'saliency_maps')
+            saliency_writer = SaliencyWriter(dstpath=saliency_path)
+        saliency_fun_name: Callable[[str, int], str] = \
+            lambda img_name, j: get_output_name(get_image_name(img_name)) \
+            + ('_saliency.png' if j == 0 else f'_saliency_top{j + 1}.png')
+
+    saliency_mode = f'{saliency_method}-{saliency_smooth}-top{saliency_topk}' \
+        if plot_saliency else 'none'
+    checkpoint_path = utils.get_weights_path(logging_path, model_name='res')
+
+    # Cascade: the first stage is another (smaller) model, or the same model at a lower
+    # resolution
+    is_cascade = cascade_threshold is not None
+    if is_cascade:
+        if not 0 <= cascade_threshold <= 1:
+            raise ValueError(f'Expected cascade_threshold between 0 and 1 '
+                             f'but found {cascade_threshold}')
+        first_logging_path = logging_path if cascade_logging_path is None \
+            else cascade_logging_path
+        first_config = config if cascade_logging_path is None else \
+            load_config(find_config(experiment_path=cascade_logging_path))
+        if cascade_logging_path is not None:
+            cascade_image_size = first_config.data.image_size
+            # the outputs of the two stages are written in the same buffers and columns
+            shapes = (config.data.num_classes, config.model.resnet.hidden_size)
+            first_shapes = (first_config.data.num_classes,
+                            first_config.model.resnet.hidden_size)
+            if first_shapes != shapes:
+                raise ValueError(f'Expected the cascade model {cascade_logging_path} '
+                                 f'to have the number of classes and the hidden size '
+                                 f'of {logging_path} {shapes} but found {first_shapes}')
+        first_checkpoint_path = utils.get_weights_path(first_logging_path,
+                                                       model_name='res')
+        first_key = get_run_key(checkpoint_path=first_checkpoint_path,
+                                image_size=cascade_image_size,
+                                temperature=temperature,
+                                saliency_mode=f'cascade{cascade_threshold}')
+        saliency_mode = f'{saliency_mode}-{first_key}'
+
+    # OOD gate: the images far from the training set are flagged, without saliency map
+    gate = None
+    if ood_gate:
+        ood = load_ood(logging_path).to(device)
+        if ood_threshold is not None:
+            ood.threshold = ood_threshold
+        ood_hash = get_file_hash(os.path.join(logging_path, OOD_NAME))
+        saliency_mode = f'{saliency_mode}-ood{ood.threshold}-{ood_hash}'
+        first_ood = None
+        if is_cascade:
+            first_image_size = None \
+                if cascade_image_size == first_config.data.image_size \
+                else cascade_image_size
+            first_ood = load_ood(first_logging_path,
+                                 image_size=first_image_size).to(device)
+            first_ood_path = os.path.join(first_logging_path,
+                                          get_ood_name(first_image_size))
+            first_ood_hash = get_file_hash(first_ood_path)
+            saliency_mode = f'{saliency_mode}-{first_ood.threshold}-{first_ood_hash}'
+        gate = OODGate(ood=ood, first_ood=first_ood)
+
+    # Similar cases: the neighbors are searched when the rows are written (also for the
+    # cached images)
+    index = None
+    if similar_k > 0:
+        # the features of the first stage are not the features of the index
+        if is_cascade and (cascade_image_size != config.data.image_size
+                           or get_file_hash(first_checkpoint_path)
+                           != get_file_hash(checkpoint_path)):
+            raise ValueError('The similar cases are not available with a cascade whose '
+                             'first stage is another model or another image size')
+        index = load_similarity_index(os.path.join(logging_path, INDEX_NAME))
+        if index.model_key != get_file_hash(checkpoint_path):
+            raise ValueError(f'The similarity index of {logging_path} was built with '
+                             f'another checkpoint, build it again with: python main.py '
+                             f'--mode build-index --path {logging_path}')
+
+    # The results are written batch by batch, and an interrupted run is resumed
+    run_mode = f'{saliency_mode}-{saliency_output}' \
+        + (f'-similar{similar_k}' if similar_k > 0 else '')
+    outputs = InferOutputs(dstpath=dstpath,
+                           filename=filename,
+                           run_key=get_run_key(checkpoint_path=checkpoint_path,
+                                               image_size=config.data.image_size,
+                                               temperature=temperature,
+                                               saliency_mode=run_mode),
+                           sep=sep,
+                           image_size=config.data.image_size,
+                           is_cascade=is_cascade,
+                           ood=gate,
+                           index=index,
+                           similar_k=similar_k,
+                           save_raw=save_raw,
+                           saliency_topk=saliency_topk,
+                           columnar_output=columnar_output)
+    pending = [image_path for image_path in infer_images_path
+               if get_image_name(image_path) not in outputs.image_names]
+
+    # Cache: only the new or changed images go through the model
+    to_run: list[int] = list(range(len(pending)))
+    cache = keys = None
+    if cache_path is not None:
+        cache = InferCache(path=cache_path,
+                           checkpoint_path=checkpoint_path,
+                           image_size=config.data.image_size,
+                           temperature=temperature,
+                           saliency_mode=saliency_mode)
+        keys = cache.get_keys(pending)
+        cached_keys = cache.contains(keys,
+                                     with_embedding=columnar_output is not None,
+                                     with_features=similar_k > 0)
+        is_png_missing: list[bool] = [save_png and keys[i] in cached_keys and not all(
+            os.path.exists(os.path.join(saliency_path,
+                                        saliency_fun_name(image_path, j)))
+            for j in range(saliency_topk)) for i, image_path in enumerate(pending)]
+        if (is_cascade or ood_gate) and any(is_png_missing):
+            # the images decided by the first stage and the flagged images have no
+            # saliency map
+            cached = cache.get([keys[i] for i in range(len(pending))
+                                if is_png_missing[i]])
+            is_png_missing = [is_missing
+                              and not (is_cascade and cached[keys[i]]['stage'] == 1)
+                              and not (ood_gate and gate.is_flagged(
+                                  cached[keys[i]]['ood_score'],
+                                  stage=cached[keys[i]]['stage']))
+                              for i, is_missing in enumerate(is_png_missing)]
+        to_run = [i for i in range(len(pending))
+                  if keys[i] not in cached_keys or is_png_missing[i]]
+        print(f'{len(pending) - len(to_run)} images found in the cache, '
+              f'{len(to_run)} images to infer')
+
+    rows = OrderedRows(outputs=outputs,
+                       images_names=list(map(get_image_name, pending)),
+                       cache=cache,
+                       keys=keys,
+                       batch_size=config.test.batch_size)
+    if to_run != []:
+        infer_dataloader = create_infer_dataloader(config=config,
+                                                   data=[pending[i] for i in to_run],
+                                                   datapath=infer_datapath)
+
+        # Get model
+        if model is None:
+            model = finetune_resnet.get_finetuneresnet(config)
+            weight = utils.load_weights(logging_path, device=device, model_name='res')
+            model.load_dict_learnable_parameters(state_dict=weight, strict=True)
+            del weight
+        model = model.to(device)
+
+        first_model = model
+        if is_cascade and cascade_logging_path is not None:
+            first_model = finetune_resnet.get_finetuneresnet(first_config)
+            weight = utils.load_weights(cascade_logging_path,
+                                        device=device,
+                                        model_name='res')
+            first_model.load_dict_learnable_parameters(state_dict=weight, strict=True)
+            first_model = first_model.to(device)
+            first_model.eval()
+            del weight
 
         if plot_saliency:
-            visualizations = gradcam.forward(x)
-            gradcam.save_saliency_maps(visualizations=visualizations,
-                                       dstpath=saliency_path,
-                                       filenames=list(map(saliency_fun_name, image_name)))
+            gradcam = get_saliency(model=model,
+                                   method=saliency_method,
+                                   smooth=saliency_smooth)
+
+        model.eval()
+        batch_start = 0
+        for x, image_path in tqdm(infer_dataloader, desc='Infering'):
+            indexes = to_run[batch_start: batch_start + len(x)]
+            batch_start += len(x)
+            x: Tensor = x.to(device)
+
+            results = classify(x=x,
+                               model=model,
+                               temperature=temperature,
+                               first_model=first_model,
+                               cascade_image_size=cascade_image_size,
+                               cascade_threshold=cascade_threshold)
+
+            # the images decided by the full model and not flagged get a saliency map
+            forwarded = results['stage'] == 2 if is_cascade else None
+            needs_saliency = torch.ones(len(x), dtype=torch.bool, device=device) \
+                if not is_cascade else forwarded.clone()
+            if ood_gate:
+                results['ood_score'] = gate.score(results['features'],
+                                                  stage=results['stage'])
+                is_flagged = gate.is_flagged(results['ood_score'],
+                                             stage=results['stage'])
+                needs_saliency = needs_saliency & ~is_flagged
+
+            if plot_saliency:
+                results['saliency'] = get_saliency_maps(gradcam=gradcam,
+                                                        x=x,
+                                                        logits=results['logits'],
+                                                        needs_saliency=needs_saliency,
+                                                        topk=saliency_topk,
+                                                        forwarded=forwarded)
+                if save_png and needs_saliency.any():
+                    filenames = [[saliency_fun_name(name, j)
+                                  for j in range(saliency_topk)]
+                                 for name, is_needed in zip(image_path,
+                                                            needs_saliency.tolist())
+                                 if is_needed]
+                    save_saliency_pngs(saliency_writer=saliency_writer,
+                                       gradcam=gradcam,
+                                       x=x[needs_saliency],
+                                       cams=results['saliency'][needs_saliency.cpu()],
+                                       filenames=filenames)
 
-        if run_temperature_optimization:
-            y_pred = torch.nn.functional.softmax(y_pred / temperature, dim=-1)
+            results = {name: results[name].cpu()
+                       if results.get(name) is not None else None
+                       for name in RESULT_COLUMNS}
+            if cache is not None:
+                cache.put([keys[i] for i in indexes], **results)
+            rows.write(indexes=indexes, results=results)
+
+    rows.flush()
+    if cache is not None:
+        cache.close()
+    if save_png:
+        saliency_writer.close()
+    outputs.close()
+
+
+def classify(x: Tensor,
+             model: finetune_resnet.FineTuneResNet,
+             temperature: float,
+             first_model: finetune_resnet.FineTuneResNet | None = None,
+             cascade_image_size: int = 128,
+             cascade_threshold: float | None = None
+             ) -> dict[str, Tensor | None]:
+    """
+    Classify a batch of images, without building an autograd graph. In a cascade
+    (cascade_threshold is not None), first_model classifies the images resized to
+    cascade_image_size, and only the images whose top-1 probability is below the
+    threshold go through model (the second stage).
+
+    Args:
+        x (Tensor): The images with shape (B, 3, H, W).
+        model (FineTuneResNet): The model.
+        temperature (float): The temperature of the probabilities.
+        first_model (FineTuneResNet | None, optional): The model of the first stage.
+            Defaults to None (model).
+        cascade_image_size (int, optional): The image size of the first stage.
+            Defaults to 128.
+        cascade_threshold (float | None, optional): The threshold of the top-1
+            probability of the first stage. Defaults to None (no cascade).
+
+    Returns:
+        dict[str, Tensor | None]: The 'probabilities' and the 'logits' with shape
+            (B, num_classes), the 'embedding' (fc1 activations), the backbone
+            'features' and the 'stage' (1 or 2) which decided each image (None without
+            cascade), on the device of x.
+    """
+    with torch.inference_mode():
+        if cascade_threshold is None:
+            features, embedding, logits = model.forward_and_get_features(x)
+            stage = None
         else:
-            y_pred = torch.nn.functional.softmax(y_pred, dim=-1)
-
-        output += get_topk_prediction(y_pred, k=3)
-        image_names += image_name
-        
-    save_infer(dstpath=dstpath,
-               filename=filename,
-               output=output,
-               images_paths=image_names,
-               sep=sep)
-    
+            x_first = torch.nn.functional.interpolate(x,
+                                                      size=(cascade_image_size,
+                                                            cascade_image_size),
+                                                      mode='bilinear',
+                                                      antialias=True)
+            first_stage_model = model if first_model is None else first_model
+            features, embedding, logits = \
+                first_stage_model.forward_and_get_features(x_first)
+            probabilities = torch.nn.functional.softmax(logits / temperature, dim=-1)
+            escalated = probabilities.max(dim=-1).values < cascade_threshold
+            if escalated.any():
+                features[escalated], embedding[escalated], logits[escalated] = \
+                    model.forward_and_get_features(x[escalated])
+            stage = 1 + escalated.int()
+        probabilities = torch.nn.functional.softmax(logits / temperature, dim=-1)
+        return {'probabilities': probabilities,
+                'logits': logits,
+                'embedding': embedding,
+                'features': features,
+                'stage': stage}
+
+
+class OODGate:
+    def __init__(self,
+                 ood: MahalanobisOOD,
+                 first_ood: MahalanobisOOD | None = None
+                 ) -> None:
+        """
+        The out-of-distribution gate of the inference: every image is scored, also the
+        images decided by the first stage of a cascade, which are often the confident
+        errors on overview shots or rulers. The backbone features of the first stage
+        come from another model or from a lower resolution, so their distances to the
+        training set are not on the scale of the statistics of the model: they are
+        scored with the statistics of the first stage (fitted on the training set at its
+        resolution, see src.ood.fit_ood), and flagged with its own threshold, instead of
+        going through the full model again.
+
+        Args:
+            ood (MahalanobisOOD): The statistics of the model (the second stage).
+            first_ood (MahalanobisOOD | None, optional): The statistics of the first
+                stage of the cascade. Defaults to None (no cascade).
+        """
+        self.ood = ood
+        self.first_ood = first_ood
+
+    def score(self, features: Tensor, stage: Tensor | None = None) -> Tensor:
+        """
+        Get the out-of-distribution scores.
+
+        Args:
+            features (Tensor): The backbone features with shape (B, 512).
+            stage (Tensor | None, optional): The stage which decided each image with
+                shape (B). Defaults to None (no cascade).
+
+        Returns:
+            Tensor: The scores with shape (B).
+        """
+        if self.first_ood is None or stage is None:
+            return self.ood.score(features).to(features.device)
+        scores = torch.empty(len(features), device=features.device)
+        is_first = stage == 1
+        for mask, ood in [(is_first, self.first_ood), (~is_first, self.ood)]:
+            if mask.any():
+                scores[mask] = ood.score(features[mask]).to(features.device)
+        return scores
+
+    def is_flagged(self, scores: Tensor, stage: Tensor | None = None) -> Tensor:
+        """
+        Get whether the images are out of distribution.
+
+        Args:
+            scores (Tensor): The scores with shape (B) (see score).
+            stage (Tensor | None, optional): The stage which decided each image with
+                shape (B). Defaults to None (no cascade).
+
+        Returns:
+            Tensor: Whether each score is above the threshold of its stage, with
+                shape (B).
+        """
+        if self.first_ood is None or stage is None:
+            return scores > self.ood.threshold
+        return scores > torch.where(stage == 1,
+                                    self.first_ood.threshold,
+                                    self.ood.threshold)
+
+
+def get_saliency_maps(gradcam: Saliency,
+                      x: Tensor,
+                      logits: Tensor,
+                      needs_saliency: Tensor,
+                      topk: int,
+                      forwarded: Tensor | None = None
+                      ) -> Tensor:
+    """
+    Get the low resolution saliency maps of the topk predicted classes (a separate stage
+    with the gradients enabled). FastCam reuses the layer4 feature maps of the
+    classification forward of the images which went through the model.
+
+    Args:
+        gradcam (Saliency): The saliency method.
+        x (Tensor): The images with shape (B, 3, H, W).
+        logits (Tensor): The logits of the images with shape (B, num_classes).
+        needs_saliency (Tensor): Whether each image gets a saliency map, with shape (B).
+        topk (int): The number of classes to explain.
+        forwarded (Tensor | None, optional): The images which went through the model in
+            the last forward (the second stage of a cascade) with shape (B), the images
+            which need a saliency map are among them. Defaults to None (all the images).
+
+    Returns:
+        Tensor: The maps with shape (B, topk, H // 32, W // 32) (the resolution of the
+            layer4), zeros for the images without saliency map.
+    """
+    cams = torch.zeros(len(x), topk, x.shape[-2] // 32, x.shape[-1] // 32)
+    if needs_saliency.any():
+        targets = logits[needs_saliency].topk(topk, dim=-1).indices.clone()
+        kwargs = {}
+        if isinstance(gradcam, FastCam):
+            mask = needs_saliency if forwarded is None else needs_saliency[forwarded]
+            kwargs['features'] = gradcam.get_last_features(mask=mask,
+                                                           image_size=x.shape[-2:])
+        saliency_cams = gradcam.get_low_resolution_cam(image=x[needs_saliency],
+                                                       targets=targets,
+                                                       **kwargs)
+        cams[needs_saliency.cpu()] = saliency_cams.detach().cpu()
+    return cams
+
+
+def save_saliency_pngs(saliency_writer: SaliencyWriter,
+                       gradcam: Saliency,
+                       x: Tensor,
+                       cams: Tensor,
+                       filenames: list[list[str]]
+                       ) -> None:
+    """
+    Save the saliency maps on their images.
+
+    Args:
+        saliency_writer (SaliencyWriter): The writer of the png files.
+        gradcam (Saliency): The saliency method.
+        x (Tensor): The images with shape (N, 3, H, W).
+        cams (Tensor): The low resolution maps with shape (N, k, h, w).
+        filenames (list[list[str]]): The k filenames of each image.
+    """
+    grayscale_cams = upsample_cam(cams, size=x.shape[-2:]).numpy()
+    for j in range(cams.shape[1]):
+        visualizations = gradcam.get_visualizations(image=x,
+                                                    grayscale_cam=grayscale_cams[:, j])
+        saliency_writer.write(visualizations=visualizations,
+                              filenames=[names[j] for names in filenames])
+
+
+class InferOutputs:
+    def __init__(self,
+                 dstpath: str,
+                 filename: str,
+                 run_key: str,
+                 sep: str,
+                 image_size: int,
+                 is_cascade: bool = False,
+                 ood: OODGate | None = None,
+                 index: SimilarityIndex | None = None,
+                 similar_k: int = 0,
+                 save_raw: bool = False,
+                 saliency_topk: int = 1,
+                 columnar_output: str | None = None
+                 ) -> None:
+        """
+        The outputs of an inference, written row by row in the same order: the results
+        file dstpath/filename (with the extra columns of the cascade, of the OOD gate
+        and of the similar cases), and optionally the raw saliency maps and the columnar
+        output. An interrupted run is resumed: the rows missing in one of the outputs
+        are removed from all of them (and run again).
+
+        Args:
+            dstpath (str): The destination path.
+            filename (str): The filename of the results.
+            run_key (str): The key of the run (see src.result_writer).
+            sep (str): The separator of the results.
+            image_size (int): The image size of the model.
+            is_cascade (bool, optional): Add the 'Stage' column. Defaults to False.
+            ood (OODGate | None, optional): Add the 'OOD score' and 'OOD' columns,
+                flagged by ood. Defaults to None.
+            index (SimilarityIndex | None, optional): Add the 'Similar cases' column,
+                searched in index. Defaults to None.
+            similar_k (int, optional): The number of similar cases. Defaults to 0.
+            save_raw (bool, optional): Save the raw saliency maps in
+                dstpath/saliency_maps.npz. Defaults to False.
+            saliency_topk (int, optional): The number of saliency maps of each image.
+                Defaults to 1.
+            columnar_output (str | None, optional): The format of the columnar output.
+                Defaults to None.
+        """
+        self.is_cascade = is_cascade
+        self.ood = ood
+        self.index = index
+        self.similar_k = similar_k
+        self.saliency_topk = saliency_topk
+        self.extra_columns = (['Stage'] if is_cascade else []) \
+            + (['OOD score', 'OOD'] if ood is not None else []) \
+            + (['Similar cases'] if index is not None else [])
+
+        self.writer = ResultWriter(path=os.path.join(dstpath, filename),
+                                   run_key=run_key,
+                                   k=3,
+                                   sep=sep,
+                                   extra_columns=self.extra_columns
+                                   if self.extra_columns != [] else None)
+        num_rows = self.writer.num_rows
+        self.store_writer = None
+        if save_raw:
+            self.store_writer = SaliencyStoreWriter(
+                path=os.path.join(dstpath, 'saliency_maps.npz'),
+                image_size=image_size,
+                chunk_size=256,
+                resume=self.writer.num_rows > 0)
+            num_rows = min(num_rows, len(self.store_writer))
+        self.columnar_writer = None
+        if columnar_output is not None:
+            self.columnar_writer = ColumnarWriter(
+                path=os.path.join(dstpath, os.path.splitext(filename)[0]),
+                output_format=columnar_output,
+                resume=self.writer.num_rows > 0)
+            num_rows = min(num_rows, len(self.columnar_writer))
+        # the rows whose raw saliency maps or columnar outputs were lost are run again
+        self.writer.truncate(num_rows=num_rows)
+        if self.store_writer is not None:
+            self.store_writer.truncate(num_rows=num_rows)
+        if self.columnar_writer is not None:
+            self.columnar_writer.truncate(num_rows=num_rows)
+
+    @property
+    def image_names(self) -> set[str]:
+        """ The names of the images already written """
+        return self.writer.image_names
+
+    def write(self, images_names: list[str], results: dict[str, Tensor | None]) -> None:
+        """
+        Write the results of a batch (the rows are written before the other outputs).
+
+        Args:
+            images_names (list[str]): The names of the images.
+            results (dict[str, Tensor | None]): The results of the images
+                (see RESULT_COLUMNS).
+        """
+        topk_indices, topk_values = get_topk_arrays(results['probabilities'], k=3)
+        scalars: dict[str, np.ndarray] = {}
+        extra_values: list[list[str]] = [[] for _ in images_names]
+        if self.is_cascade:
+            scalars['stage'] = results['stage'].numpy().astype(np.int8)
+            for values, stage in zip(extra_values, scalars['stage'].tolist()):
+                values.append(str(stage))
+        if self.ood is not None:
+            scalars['ood_score'] = results['ood_score'].numpy()
+            flags = self.ood.is_flagged(results['ood_score'],
+                                        stage=results['stage']).tolist()
+            for values, score, is_flagged in zip(extra_values,
+                                                 scalars['ood_score'].tolist(),
+                                                 flags):
+                values += [f'{score:.1f}', 'yes' if is_flagged else 'no']
+        if self.index is not None:
+            vectors = results['features'] if self.index.embedding == 'features' \
+                else results['embedding']
+            neighbors = self.index.get_neighbors(vectors.numpy(), k=self.similar_k)
+            for values, image_neighbors in zip(extra_values, neighbors):
+                values.append(' | '.join(f'{path} ({label}, {score:.2f})'
+                                         for path, label, score in image_neighbors))
+        self.writer.write(images_names,
+                          get_topk_records(topk_indices, topk_values),
+                          extra_values=extra_values
+                          if self.extra_columns != [] else None)
+        if self.store_writer is not None:
+            cams = results['saliency']
+            self.store_writer.write(cams if self.saliency_topk > 1 else cams[:, 0])
+        if self.columnar_writer is not None:
+            self.columnar_writer.write(images_paths=images_names,
+                                       probabilities=results['probabilities'].numpy(),
+                                       topk_indices=topk_indices,
+                                       logits=results['logits'].numpy(),
+                                       embeddings=results['embedding'].numpy(),
+                                       scalars=scalars)
+
+    def close(self) -> None:
+        """
+        Close the outputs.
+        """
+        if self.store_writer is not None:
+            self.store_writer.close()
+        if self.columnar_writer is not None:
+            self.columnar_writer.close()
+        self.writer.close()
+
+
+class OrderedRows:
+    def __init__(self,
+                 outputs: InferOutputs,
+                 images_names: list[str],
+                 cache: InferCache | None = None,
+                 keys: list[str] | None = None,
+                 batch_size: int = 32
+                 ) -> None:
+        """
+        Write the rows of the pending images in their order, when only some of them go
+        through the model: before the rows of the inferred images, the rows of the
+        images before them are read from the cache.
+
+        Args:
+            outputs (InferOutputs): The outputs.
+            images_names (list[str]): The names of the pending images.
+            cache (InferCache | None, optional): The cache of the images which are not
+                inferred. Defaults to None (all the images are inferred).
+            keys (list[str] | None, optional): The cache keys of the pending images.
+                Defaults to None.
+            batch_size (int, optional): The number of cached rows read at once.
+                Defaults to 32.
+        """
+        self.outputs = outputs
+        self.images_names = images_names
+        self.cache = cache
+        self.keys = keys
+        self.batch_size = batch_size
+        # next pending image to write
+        self.next_index: int = 0
+
+    def write(self, indexes: list[int], results: dict[str, Tensor | None]) -> None:
+        """
+        Write the results of inferred images, and the cached images before them.
+
+        Args:
+            indexes (list[int]): The increasing indexes of the images in the pending
+                images.
+            results (dict[str, Tensor | None]): The results of the images.
+        """
+        for start, stop in get_contiguous_segments(indexes):
+            self.__write_cached(stop=indexes[start])
+            self.outputs.write([self.images_names[i] for i in indexes[start: stop]],
+                               results={name: value[start: stop]
+                                        if value is not None else None
+                                        for name, value in results.items()})
+            self.next_index = indexes[stop - 1] + 1
+
+    def flush(self) -> None:
+        """
+        Write the cached images after the last inferred image.
+        """
+        self.__write_cached(stop=len(self.images_names))
+
+    def __write_cached(self, stop: int) -> None:
+        """ Write the results of the images from next_index to stop (all cached) """
+        for chunk_start in range(self.next_index, stop, self.batch_size):
+            chunk = range(chunk_start, min(chunk_start + self.batch_size, stop))
+            cached = self.cache.get([self.keys[i] for i in chunk])
+            results = {name: torch.stack([cached[self.keys[i]][name] for i in chunk])
+                       if all(cached[self.keys[i]][name] is not None for i in chunk)
+                       else None
+                       for name in RESULT_COLUMNS}
+            self.outputs.write([self.images_names[i] for i in chunk], results=results)
+        self.next_index = max(self.next_index, stop)
+
+
+def get_contiguous_segments(indexes: list[int]) -> list[tuple[int, int]]:
+    """
+    Split a sorted list of indexes into its runs of consecutive indexes.
+
+    Args:
+        indexes (list[int]): The sorted indexes.
+
+    Returns:
+        list[tuple[int, int]]: The (start, stop) positions in indexes of each run.
+    """
+    bounds = [0] \
+        + [i for i in range(1, len(indexes)) if indexes[i] != indexes[i - 1] + 1] \
+        + [len(indexes)]
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)
+            if bounds[i] < bounds[i + 1]]
+
 
 def save_infer(dstpath: str,
                filename: str,
@@ -118,19 +814,10 @@ def save_infer(dstpath: str,
     file = os.path.join(dstpath, filename)
     k = len(output[0])
 
-    header = f'Image{sep}'
-    for j in range(k):
-        header += f'Prediction {j + 1}{sep}Confidence {j + 1} (en %){sep}'
-
     with open(file, 'w', encoding='utf8') as f:
-        f.write(header[:-len(sep)] + '\n')
-
+        f.write(get_infer_header(k=k, sep=sep) + '\n')
         for i in range(len(output)):
-            line = f'{images_paths[i]}{sep}'
-            for j in range(k):
-                line += f'{output[i][j][1]}{sep}{output[i][j][2] * 100:.0f}{sep}'
-            f.write(line[:-len(sep)] + '\n')
-        f.close()
+            f.write(get_infer_line(images_paths[i], output[i], sep=sep) + '\n')
 
     print(f'Inference results saved at {file}')
 
@@ -141,7 +828,7 @@ if __name__ == '__main__':
     logging_path = os.path.join('logs', 'resnet_img256_0')
     datapath = os.path.join('data', 'images_to_predict')
     config = EasyDict(yaml.safe_load(open(os.path.join(logging_path, 'config.yaml'))))
-    
+
     infer(infer_images_path=None,
           infer_datapath=datapath,
           logging_path=logging_path,
@@ -150,4 +837,3 @@ if __name__ == '__main__':
           run_temperature_optimization=False,
           dstpath='',
           filename='inference_results.csv')
-        
\ No newline at end of file
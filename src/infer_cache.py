@@ -0,0 +1,272 @@
+import io
+import os
+import sys
+import sqlite3
+import hashlib
+import numpy as np
+from typing import Any
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.dataloader.infer_dataloader import get_archive_reader, split_archive_path
+
+
+CACHE_NAME = 'infer_cache.sqlite'
+RESULT_COLUMNS = ['probabilities', 'saliency', 'logits', 'embedding', 'stage',
+                  'ood_score', 'features']
+
+
+class InferCache:
+    def __init__(self,
+                 path: str,
+                 checkpoint_path: str,
+                 image_size: int,
+                 temperature: float,
+                 saliency_mode: str
+                 ) -> None:
+        """
+        Persistent cache of the inference results (sqlite file). An entry is keyed by
+        the hash of the content of the image and by everything which changes the result:
+        the hash of the checkpoint, the image size, the temperature and the saliency
+        mode. It stores the probability vector, the raw low resolution saliency maps,
+        the logits, the embedding (fc1 activations) of the image, the stage of the
+        cascade which decided it, its out-of-distribution score and its backbone
+        features.
+
+        Args:
+            path (str): The path of the cache file (created if it does not exist).
+            checkpoint_path (str): The path of the weights of the model.
+            image_size (int): The size of the images given to the model.
+            temperature (float): The temperature of the softmax.
+            saliency_mode (str): A description of the saliency maps, e.g.
+                'gradcam-full-top1', or 'none' without saliency maps.
+        """
+        self.path = path
+        # the processes of src.sharded_infer share the cache: wait for the lock of the
+        # other writers
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS results ('
+                                'key TEXT PRIMARY KEY, '
+                                'probabilities BLOB NOT NULL, '
+                                'saliency BLOB)')
+        # the caches created before the logits and the embedding were stored get the
+        # new columns
+        columns = [row[1]
+                   for row in self.connection.execute('PRAGMA table_info(results)')]
+        for column in RESULT_COLUMNS:
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE results ADD COLUMN {column} BLOB')
+        self.connection.commit()
+
+        self.run_key = get_run_key(checkpoint_path=checkpoint_path,
+                                   image_size=image_size,
+                                   temperature=temperature,
+                                   saliency_mode=saliency_mode)
+
+    def get_keys(self, images_paths: list[str]) -> list[str]:
+        """
+        Get the keys of the images (the images are read but not decoded).
+
+        Args:
+            images_paths (list[str]): The paths of the images.
+
+        Returns:
+            list[str]: The key of each image.
+        """
+        names = [f'{get_file_hash(image_path)}_{self.run_key}'
+                 for image_path in images_paths]
+        return [hashlib.sha1(name.encode()).hexdigest() for name in names]
+
+    def contains(self,
+                 keys: list[str],
+                 with_embedding: bool = False,
+                 with_features: bool = False
+                 ) -> set[str]:
+        """
+        Get the keys which are in the cache (without loading their results).
+
+        Args:
+            keys (list[str]): The keys of the images.
+            with_embedding (bool, optional): Only the entries with their logits and
+                embedding. Defaults to False.
+            with_features (bool, optional): Only the entries with their backbone
+                features. Defaults to False.
+
+        Returns:
+            set[str]: The cached keys.
+        """
+        condition = (' AND embedding IS NOT NULL' if with_embedding else '') \
+            + (' AND features IS NOT NULL' if with_features else '')
+        output: set[str] = set()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start: start + 500]
+            rows = self.connection.execute(
+                f"SELECT key FROM results "
+                f"WHERE key IN ({','.join('?' * len(chunk))}){condition}", chunk)
+            output.update(key for key, in rows)
+        return output
+
+    def get(self, keys: list[str]) -> dict[str, dict[str, Tensor | None]]:
+        """
+        Get the cached results.
+
+        Args:
+            keys (list[str]): The keys of the images.
+
+        Returns:
+            dict[str, dict[str, Tensor | None]]: For each cached key, the
+                'probabilities' with shape (num_classes), the 'saliency' maps, the
+                'logits', the 'embedding', the 'stage', the 'ood_score' and the
+                'features' (None if they were not stored).
+        """
+        output: dict[str, dict[str, Tensor | None]] = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start: start + 500]
+            rows = self.connection.execute(
+                f"SELECT key, {', '.join(RESULT_COLUMNS)} FROM results "
+                f"WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            for key, probabilities, *values in rows:
+                output[key] = {column: None if value is None
+                               else torch.from_numpy(decode_array(value))
+                               for column, value in zip(RESULT_COLUMNS[1:], values)}
+                probabilities = np.frombuffer(probabilities, dtype=np.float32).copy()
+                output[key]['probabilities'] = torch.from_numpy(probabilities)
+        return output
+
+    def put(self,
+            keys: list[str],
+            probabilities: Tensor,
+            saliency: Tensor | None = None,
+            logits: Tensor | None = None,
+            embedding: Tensor | None = None,
+            stage: Tensor | None = None,
+            ood_score: Tensor | None = None,
+            features: Tensor | None = None
+            ) -> None:
+        """
+        Add the results of a batch to the cache.
+
+        Args:
+            keys (list[str]): The keys of the images.
+            probabilities (Tensor): The probabilities with shape (B, num_classes).
+            saliency (Tensor | None, optional): The low resolution saliency maps with
+                shape (B, ..., h, w). Defaults to None.
+            logits (Tensor | None, optional): The logits with shape (B, num_classes).
+                Defaults to None.
+            embedding (Tensor | None, optional): The fc1 activations with shape
+                (B, hidden_size). Defaults to None.
+            stage (Tensor | None, optional): The stage of the cascade which decided each
+                image with shape (B). Defaults to None.
+            ood_score (Tensor | None, optional): The out-of-distribution score of each
+                image with shape (B). Defaults to None.
+            features (Tensor | None, optional): The backbone features with shape
+                (B, 512), stored in float16. Defaults to None.
+        """
+        probabilities = probabilities.detach().cpu().numpy().astype(np.float32)
+        values = [(saliency, np.float16), (logits, np.float32), (embedding, np.float32),
+                  (stage, np.int8), (ood_score, np.float32), (features, np.float16)]
+        arrays = [None if value is None else value.detach().cpu().numpy().astype(dtype)
+                  for value, dtype in values]
+
+        # the probabilities are stored as raw float32, the other arrays with their shape
+        rows = [(key,
+                 probabilities[i].tobytes(),
+                 *[None if array is None else encode_array(array[i])
+                   for array in arrays])
+                for i, key in enumerate(keys)]
+        self.connection.executemany(
+            f"INSERT OR REPLACE INTO results (key, {', '.join(RESULT_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * (len(RESULT_COLUMNS) + 1))})", rows)
+        self.connection.commit()
+
+    def close(self) -> None:
+        """
+        Close the cache file.
+        """
+        self.connection.close()
+
+    def __enter__(self) -> 'InferCache':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def get_run_key(checkpoint_path: str,
+                image_size: int,
+                temperature: float,
+                saliency_mode: str
+                ) -> str:
+    """
+    Get a key which identifies the model and the options of an inference run.
+
+    Args:
+        checkpoint_path (str): The path of the weights of the model.
+        image_size (int): The size of the images given to the model.
+        temperature (float): The temperature of the softmax.
+        saliency_mode (str): A description of the saliency maps (see InferCache).
+
+    Returns:
+        str: The key of the run.
+    """
+    checkpoint_hash = get_file_hash(checkpoint_path)
+    return f'{checkpoint_hash}_{image_size}_{temperature}_{saliency_mode}'
+
+
+def get_file_hash(path: str, chunk_size: int = 2 ** 20) -> str:
+    """
+    Get the hash of the content of a file.
+
+    Args:
+        path (str): The path of the file, or of an archive member ('archive!member').
+        chunk_size (int, optional): The size of the read chunks, in bytes.
+            Defaults to 1 MB.
+
+    Returns:
+        str: The blake2b hash of the file.
+    """
+    file_hash = hashlib.blake2b(digest_size=16)
+    archive_member = split_archive_path(path)
+    if archive_member is not None:
+        file_hash.update(get_archive_reader(archive_member[0]).read(archive_member[1]))
+        return file_hash.hexdigest()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def encode_array(array: np.ndarray) -> bytes:
+    """ Encode an array with its shape and dtype (npy format) """
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def decode_array(data: bytes) -> np.ndarray:
+    """ Decode an array encoded by encode_array """
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    tmp_path = tempfile.mkdtemp()
+    image_path = os.path.join(tmp_path, 'image.jpg')
+    with open(image_path, 'wb') as f:
+        f.write(os.urandom(1000))
+
+    with InferCache(path=os.path.join(tmp_path, CACHE_NAME),
+                    checkpoint_path=image_path,
+                    image_size=256,
+                    temperature=1.5,
+                    saliency_mode='gradcam-full-top1') as cache:
+        keys = cache.get_keys([image_path])
+        print(cache.get(keys))
+        cache.put(keys, probabilities=torch.rand(1, 18), saliency=torch.rand(1, 8, 8))
+        result = cache.get(keys)[keys[0]]
+        print(result['probabilities'].shape, result['saliency'].shape)
@@ -0,0 +1,187 @@
+import os
+import sys
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+
+sys.path.append(up(up(up(os.path.abspath(__file__)))))
+
+from src.model.finetune_resnet import FineTuneResNet
+
+
+class Perturbation_Metrics:
+    def __init__(self,
+                 model: FineTuneResNet,
+                 num_steps: int = 20,
+                 memory_budget: float = 256,
+                 blur_factor: int = 16
+                 ) -> None:
+        """
+        Initialize the Perturbation_Metrics class witch compute the deletion and
+        insertion curves of the saliency maps. See https://arxiv.org/pdf/1806.07421.pdf
+        for more details.
+        - deletion: the most salient pixels are removed first (replaced by 0, the mean
+          color), the probability of the class must drop quickly (lower AUC is better).
+        - insertion: the most salient pixels are added first on a blurred image,
+          the probability of the class must rise quickly (higher AUC is better).
+
+        All the perturbed copies of a batch (num_steps + 1 per image and per curve) go
+        through the model as one large batch, cut in chunks so that the perturbed images
+        of a chunk fit in memory_budget.
+
+        Args:
+            model (FineTuneResNet): The model used for prediction.
+            num_steps (int, optional): The number of steps M of the curves.
+                Defaults to 20.
+            memory_budget (float, optional): The memory of the perturbed images of one
+                chunk, in MB. Defaults to 256.
+            blur_factor (int, optional): The downsampling factor of the blurred image
+                used as start of the insertion. Defaults to 16.
+
+        Raises:
+            ValueError: If num_steps is lower than 1.
+        """
+        if num_steps < 1:
+            raise ValueError(f'Expected num_steps >= 1 but found {num_steps}')
+
+        self.model = model
+        self.num_steps = num_steps
+        self.memory_budget = memory_budget
+        self.blur_factor = blur_factor
+        self.metrics_name = ['deletion auc', 'insertion auc']
+
+    def compute(self, image: Tensor, saliency: Tensor, targets: Tensor) -> Tensor:
+        """
+        Calculate the deletion and insertion AUC of each image.
+
+        Args:
+            image (Tensor): The images with shape (B, 3, H, W).
+            saliency (Tensor): The saliency maps with shape (B, H, W) or (B, h, w)
+                (upsampled to the size of the image).
+            targets (Tensor): The class explained by the saliency maps with shape (B).
+
+        Raises:
+            ValueError: If the shape of saliency is not 3D.
+
+        Returns:
+            Tensor: The deletion and insertion AUC with shape (B, 2).
+        """
+        if len(saliency.shape) != 3:
+            raise ValueError('saliency must be a 3D tensor, '
+                             f'but got {len(saliency.shape)}D tensor.')
+
+        deletion, insertion = self.get_curves(image=image,
+                                              saliency=saliency,
+                                              targets=targets)
+        return torch.stack([get_auc(deletion), get_auc(insertion)], dim=1)
+
+    def get_curves(self,
+                   image: Tensor,
+                   saliency: Tensor,
+                   targets: Tensor
+                   ) -> tuple[Tensor, Tensor]:
+        """
+        Calculate the deletion and insertion curves: the probability of the target class
+        after each of the num_steps + 1 steps.
+
+        Args:
+            image (Tensor): The images with shape (B, 3, H, W).
+            saliency (Tensor): The saliency maps with shape (B, h, w).
+            targets (Tensor): The class explained by the saliency maps with shape (B).
+
+        Returns:
+            tuple[Tensor, Tensor]: The deletion and insertion curves, each with shape
+                (B, M + 1).
+        """
+        batch_size, _, height, width = image.shape
+        num_points = self.num_steps + 1
+        device = image.device
+
+        if saliency.shape[-2:] != image.shape[-2:]:
+            saliency = F.interpolate(saliency.unsqueeze(1).float(),
+                                     size=(height, width),
+                                     mode='bilinear',
+                                     align_corners=False).squeeze(1)
+
+        # rank of each pixel in the saliency order (0 = most salient)
+        order = saliency.to(device).flatten(1).argsort(dim=1, descending=True)
+        ranks = torch.empty_like(order)
+        pixel_index = torch.arange(height * width, device=device).expand(batch_size, -1)
+        ranks.scatter_(dim=1, index=order, src=pixel_index)
+        ranks = ranks.view(batch_size, 1, height, width)
+
+        # number of pixels perturbed after each step
+        thresholds = torch.linspace(0, height * width, num_points, device=device)
+        thresholds = thresholds.round()
+
+        blurred = F.interpolate(image, scale_factor=1 / self.blur_factor,
+                                mode='bilinear', align_corners=False)
+        blurred = F.interpolate(blurred, size=(height, width), mode='bilinear',
+                                align_corners=False)
+
+        # copy n is the step n // B of the image n % B, for deletion then insertion
+        num_copies = 2 * num_points * batch_size
+        chunk_size = max(1, int(self.memory_budget * 2 ** 20 // image[0].nbytes))
+        targets = targets.to(device)
+        probabilities: list[Tensor] = []
+
+        with torch.no_grad():
+            for start in range(0, num_copies, chunk_size):
+                stop = min(start + chunk_size, num_copies)
+                copies = torch.arange(start, stop, device=device)
+                is_insertion = (copies >= num_points * batch_size).view(-1, 1, 1, 1)
+                step = (copies // batch_size) % num_points
+                image_index = copies % batch_size
+
+                # mask = 1 on the pixels already removed (deletion) or inserted
+                mask = ranks[image_index] < thresholds[step].view(-1, 1, 1, 1)
+                images = image[image_index]
+                deleted = torch.where(mask, torch.zeros_like(images), images)
+                inserted = torch.where(mask, images, blurred[image_index])
+                perturbed = torch.where(is_insertion, inserted, deleted)
+
+                y_pred = F.softmax(self.model.forward(perturbed), dim=1)
+                index = targets[image_index].view(-1, 1)
+                probabilities.append(y_pred.gather(dim=1, index=index))
+
+        curves = torch.cat(probabilities, dim=0).view(2, num_points, batch_size)
+        curves = curves.permute(0, 2, 1)
+        return curves[0], curves[1]
+
+    def get_metrics_name(self) -> list[str]:
+        """ Get the names of the metrics. """
+        return self.metrics_name
+
+
+def get_auc(curves: Tensor) -> Tensor:
+    """
+    Calculate the area under each curve (trapezoidal rule), the x axis going from 0
+    to 1.
+
+    Args:
+        curves (Tensor): The curves with shape (B, M + 1).
+
+    Returns:
+        Tensor: The AUC of each curve with shape (B).
+    """
+    return torch.trapezoid(curves, dx=1 / (curves.shape[1] - 1), dim=1)
+
+
+if __name__ == '__main__':
+    from config.utils import load_config
+    from src.model.finetune_resnet import get_finetuneresnet
+
+    config = load_config('config/config.yaml')
+    model = get_finetuneresnet(config)
+    model.eval()
+
+    batch_size = 4
+    x = torch.rand((batch_size, 3, config.data.image_size, config.data.image_size))
+    saliency = torch.rand((batch_size, 8, 8))
+    targets = model.forward(x).argmax(dim=1)
+
+    metrics = Perturbation_Metrics(model=model, num_steps=10)
+    print(metrics.get_metrics_name())
+    print(metrics.compute(image=x, saliency=saliency, targets=targets))
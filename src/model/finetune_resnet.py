@@ -84,6 +84,28 @@ class FineTuneResNet(Model):
         reel_output = self.fc2(x)
         return intermediare, reel_output
 
+    def forward_and_get_features(self, x: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+        """
+        Forward pass of the model and returns the backbone features, the intermediate
+        and the final outputs.
+
+        Args:
+            x (Tensor): Input tensor of shape (batch_size, 3, 128, 128).
+
+        Returns:
+            tuple[Tensor, Tensor, Tensor]: A tuple containing:
+                - features (Tensor): Pooled output of the resnet of shape
+                  (batch_size, 512).
+                - intermediare (Tensor): Intermediate tensor of shape
+                  (batch_size, hidden_size).
+                - reel_output (Tensor): Final output tensor of shape
+                  (batch_size, num_classes).
+        """
+        features = self.resnet_begin(x).squeeze(-1).squeeze(-1)
+        intermediare = self.relu(self.fc1(features))
+        reel_output = self.fc2(self.dropout(intermediare))
+        return features, intermediare, reel_output
+
     def get_intermediare_parameters(self) -> Iterator[nn.Parameter]:
         """
         Get the intermediate parameters of the model, wicht are the last two fully connected layers.
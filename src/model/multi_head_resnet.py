@@ -0,0 +1,138 @@
+import os
+import sys
+from easydict import EasyDict
+from os.path import dirname as up
+
+import torch
+from torch import nn, Tensor
+from torchvision import models
+from torchvision.models.resnet import ResNet18_Weights
+
+sys.path.append(up(up(up(os.path.abspath(__file__)))))
+
+from src.model.basemodel import Model
+from config.utils import load_config, find_config
+from utils import utils
+
+
+class MultiHeadResNet(Model):
+    def __init__(self, heads_configs: list[EasyDict]) -> None:
+        """
+        Several FineTuneResNet models which share their frozen ImageNet ResNet18: the
+        backbone runs once per batch, and the fc1/fc2 head of each model is applied to
+        the shared 512 features, so N models cost about one. For the inference only
+        (no dropout).
+
+        Args:
+            heads_configs (list[EasyDict]): The configuration of each model.
+        """
+        super(MultiHeadResNet, self).__init__()
+
+        resnet = models.resnet18(weights=ResNet18_Weights.IMAGENET1K_V1)
+        self.resnet_begin = nn.Sequential(*(list(resnet.children())[:-1]))
+        for param in self.resnet_begin.parameters():
+            param.requires_grad = False
+        self.resnet_begin.eval()
+
+        # head: fc1 -> relu -> fc2, like FineTuneResNet
+        self.heads = nn.ModuleList([
+            nn.Sequential(nn.Linear(in_features=512,
+                                    out_features=config.model.resnet.hidden_size),
+                          nn.ReLU(),
+                          nn.Linear(in_features=config.model.resnet.hidden_size,
+                                    out_features=config.data.num_classes))
+            for config in heads_configs])
+
+    def forward(self, x: Tensor) -> tuple[Tensor, Tensor]:
+        """
+        Forward pass of the backbone and of all the heads.
+
+        Args:
+            x (Tensor): Input tensor of shape (batch_size, 3, image_size, image_size).
+
+        Returns:
+            tuple[Tensor, Tensor]: A tuple containing:
+                - features (Tensor): Pooled output of the resnet of shape
+                  (batch_size, 512).
+                - logits (Tensor): Output of each head of shape (num_heads, batch_size,
+                  num_classes).
+        """
+        features = self.resnet_begin(x).squeeze(-1).squeeze(-1)
+        logits = torch.stack([head(features) for head in self.heads])
+        return features, logits
+
+    def load_head(self, index: int, state_dict: dict[str, Tensor]) -> None:
+        """
+        Load the fc1 and fc2 weights of a FineTuneResNet checkpoint into a head.
+
+        Args:
+            index (int): The index of the head.
+            state_dict (dict[str, Tensor]): The learnable parameters of the
+                FineTuneResNet.
+
+        Raises:
+            ValueError: If the checkpoint has other parameters than fc1 and fc2 (the
+                resnet was fine-tuned, so it is not the shared backbone).
+        """
+        others = [name for name in state_dict if not name.startswith(('fc1.', 'fc2.'))]
+        if others != []:
+            raise ValueError('Expected only the fc1 and fc2 parameters (frozen resnet) '
+                             f'but found {others[:4]}')
+        head_state_dict = {name.replace('fc1.', '0.').replace('fc2.', '2.'): value
+                           for name, value in state_dict.items()}
+        self.heads[index].load_state_dict(head_state_dict, strict=True)
+
+
+def get_multi_head_resnet(logging_paths: list[str],
+                          device: torch.device = torch.device('cpu')
+                          ) -> tuple[MultiHeadResNet, list[EasyDict]]:
+    """
+    Load the models of several log folders into one MultiHeadResNet.
+
+    Args:
+        logging_paths (list[str]): The log folders of the models, whose resnet were
+            frozen during the training.
+        device (torch.device, optional): The device of the model.
+            Defaults to torch.device('cpu').
+
+    Raises:
+        ValueError: If the models do not have the same image size or number of classes.
+        ValueError: If the resnet of a model was fine-tuned.
+
+    Returns:
+        tuple[MultiHeadResNet, list[EasyDict]]: The model and the configuration of each
+            head.
+    """
+    configs = [load_config(find_config(experiment_path=logging_path))
+               for logging_path in logging_paths]
+    for name in ['image_size', 'num_classes']:
+        values = [config.data[name] for config in configs]
+        if len(set(values)) > 1:
+            raise ValueError(f'Expected models with the same {name} but found {values}')
+
+    model = MultiHeadResNet(heads_configs=configs)
+    for i, logging_path in enumerate(logging_paths):
+        weight = utils.load_weights(logging_path,
+                                    device=torch.device('cpu'),
+                                    model_name='res')
+        try:
+            model.load_head(i, weight)
+        except ValueError as error:
+            raise ValueError(f"The resnet of {logging_path} can't be shared: "
+                             f"{error}") from error
+    model = model.to(device)
+    model.eval()
+    return model, configs
+
+
+if __name__ == '__main__':
+    logging_paths = [os.path.join('logs', 'resnet_img256_0'),
+                     os.path.join('logs', 'retrain_resnet_img256_0')]
+    model, configs = get_multi_head_resnet(logging_paths)
+    print("Total parameters:", model.get_number_parameters())
+
+    x = torch.randn((8, 3, 256, 256))
+    with torch.inference_mode():
+        features, logits = model.forward(x)
+    print("features shape:", features.shape)
+    print("logits shape:", logits.shape)
@@ -0,0 +1,151 @@
+import os
+import sys
+from tqdm import tqdm
+from typing import Callable
+from easydict import EasyDict
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from config.utils import load_config, find_config
+from src.dataloader.labels import get_topk_arrays, get_topk_records
+from src.dataloader.infer_dataloader import create_infer_dataloader, get_image_from_path
+from src.model.multi_head_resnet import get_multi_head_resnet
+from src.infer_cache import get_run_key, get_file_hash
+from src.result_writer import ResultWriter
+from utils import utils
+
+
+def multi_head_infer(infer_datapath: str,
+                     logging_paths: list[str],
+                     dstpath: str,
+                     filename: str,
+                     run_temperature_optimization: bool = True,
+                     sep: str = ',',
+                     side_by_side: bool = True,
+                     ensemble: bool = True
+                     ) -> None:
+    """
+    Perform an inference with several models which share their frozen ResNet18 (see
+    src.model.multi_head_resnet): the backbone runs once per batch and each model only
+    adds its head. The predictions of each model are written in
+    dstpath/<filename>_<model folder>.csv (side by side, like one infer run per model
+    without saliency), and the mean of the probabilities of the models in
+    dstpath/filename. An interrupted run is resumed (see src.result_writer).
+
+    Args:
+        infer_datapath (str): The path to the inference data.
+        logging_paths (list[str]): The log folders of the models.
+        dstpath (str): The destination path for saving the inference results.
+        filename (str): The filename of the results of the ensemble, e.g.
+            'inference_results.csv'.
+        run_temperature_optimization (bool, optional): Whether to run temperature
+            optimization. Defaults to True.
+        sep (str, optional): The separator for saving the inference results.
+            Defaults to ','.
+        side_by_side (bool, optional): Write the results of each model.
+            Defaults to True.
+        ensemble (bool, optional): Write the results of the ensemble. Defaults to True.
+
+    Raises:
+        ValueError: If two models have the same folder name.
+        ValueError: If neither side_by_side nor ensemble.
+    """
+    names = [os.path.basename(os.path.normpath(logging_path))
+             for logging_path in logging_paths]
+    if len(set(names)) < len(names):
+        raise ValueError('Expected models with different folder names '
+                         f'but found {names}')
+    if not (side_by_side or ensemble):
+        raise ValueError('Expected side_by_side or ensemble')
+
+    # the data and test options of the first model
+    config: EasyDict = load_config(find_config(experiment_path=logging_paths[0]))
+    device = utils.get_device(device_config=config.learning.device)
+    if device.type == 'cpu':
+        config.test.batch_size = 32
+
+    infer_images_path = get_image_from_path(infer_datapath)
+    get_image_name: Callable[[str], str] = \
+        lambda img_name: utils.get_relatif_image_path(img_name, infer_datapath)
+    temperature: float = 1.5 if run_temperature_optimization else 1
+
+    checkpoints_paths = [utils.get_weights_path(logging_path, model_name='res')
+                         for logging_path in logging_paths]
+    stem, extension = os.path.splitext(filename)
+    writers: dict[str, ResultWriter] = {}
+    if side_by_side:
+        for name, checkpoint_path in zip(names, checkpoints_paths):
+            run_key = get_run_key(checkpoint_path=checkpoint_path,
+                                  image_size=config.data.image_size,
+                                  temperature=temperature,
+                                  saliency_mode='heads')
+            path = os.path.join(dstpath, f'{stem}_{name}{extension}')
+            writers[name] = ResultWriter(path=path,
+                                         run_key=run_key,
+                                         k=3,
+                                         sep=sep)
+    if ensemble:
+        models_hash = '-'.join(get_file_hash(checkpoint_path)
+                               for checkpoint_path in checkpoints_paths[1:])
+        run_key = get_run_key(checkpoint_path=checkpoints_paths[0],
+                              image_size=config.data.image_size,
+                              temperature=temperature,
+                              saliency_mode=f'ensemble-{models_hash}')
+        writers['ensemble'] = ResultWriter(path=os.path.join(dstpath, filename),
+                                           run_key=run_key,
+                                           k=3,
+                                           sep=sep)
+    # the images missing in at least one of the results files
+    pending = [image_path for image_path in infer_images_path
+               if any(get_image_name(image_path) not in writer.image_names
+                      for writer in writers.values())]
+
+    if pending != []:
+        infer_dataloader = create_infer_dataloader(config=config,
+                                                   data=pending,
+                                                   datapath=infer_datapath)
+        model, _ = get_multi_head_resnet(logging_paths, device=device)
+
+        desc = f'Infering with {len(logging_paths)} heads'
+        for x, image_path in tqdm(infer_dataloader, desc=desc):
+            x: Tensor = x.to(device)
+            with torch.inference_mode():
+                _, logits = model.forward(x)
+                probabilities = torch.nn.functional.softmax(logits / temperature,
+                                                            dim=-1).cpu()
+
+            images_names = list(map(get_image_name, image_path))
+            outputs = {name: probabilities[i]
+                       for i, name in enumerate(names) if name in writers}
+            if ensemble:
+                outputs['ensemble'] = probabilities.mean(dim=0)
+            for name, output in outputs.items():
+                # a resumed results file only gets its missing images
+                is_new = [image_name not in writers[name].image_names
+                          for image_name in images_names]
+                if not any(is_new):
+                    continue
+                topk_indices, topk_values = \
+                    get_topk_arrays(output[torch.tensor(is_new)], k=3)
+                new_names = [image_name
+                             for image_name, new in zip(images_names, is_new) if new]
+                writers[name].write(new_names,
+                                    get_topk_records(topk_indices, topk_values))
+
+    for writer in writers.values():
+        writer.close()
+
+
+if __name__ == '__main__':
+    logging_paths = [os.path.join('logs', 'resnet_img256_0'),
+                     os.path.join('logs', 'retrain_resnet_img256_0')]
+    datapath = os.path.join('data', 'images_to_predict')
+
+    multi_head_infer(infer_datapath=datapath,
+                     logging_paths=logging_paths,
+                     dstpath='',
+                     filename='inference_results.csv')
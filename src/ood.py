@@ -0,0 +1,285 @@
+import os
+import sys
+import numpy as np
+from tqdm import tqdm
+from easydict import EasyDict
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+from torch.utils.data import DataLoader
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.dataloader.dataloader import DataGenerator
+from src.model import finetune_resnet
+from utils import utils
+
+
+# not a .pt file, which would be taken for the weights of the model
+OOD_NAME = 'ood_stats.npz'
+
+
+class MahalanobisOOD:
+    def __init__(self,
+                 means: Tensor,
+                 precision: Tensor,
+                 threshold: float
+                 ) -> None:
+        """
+        Out-of-distribution score of an image: the Mahalanobis distance of its backbone
+        features (the 512 pooled outputs of the resnet) to the closest class, with a
+        covariance shared by the classes. The statistics are fitted once on the training
+        set (see fit_ood), and an image whose score is above the threshold is flagged
+        (e.g. an overview shot, a ruler or an evidence tag).
+
+        Args:
+            means (Tensor): The mean features of each class with shape
+                (num_classes, 512).
+            precision (Tensor): The inverse of the shared covariance with shape
+                (512, 512).
+            threshold (float): The score above which an image is out of distribution.
+        """
+        self.means = means.double()
+        self.precision = precision.double()
+        self.threshold = threshold
+        # |f - m|^2 = f P f - 2 f P m + m P m, with the terms of the means computed once
+        self.precision_means = self.means @ self.precision
+        self.means_norms = (self.precision_means * self.means).sum(dim=-1)
+
+    def score(self, features: Tensor) -> Tensor:
+        """
+        Get the out-of-distribution scores.
+
+        Args:
+            features (Tensor): The backbone features with shape (B, 512).
+
+        Returns:
+            Tensor: The Mahalanobis distance to the closest class with shape (B).
+        """
+        features = features.double().to(self.means.device)
+        features_norms = ((features @ self.precision) * features).sum(dim=-1,
+                                                                      keepdim=True)
+        distances = features_norms - 2 * features @ self.precision_means.T \
+            + self.means_norms
+        return distances.min(dim=-1).values.clamp(min=0).sqrt().float()
+
+    def to(self, device: torch.device) -> 'MahalanobisOOD':
+        """
+        Move the statistics to a device.
+        """
+        for name in ['means', 'precision', 'precision_means', 'means_norms']:
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    def save(self, path: str) -> None:
+        """
+        Save the statistics.
+
+        Args:
+            path (str): The path of the file.
+        """
+        np.savez(path,
+                 means=self.means.cpu().numpy(),
+                 precision=self.precision.cpu().numpy(),
+                 threshold=self.threshold)
+
+
+def fit_mahalanobis(features: Tensor,
+                    labels: Tensor,
+                    num_classes: int,
+                    quantile: float = 0.99,
+                    shrinkage: float = 0.01,
+                    holdout: float = 0.2
+                    ) -> MahalanobisOOD:
+    """
+    Fit the class means and the shared covariance of the features. The threshold is
+    taken from the scores of held-out images, because the images used for the fit are
+    closer to the statistics than new images of the same distribution.
+
+    Args:
+        features (Tensor): The backbone features of the training images with shape
+            (N, 512).
+        labels (Tensor): The labels of the training images with shape (N).
+        num_classes (int): The number of classes.
+        quantile (float, optional): The threshold is this quantile of the scores of the
+            held-out images. Defaults to 0.99.
+        shrinkage (float, optional): The covariance is shrunk towards a multiple of the
+            identity by this factor, so it can be inverted with few images per class.
+            Defaults to 0.01.
+        holdout (float, optional): The fraction of the images held out to get the
+            threshold (the final statistics are fitted on all the images).
+            Defaults to 0.2.
+
+    Raises:
+        ValueError: If a class has no image.
+
+    Returns:
+        MahalanobisOOD: The fitted out-of-distribution scorer.
+    """
+    features = features.double()
+    counts = torch.bincount(labels, minlength=num_classes)
+    if (counts == 0).any():
+        raise ValueError(f'Expected images of each class but found no image of the '
+                         f'classes {torch.where(counts == 0)[0].tolist()}')
+
+    permutation = torch.randperm(len(features),
+                                 generator=torch.Generator().manual_seed(0))
+    num_holdout = int(holdout * len(features))
+    fit_indexes, holdout_indexes = permutation[num_holdout:], permutation[:num_holdout]
+    if num_holdout == 0 \
+            or torch.bincount(labels[fit_indexes], minlength=num_classes).min() == 0:
+        # too few images: the threshold is taken from the images of the fit
+        fit_indexes = holdout_indexes = permutation
+
+    ood = get_mahalanobis(features[fit_indexes],
+                          labels[fit_indexes],
+                          num_classes,
+                          shrinkage=shrinkage)
+    holdout_scores = ood.score(features[holdout_indexes]).double()
+    threshold = torch.quantile(holdout_scores, quantile).item()
+
+    ood = get_mahalanobis(features, labels, num_classes, shrinkage=shrinkage)
+    ood.threshold = threshold
+    return ood
+
+
+def get_mahalanobis(features: Tensor,
+                    labels: Tensor,
+                    num_classes: int,
+                    shrinkage: float
+                    ) -> MahalanobisOOD:
+    """ Get the class means and the shrunk shared covariance (without threshold) """
+    counts = torch.bincount(labels, minlength=num_classes)
+    means = torch.zeros(num_classes, features.shape[1], dtype=torch.float64)
+    means.index_add_(0, labels, features)
+    means /= counts.clamp(min=1).unsqueeze(1)
+
+    centered = features - means[labels]
+    covariance = centered.T @ centered / len(features)
+    dimension = covariance.shape[0]
+    identity = torch.eye(dimension, dtype=torch.float64)
+    covariance = (1 - shrinkage) * covariance \
+        + shrinkage * torch.trace(covariance) / dimension * identity
+    return MahalanobisOOD(means=means,
+                          precision=torch.linalg.inv(covariance),
+                          threshold=0)
+
+
+def get_ood_name(image_size: int | None = None) -> str:
+    """
+    Get the filename of the out-of-distribution statistics of a model.
+
+    Args:
+        image_size (int | None, optional): The image size given to the model, if it is
+            not the image size of its training (e.g. the first stage of a cascade).
+            Defaults to None.
+
+    Returns:
+        str: The filename, e.g. 'ood_stats.npz' or 'ood_stats_img128.npz'.
+    """
+    if image_size is None:
+        return OOD_NAME
+    return OOD_NAME.replace('.npz', f'_img{image_size}.npz')
+
+
+def load_ood(logging_path: str, image_size: int | None = None) -> MahalanobisOOD:
+    """
+    Load the out-of-distribution statistics of a model.
+
+    Args:
+        logging_path (str): The log folder of the model.
+        image_size (int | None, optional): The image size given to the model, if it is
+            not the image size of its training (see get_ood_name). Defaults to None.
+
+    Raises:
+        FileNotFoundError: If the statistics were not fitted.
+
+    Returns:
+        MahalanobisOOD: The out-of-distribution scorer.
+    """
+    path = os.path.join(logging_path, get_ood_name(image_size))
+    if not os.path.exists(path):
+        option = f' --ood_image_size {image_size}' if image_size is not None else ''
+        raise FileNotFoundError(f"{path} wasn't found, fit it with: python main.py "
+                                f"--mode fit-ood --path {logging_path}{option}")
+    with np.load(path) as stats:
+        return MahalanobisOOD(means=torch.from_numpy(stats['means']),
+                              precision=torch.from_numpy(stats['precision']),
+                              threshold=stats['threshold'].item())
+
+
+def fit_ood(config: EasyDict,
+            logging_path: str,
+            run_real_data: bool = False,
+            quantile: float = 0.99,
+            image_size: int | None = None
+            ) -> MahalanobisOOD:
+    """
+    Fit the out-of-distribution statistics of a model on its training set (without the
+    augmentations), and save them in logging_path/ood_stats.npz.
+
+    Args:
+        config (EasyDict): The configuration of the model.
+        logging_path (str): The log folder of the model.
+        run_real_data (bool, optional): Fit on the real data. Defaults to False.
+        quantile (float, optional): The threshold is this quantile of the scores of the
+            held-out training images. Defaults to 0.99.
+        image_size (int | None, optional): Fit the statistics of the images resized to
+            image_size, like the first stage of a cascade of infer (the features and
+            their distances change with the resolution), saved in
+            logging_path/ood_stats_img<size>.npz. Defaults to None (the image size of
+            the training).
+
+    Returns:
+        MahalanobisOOD: The fitted out-of-distribution scorer.
+    """
+    device = utils.get_device(device_config=config.learning.device)
+    data_path = config.data.real_data_path if run_real_data else config.data.path
+    generator = DataGenerator(data_path=os.path.join(data_path,
+                                                     f'train_{config.data.image_size}'),
+                              mode='test',
+                              use_background=(not (run_real_data
+                                                   or 'real' in config.data.path)),
+                              transforms=config.data.transforms)
+    dataloader = DataLoader(dataset=generator,
+                            batch_size=config.test.batch_size,
+                            shuffle=False,
+                            num_workers=config.test.num_workers)
+
+    model = finetune_resnet.get_finetuneresnet(config)
+    weight = utils.load_weights(logging_path, device=device, model_name='res')
+    model.load_dict_learnable_parameters(state_dict=weight, strict=True)
+    model = model.to(device)
+    model.eval()
+    del weight
+
+    features, labels = [], []
+    with torch.inference_mode():
+        for item in tqdm(dataloader, desc='Fitting the OOD statistics'):
+            x = item['image'].to(device)
+            if image_size is not None:
+                x = torch.nn.functional.interpolate(x, size=(image_size, image_size),
+                                                    mode='bilinear', antialias=True)
+            features.append(model.forward_and_get_features(x)[0].cpu())
+            labels.append(item['label'])
+
+    ood = fit_mahalanobis(features=torch.cat(features),
+                          labels=torch.cat(labels),
+                          num_classes=config.data.num_classes,
+                          quantile=quantile)
+    path = os.path.join(logging_path, get_ood_name(image_size))
+    ood.save(path)
+    print(f'OOD statistics saved at {path} (threshold: {ood.threshold:.1f})')
+    return ood
+
+
+if __name__ == '__main__':
+    num_classes = 18
+    labels = torch.arange(num_classes).repeat(20)
+    features = torch.randn(num_classes, 512)[labels] \
+        + 0.5 * torch.randn(len(labels), 512)
+    ood = fit_mahalanobis(features=features, labels=labels, num_classes=num_classes)
+    print(f'{ood.threshold = :.1f}')
+    print('in distribution:', ood.score(features[:4]))
+    print('out of distribution:', ood.score(10 * torch.randn(4, 512)))
@@ -0,0 +1,228 @@
+import io
+import os
+import sys
+import time
+import threading
+from PIL import Image
+from typing import Any
+from collections import deque
+from concurrent.futures import Future
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+from torchvision import transforms
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from config.utils import load_config, find_config
+from src.dataloader.labels import get_topk_prediction, LABELS
+from src.model import finetune_resnet
+from utils import utils
+
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = [INTERACTIVE, BULK]
+
+
+class Predictor:
+    def __init__(self,
+                 logging_path: str,
+                 max_batch_size: int = 16,
+                 max_latency: float = 10,
+                 bulk_latency: float = 100,
+                 temperature: float = 1.5
+                 ) -> None:
+        """
+        Thread-safe predictor which keeps a model in memory and classifies the submitted
+        images by dynamic batches: a batch is run as soon as it has max_batch_size
+        images, or when its oldest image has waited its latency. There are two priority
+        classes: the interactive images are always run before the bulk images, and an
+        interactive batch is never filled with bulk images, so a large bulk backlog
+        delays an interactive image by at most one running batch.
+
+        Args:
+            logging_path (str): The log folder of the model (with its config and
+                checkpoint).
+            max_batch_size (int, optional): The maximum number of images in a batch.
+                Defaults to 16.
+            max_latency (float, optional): The maximum waiting time of an interactive
+                image before its batch is run, in ms. Defaults to 10.
+            bulk_latency (float, optional): The maximum waiting time of a bulk image
+                before its batch is run, in ms. Defaults to 100.
+            temperature (float, optional): The temperature of the softmax.
+                Defaults to 1.5.
+        """
+        self.config = load_config(find_config(experiment_path=logging_path))
+        self.device = utils.get_device(device_config=self.config.learning.device)
+
+        self.model = finetune_resnet.get_finetuneresnet(self.config)
+        weight = utils.load_weights(logging_path, device=self.device, model_name='res')
+        self.model.load_dict_learnable_parameters(state_dict=weight, strict=True)
+        self.model = self.model.to(self.device)
+        self.model.eval()
+        del weight
+
+        image_size = (self.config.data.image_size, self.config.data.image_size)
+        self.transform = transforms.Compose([transforms.Resize(image_size),
+                                             transforms.ToTensor()])
+        self.max_batch_size = max_batch_size
+        self.latency = {INTERACTIVE: max_latency / 1000, BULK: bulk_latency / 1000}
+        self.temperature = temperature
+
+        # hold model_lock to use self.model in another thread (e.g. for a saliency map)
+        self.model_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.queues: dict[str, deque[tuple[Tensor, Future, float]]] = \
+            {priority: deque() for priority in PRIORITIES}
+        self.is_running = True
+        self.batch_thread = threading.Thread(target=self.__run_batches, daemon=True)
+        self.batch_thread.start()
+
+    def load_image(self, image: Tensor | bytes | str) -> Tensor:
+        """
+        Load an image from its encoded bytes or its path.
+
+        Args:
+            image (Tensor | bytes | str): The image with shape (3, H, W)
+                (returned as it is), the content of the image file, or its path.
+
+        Raises:
+            FileNotFoundError: If the path does not exist.
+
+        Returns:
+            Tensor: The image with shape (3, H, W).
+        """
+        if isinstance(image, Tensor):
+            return image
+        if isinstance(image, str):
+            if not os.path.exists(image):
+                raise FileNotFoundError(f"{image} wasn't found")
+            image = Image.open(image)
+        else:
+            image = Image.open(io.BytesIO(image))
+        return self.transform(image.convert('RGB'))
+
+    def submit(self,
+               image: Tensor | bytes | str,
+               priority: str = INTERACTIVE
+               ) -> Future:
+        """
+        Queue an image to be classified.
+
+        Args:
+            image (Tensor | bytes | str): The image (see load_image).
+            priority (str, optional): The priority class, 'interactive' or 'bulk'.
+                Defaults to 'interactive'.
+
+        Raises:
+            ValueError: If priority is not in PRIORITIES.
+            RuntimeError: If the predictor is closed.
+
+        Returns:
+            Future: The probabilities of the classes with shape (num_classes).
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f'Expected priority in {PRIORITIES} but found {priority}')
+
+        x = self.load_image(image)
+        future = Future()
+        with self.condition:
+            if not self.is_running:
+                raise RuntimeError('the predictor is closed')
+            self.queues[priority].append((x, future, time.monotonic()))
+            self.condition.notify()
+        return future
+
+    def predict(self,
+                images: list[Tensor | bytes | str],
+                k: int = 3,
+                priority: str = INTERACTIVE
+                ) -> list[list[tuple[int, str, float]]]:
+        """
+        Classify images and wait for the results.
+
+        Args:
+            images (list[Tensor | bytes | str]): The images (see load_image).
+            k (int, optional): The number of predictions per image. Defaults to 3.
+            priority (str, optional): The priority class. Defaults to 'interactive'.
+
+        Raises:
+            ValueError: If k is not between 1 and the number of classes.
+
+        Returns:
+            list[list[tuple[int, str, float]]]: The top-k (index, label, confidence) of
+                each image, like get_topk_prediction.
+        """
+        if not 1 <= k <= len(LABELS):
+            raise ValueError(f'Expected k between 1 and {len(LABELS)} but found {k}')
+
+        futures = [self.submit(image, priority=priority) for image in images]
+        y_pred = torch.stack([future.result() for future in futures])
+        return get_topk_prediction(y_pred, k=k)
+
+    def close(self) -> None:
+        """
+        Stop the batch thread once all the submitted images are classified.
+        """
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+        self.batch_thread.join()
+
+    def __enter__(self) -> 'Predictor':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+    def __get_batch(self) -> list[tuple[Tensor, Future, float]] | None:
+        """ Wait for the next batch (None when the predictor is closed and empty) """
+        with self.condition:
+            while True:
+                priority = next(filter(lambda p: len(self.queues[p]) > 0, PRIORITIES),
+                                None)
+                if priority is None:
+                    if not self.is_running:
+                        return None
+                    self.condition.wait()
+                    continue
+
+                pending = self.queues[priority]
+                remaining = pending[0][2] + self.latency[priority] - time.monotonic()
+                if len(pending) >= self.max_batch_size or remaining <= 0 \
+                        or not self.is_running:
+                    return [pending.popleft()
+                            for _ in range(min(self.max_batch_size, len(pending)))]
+                # wake up on a new image (maybe interactive) or at the deadline
+                self.condition.wait(timeout=remaining)
+
+    def __run_batches(self) -> None:
+        """ Classify the batches until the predictor is closed """
+        while (batch := self.__get_batch()) is not None:
+            futures = [future for _, future, _ in batch]
+            try:
+                x = torch.stack([x for x, _, _ in batch]).to(self.device)
+                with self.model_lock, torch.no_grad():
+                    y_pred = self.model.forward(x)
+                y_pred = torch.nn.functional.softmax(y_pred / self.temperature,
+                                                     dim=-1).cpu()
+                for future, y in zip(futures, y_pred):
+                    future.set_result(y)
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+
+
+if __name__ == '__main__':
+    from src.dataloader.infer_dataloader import get_image_from_path
+
+    logging_path = os.path.join('logs', 'resnet_img256_0')
+    datapath = os.path.join('data', 'images_to_predict')
+    images = get_image_from_path(datapath)
+
+    with Predictor(logging_path=logging_path) as predictor:
+        backlog = [predictor.submit(image, priority=BULK) for image in images]
+        print(predictor.predict(images[:1], k=3))   # not delayed by the backlog
+        print(f'{len([future.result() for future in backlog])} bulk images classified')
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+from typing import Any
+
+
+class ResultWriter:
+    def __init__(self,
+                 path: str,
+                 run_key: str,
+                 k: int = 3,
+                 sep: str = ',',
+                 fsync_interval: float = 10,
+                 extra_columns: list[str] | None = None,
+                 append: bool = False
+                 ) -> None:
+        """
+        Write the inference results row by row, so the memory does not depend on the
+        number of images and a crash only loses the rows of the running batch. The rows
+        are flushed after each write and synced on disk every fsync_interval seconds.
+
+        A state file (<path>.state.json) records the run_key and whether the run is
+        complete. If the previous run with the same run_key was interrupted, its rows
+        are kept and the images in image_names can be skipped; otherwise the file is
+        started again.
+
+        Args:
+            path (str): The path of the results file.
+            run_key (str): Identify the model and the options of the run (see
+                src.infer_cache.get_run_key): the rows of another run are never resumed.
+            k (int, optional): The number of predictions per image. Defaults to 3.
+            sep (str, optional): The separator used in the file. Defaults to ','.
+            fsync_interval (float, optional): The time between two syncs on disk, in
+                seconds. Defaults to 10.
+            extra_columns (list[str] | None, optional): The names of columns added after
+                the predictions, e.g. ['Stage']. Defaults to None.
+            append (bool, optional): Also keep the rows of a complete run with the same
+                run_key (e.g. the results file of src.watch_infer, which grows across
+                the restarts). Defaults to False.
+        """
+        self.path = path
+        self.state_path = f'{path}.state.json'
+        self.run_key = run_key
+        self.k = k
+        self.sep = sep
+        self.fsync_interval = fsync_interval
+        self.extra_columns = extra_columns
+        self.append = append
+        self.image_names: set[str] = set()
+        self.num_rows: int = 0
+
+        if self.__can_resume():
+            self.__read_rows()
+            self.file = open(path, 'a', encoding='utf8')
+            if self.num_rows > 0:
+                print(f'resume the inference: {self.num_rows} images found in {path}')
+        else:
+            self.file = open(path, 'w', encoding='utf8')
+            header = get_infer_header(k=k, sep=sep, extra_columns=extra_columns)
+            self.file.write(header + '\n')
+
+        self.__write_state(complete=False)
+        self.last_fsync = time.monotonic()
+
+    def write(self,
+              images_paths: list[str],
+              output: list[list[tuple[int, str, float]]],
+              extra_values: list[list[str]] | None = None
+              ) -> None:
+        """
+        Append the results of a batch.
+
+        Args:
+            images_paths (list[str]): The paths of the images.
+            output (list[list[tuple[int, str, float]]]): The top-k predictions of the
+                images.
+            extra_values (list[list[str]] | None, optional): The values of the extra
+                columns of each image. Defaults to None.
+        """
+        if extra_values is None:
+            extra_values = [None] * len(images_paths)
+        lines = [get_infer_line(image_path, prediction,
+                                sep=self.sep,
+                                extra_values=values)
+                 for image_path, prediction, values
+                 in zip(images_paths, output, extra_values)]
+        self.file.write(''.join(map(lambda line: line + '\n', lines)))
+        self.file.flush()
+        self.image_names.update(images_paths)
+        self.num_rows += len(lines)
+
+        if time.monotonic() - self.last_fsync > self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.monotonic()
+
+    def truncate(self, num_rows: int) -> None:
+        """
+        Keep only the first num_rows rows (e.g. the rows which have their raw saliency
+        maps).
+
+        Args:
+            num_rows (int): The number of rows to keep.
+        """
+        if num_rows >= self.num_rows:
+            return None
+
+        self.file.close()
+        with open(self.path, 'r', encoding='utf8') as f:
+            lines = [next(f) for _ in range(num_rows + 1)]
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.path)
+
+        self.image_names = set(map(lambda line: line.split(self.sep)[0], lines[1:]))
+        self.num_rows = num_rows
+        self.file = open(self.path, 'a', encoding='utf8')
+        return None
+
+    def close(self) -> None:
+        """
+        Sync the file on disk and mark the run as complete.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.__write_state(complete=True)
+        print(f'Inference results saved at {self.path}')
+
+    def __can_resume(self) -> bool:
+        """ Returns True if the previous run is the same run and was interrupted """
+        if not (os.path.exists(self.path) and os.path.exists(self.state_path)):
+            return False
+        with open(self.state_path, 'r', encoding='utf8') as f:
+            state = json.load(f)
+        header = get_infer_header(k=self.k,
+                                  sep=self.sep,
+                                  extra_columns=self.extra_columns)
+        with open(self.path, 'r', encoding='utf8') as f:
+            is_same_header = f.readline().rstrip('\n') == header
+        # a complete run is also resumed in append mode
+        return state['run_key'] == self.run_key \
+            and (not state['complete'] or self.append) and is_same_header
+
+    def __read_rows(self) -> None:
+        """ Read the names of the written images and remove a partial last row """
+        with open(self.path, 'rb+') as f:
+            content = f.read()
+            end = content.rfind(b'\n') + 1
+            if end < len(content):
+                f.truncate(end)
+
+        with open(self.path, 'r', encoding='utf8') as f:
+            next(f)
+            for line in f:
+                self.image_names.add(line.split(self.sep)[0])
+                self.num_rows += 1
+
+    def __write_state(self, complete: bool) -> None:
+        """ Write the state file atomically """
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as f:
+            json.dump({'run_key': self.run_key, 'complete': complete}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.state_path)
+
+    def __enter__(self) -> 'ResultWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+def merge_result_files(paths: list[str],
+                       path: str,
+                       image_names: list[str],
+                       sep: str = ','
+                       ) -> None:
+    """
+    Merge complete results files of the same run (e.g. the shards of src.sharded_infer)
+    into one results file, with the rows in the order of image_names. The state file of
+    the first file is kept, so the merged file is a complete run.
+
+    Args:
+        paths (list[str]): The paths of the results files to merge.
+        path (str): The path of the merged results file.
+        image_names (list[str]): The names of the images, in the order of the rows.
+        sep (str, optional): The separator used in the files. Defaults to ','.
+
+    Raises:
+        ValueError: If the files do not have the same header.
+        ValueError: If an image is in none of the files.
+    """
+    header, rows = None, {}
+    for file_path in paths:
+        with open(file_path, 'r', encoding='utf8') as f:
+            file_header = f.readline()
+            if header is not None and file_header != header:
+                raise ValueError(f'Expected the header {header!r} in {file_path} '
+                                 f'but found {file_header!r}')
+            header = file_header
+            for line in f:
+                rows[line.split(sep, 1)[0]] = line
+
+    missing = [image_name for image_name in image_names if image_name not in rows]
+    if missing != []:
+        raise ValueError('Expected all the images in the results files '
+                         f'but {len(missing)} are missing, e.g. {missing[:3]}')
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        f.write(header)
+        f.writelines(rows[image_name] for image_name in image_names)
+    os.replace(tmp_path, path)
+    os.replace(f'{paths[0]}.state.json', f'{path}.state.json')
+    for file_path in paths:
+        os.remove(file_path)
+        if os.path.exists(f'{file_path}.state.json'):
+            os.remove(f'{file_path}.state.json')
+
+
+def get_infer_header(k: int,
+                     sep: str = ',',
+                     extra_columns: list[str] | None = None
+                     ) -> str:
+    """
+    Get the header of the results file.
+
+    Args:
+        k (int): The number of predictions per image.
+        sep (str, optional): The separator used in the file. Defaults to ','.
+        extra_columns (list[str] | None, optional): The names of the columns added after
+            the predictions. Defaults to None.
+
+    Returns:
+        str: The header (without new line).
+    """
+    header = f'Image{sep}'
+    for j in range(k):
+        header += f'Prediction {j + 1}{sep}Confidence {j + 1} (en %){sep}'
+    for column in extra_columns or []:
+        header += f'{column}{sep}'
+    return header[:-len(sep)]
+
+
+def get_infer_line(image_path: str,
+                   prediction: list[tuple[int, str, float]],
+                   sep: str = ',',
+                   extra_values: list[str] | None = None
+                   ) -> str:
+    """
+    Get the row of an image in the results file.
+
+    Args:
+        image_path (str): The path of the image.
+        prediction (list[tuple[int, str, float]]): The top-k predictions of the image.
+        sep (str, optional): The separator used in the file. Defaults to ','.
+        extra_values (list[str] | None, optional): The values of the extra columns.
+            Defaults to None.
+
+    Returns:
+        str: The row (without new line).
+    """
+    line = f'{image_path}{sep}'
+    for j in range(len(prediction)):
+        line += f'{prediction[j][1]}{sep}{prediction[j][2] * 100:.0f}{sep}'
+    for value in extra_values or []:
+        line += f'{value}{sep}'
+    return line[:-len(sep)]
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'inference_results.csv')
+    prediction = [(0, 'label 0', 0.5), (1, 'label 1', 0.3), (2, 'label 2', 0.2)]
+
+    writer = ResultWriter(path=path, run_key='run', sep=';')
+    writer.write(['image_0.jpg', 'image_1.jpg'], [prediction, prediction])
+    del writer      # crash: the run is not marked as complete
+
+    writer = ResultWriter(path=path, run_key='run', sep=';')
+    print(f'{writer.image_names = }')
+    writer.write(['image_2.jpg'], [prediction])
+    writer.close()
+    print(open(path, 'r', encoding='utf8').read())
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import zipfile
+import numpy as np
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.gradcam import overlay_cam, upsample_cam
+from src.dataloader.infer_dataloader import open_image
+
+
+SALIENCY_OUTPUTS = ['png', 'raw', 'both']
+META_NAME = 'meta'
+CHUNK_NAME = 'chunk_{:05d}'
+
+
+class SaliencyStoreWriter:
+    def __init__(self,
+                 path: str,
+                 image_size: int,
+                 chunk_size: int = 1024,
+                 resume: bool = False
+                 ) -> None:
+        """
+        Write the raw low resolution saliency maps (the layer4 grid, in float16) of a
+        whole inference run in one compressed file. The maps are grouped by chunks of
+        chunk_size maps, and are stored in the order of the images in the results CSV.
+        The file is a .npz archive, so it can also be read with np.load. The archive is
+        closed after each chunk, so the written chunks survive a crash.
+
+        Args:
+            path (str): The path of the file (.npz).
+            image_size (int): The size of the images given to the model.
+            chunk_size (int, optional): The number of saliency maps per chunk.
+                Defaults to 1024.
+            resume (bool, optional): Append the maps to the chunks of an existing file
+                (a new file is started if it is missing or unreadable).
+                Defaults to False.
+        """
+        self.path = path
+        self.image_size = image_size
+        self.chunk_size = chunk_size
+        self.buffer: list[np.ndarray] = []
+        self.num_buffered: int = 0
+        self.chunk_lengths: list[int] = []
+
+        if resume and zipfile.is_zipfile(path):
+            with zipfile.ZipFile(path, mode='r') as archive:
+                self.chunk_lengths = get_chunk_lengths(archive)
+        else:
+            with zipfile.ZipFile(path, mode='w') as archive:
+                archive.writestr(f'{META_NAME}.json',
+                                 json.dumps({'image_size': image_size}))
+
+    def __len__(self) -> int:
+        """
+        Returns the number of saliency maps written on disk (without the buffered ones).
+        """
+        return sum(self.chunk_lengths)
+
+    def truncate(self, num_rows: int) -> None:
+        """
+        Keep only the first num_rows saliency maps written on disk (to call after a
+        resume, before writing). The file is rewritten.
+
+        Args:
+            num_rows (int): The number of saliency maps to keep.
+        """
+        if num_rows >= len(self):
+            return None
+
+        tmp_path = f'{self.path}.tmp'
+        with zipfile.ZipFile(self.path, mode='r') as archive, \
+                zipfile.ZipFile(tmp_path,
+                                mode='w',
+                                compression=zipfile.ZIP_DEFLATED) as new_archive:
+            new_archive.writestr(f'{META_NAME}.json',
+                                 archive.read(f'{META_NAME}.json'))
+            kept = 0
+            chunk_lengths: list[int] = []
+            for i, chunk_length in enumerate(self.chunk_lengths):
+                if kept >= num_rows:
+                    break
+                name = f'{CHUNK_NAME.format(i)}.npy'
+                with archive.open(name) as f:
+                    chunk = np.lib.format.read_array(f, allow_pickle=False)
+                chunk = chunk[:num_rows - kept]
+                with new_archive.open(name, mode='w', force_zip64=True) as f:
+                    np.lib.format.write_array(f, chunk, allow_pickle=False)
+                chunk_lengths.append(len(chunk))
+                kept += len(chunk)
+        os.replace(tmp_path, self.path)
+        self.chunk_lengths = chunk_lengths
+        return None
+
+    def write(self, cams: Tensor | np.ndarray) -> None:
+        """
+        Append the saliency maps of a batch.
+
+        Args:
+            cams (Tensor | np.ndarray): The low resolution saliency maps with shape
+                (B, ..., h, w).
+        """
+        if isinstance(cams, Tensor):
+            cams = cams.detach().cpu().numpy()
+        self.buffer.append(cams.astype(np.float16))
+        self.num_buffered += len(cams)
+        if self.num_buffered >= self.chunk_size:
+            self.__flush()
+
+    def close(self) -> None:
+        """
+        Write the last chunk.
+        """
+        self.__flush()
+        print(f'Raw saliency maps saved at {self.path}')
+
+    def __flush(self) -> None:
+        """ Write the buffered saliency maps in a new chunk """
+        if self.buffer == []:
+            return None
+        chunk = np.concatenate(self.buffer, axis=0)
+        name = CHUNK_NAME.format(len(self.chunk_lengths))
+        with zipfile.ZipFile(self.path,
+                             mode='a',
+                             compression=zipfile.ZIP_DEFLATED) as archive:
+            with archive.open(f'{name}.npy', mode='w', force_zip64=True) as f:
+                np.lib.format.write_array(f, chunk, allow_pickle=False)
+        self.chunk_lengths.append(len(chunk))
+        self.buffer = []
+        self.num_buffered = 0
+        return None
+
+    def __enter__(self) -> 'SaliencyStoreWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class SaliencyStore:
+    def __init__(self, path: str) -> None:
+        """
+        Read a file written by SaliencyStoreWriter. The chunks are loaded lazily,
+        and the saliency maps are upsampled only when they are rendered.
+
+        Args:
+            path (str): The path of the file (.npz).
+
+        Raises:
+            FileNotFoundError: If the file does not exist.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} wasn't found")
+
+        self.zipfile = zipfile.ZipFile(path, mode='r')
+        meta = json.loads(self.zipfile.read(f'{META_NAME}.json'))
+        self.image_size: int = meta['image_size']
+        self.offsets = np.cumsum([0] + get_chunk_lengths(self.zipfile))
+        self.chunk_index: int = -1
+        self.chunk: np.ndarray = None
+
+    def __len__(self) -> int:
+        """
+        Returns the number of saliency maps.
+        """
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        """
+        Get the raw low resolution saliency map of the image at the row index of the
+        results CSV.
+
+        Args:
+            index (int): The index of the image.
+
+        Raises:
+            IndexError: If the index is out of range.
+
+        Returns:
+            np.ndarray: The saliency map with shape (..., h, w) and dtype float16.
+        """
+        if not (0 <= index < len(self)):
+            raise IndexError(f'index out of range. {index = } but {len(self) = }')
+        chunk_index = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        if chunk_index != self.chunk_index:
+            with self.zipfile.open(f'{CHUNK_NAME.format(chunk_index)}.npy') as f:
+                self.chunk = np.lib.format.read_array(f, allow_pickle=False)
+            self.chunk_index = chunk_index
+        return self.chunk[index - self.offsets[chunk_index]]
+
+    def render(self,
+               index: int,
+               image_path: str = None,
+               size: tuple[int, int] = None
+               ) -> np.ndarray:
+        """
+        Upsample a saliency map, and put it on its image if image_path is given.
+
+        Args:
+            index (int): The index of the image in the results CSV.
+            image_path (str, optional): The path of the image. Defaults to None.
+            size (tuple[int, int], optional): The size (H, W) of the output.
+                Defaults to None (the size of the image given to the model).
+
+        Returns:
+            np.ndarray: The saliency map with shape (..., H, W) and values in [0, 1] if
+                image_path is None, else the visualization with shape (..., H, W, 3) and
+                dtype uint8.
+        """
+        if size is None:
+            size = (self.image_size, self.image_size)
+
+        cam = torch.from_numpy(self[index].astype(np.float32))
+        cam = upsample_cam(cam, size=size).numpy()
+        if image_path is None:
+            return cam
+
+        shape = cam.shape
+        cam = cam.reshape(-1, *size)
+
+        image = open_image(image_path).convert('RGB').resize((size[1], size[0]))
+        rgb_img = np.repeat(np.array(image)[np.newaxis], len(cam), axis=0)
+        visualizations = overlay_cam(rgb_img=rgb_img, grayscale_cam=cam)
+        return visualizations.reshape(*shape[:-2], *size, 3)
+
+    def close(self) -> None:
+        """
+        Close the file.
+        """
+        self.zipfile.close()
+
+
+def get_chunk_lengths(archive: zipfile.ZipFile) -> list[int]:
+    """
+    Get the number of saliency maps of each chunk (only the headers of the chunks are
+    read).
+
+    Args:
+        archive (zipfile.ZipFile): The opened file.
+
+    Returns:
+        list[int]: The length of each chunk.
+    """
+    chunk_lengths: list[int] = []
+    names = set(archive.namelist())
+    while f'{CHUNK_NAME.format(len(chunk_lengths))}.npy' in names:
+        with archive.open(f'{CHUNK_NAME.format(len(chunk_lengths))}.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, _ = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, _ = np.lib.format.read_array_header_2_0(f)
+        chunk_lengths.append(shape[0])
+    return chunk_lengths
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'saliency_maps.npz')
+    with SaliencyStoreWriter(path=path, image_size=256, chunk_size=64) as writer:
+        for _ in range(10):
+            writer.write(torch.rand(32, 8, 8))
+
+    store = SaliencyStore(path)
+    print(f'{len(store) = }, {store[100].shape = }, {store.render(100).shape = }')
+    print(f'file size: {os.path.getsize(path) / 1024:.1f} KB')
@@ -0,0 +1,94 @@
+import os
+import cv2
+import threading
+import numpy as np
+from typing import Any
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class SaliencyWriter:
+    def __init__(self,
+                 dstpath: str,
+                 num_workers: int = 2,
+                 max_pending: int = 256
+                 ) -> None:
+        """
+        Encode and write the saliency maps in background threads, so the inference
+        can go on with the next batch (cv2 releases the GIL while encoding the PNG).
+
+        Args:
+            dstpath (str): The destination path where the images will be saved.
+            num_workers (int, optional): The number of writing threads. Defaults to 2.
+            max_pending (int, optional): The maximum number of images waiting to be
+                written. write blocks when it is reached, to bound the memory.
+                Defaults to 256.
+        """
+        if not os.path.exists(dstpath):
+            os.makedirs(dstpath)
+            print(f"Directory {dstpath} created ")
+
+        self.dstpath = dstpath
+        self.executor = ThreadPoolExecutor(max_workers=num_workers,
+                                           thread_name_prefix='saliency_writer')
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures: list[Future] = []
+
+    def write(self, visualizations: np.ndarray, filenames: list[str]) -> None:
+        """
+        Queue the saliency maps to be written.
+
+        Args:
+            visualizations (np.ndarray): The saliency maps with shape (B, H, W, C).
+            filenames (list[str]): The filenames for the saved images.
+        """
+        self.__raise_errors()
+        for visualization, filename in zip(visualizations, filenames):
+            self.slots.acquire()
+            future = self.executor.submit(self.__write_image, visualization, filename)
+            self.futures.append(future)
+
+    def close(self) -> None:
+        """
+        Wait until all the saliency maps are written.
+
+        Raises:
+            Exception: The first error raised while writing an image.
+        """
+        self.executor.shutdown(wait=True)
+        self.__raise_errors()
+
+    def __write_image(self, visualization: np.ndarray, filename: str) -> None:
+        """ Write an image and free its slot """
+        try:
+            cv2.imwrite(os.path.join(self.dstpath, filename), visualization)
+        finally:
+            self.slots.release()
+
+    def __raise_errors(self) -> None:
+        """ Raise the error of a finished writing and forget the finished writings """
+        running: list[Future] = []
+        for future in self.futures:
+            if future.done():
+                future.result()
+            else:
+                running.append(future)
+        self.futures = running
+
+    def __enter__(self) -> 'SaliencyWriter':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    dstpath = tempfile.mkdtemp()
+    with SaliencyWriter(dstpath=dstpath) as writer:
+        for i in range(4):
+            visualizations = np.random.randint(0, 255,
+                                               size=(8, 256, 256, 3),
+                                               dtype=np.uint8)
+            writer.write(visualizations, [f'{i}_{b}_saliency.png' for b in range(8)])
+    print(f'{len(os.listdir(dstpath))} images written in {dstpath}')
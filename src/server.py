@@ -0,0 +1,243 @@
+import os
+import sys
+import cv2
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.gradcam import get_saliency
+from src.predictor import Predictor, INTERACTIVE
+
+
+class InferenceService:
+    def __init__(self,
+                 predictor: Predictor,
+                 saliency_method: str = 'gradcam',
+                 saliency_smooth: str = 'fast',
+                 max_saliency_maps: int = 256
+                 ) -> None:
+        """
+        Classify the images of the HTTP requests with a Predictor, so the images of
+        concurrent requests share the same batches. The saliency maps are computed in a
+        background thread, between two batches, and kept in memory until they are
+        fetched.
+
+        Args:
+            predictor (Predictor): The predictor which holds the model
+                (see src.predictor).
+            saliency_method (str, optional): The saliency method (see
+                src.gradcam.get_saliency). Defaults to 'gradcam'.
+            saliency_smooth (str, optional): The smoothing preset of gradcam.
+                Defaults to 'fast'.
+            max_saliency_maps (int, optional): The number of saliency maps kept in
+                memory (the oldest ones are forgotten). Defaults to 256.
+        """
+        self.predictor = predictor
+        self.saliency = get_saliency(model=predictor.model, method=saliency_method,
+                                     smooth=saliency_smooth)
+        self.saliency_executor = ThreadPoolExecutor(max_workers=1,
+                                                    thread_name_prefix='saliency')
+        self.saliency_maps: OrderedDict[str, Future] = OrderedDict()
+        self.max_saliency_maps = max_saliency_maps
+        self.saliency_count = 0
+        self.saliency_lock = threading.Lock()
+
+    def predict(self,
+                images: list[bytes | str],
+                k: int = 3,
+                saliency: bool = False
+                ) -> list[dict]:
+        """
+        Classify images (they can share a batch with the images of other requests).
+
+        Args:
+            images (list[bytes | str]): The images, as encoded bytes or paths.
+            k (int, optional): The number of predictions per image. Defaults to 3.
+            saliency (bool, optional): Whether to compute the saliency map of the
+                predicted class in background. Defaults to False.
+
+        Raises:
+            ValueError: If k is not between 1 and the number of classes.
+
+        Returns:
+            list[dict]: For each image, 'prediction' the top-k
+                (index, label, confidence) like get_topk_prediction, and 'saliency' the
+                id of its saliency map (or None).
+        """
+        x = list(map(self.predictor.load_image, images))
+        predictions = self.predictor.predict(x, k=k, priority=INTERACTIVE)
+
+        output: list[dict] = []
+        for i in range(len(x)):
+            saliency_id = None
+            if saliency:
+                saliency_id = self.submit_saliency(x[i], target=predictions[i][0][0])
+            output.append({'prediction': predictions[i], 'saliency': saliency_id})
+        return output
+
+    def submit_saliency(self, x: Tensor, target: int) -> str:
+        """
+        Queue the computation of a saliency map.
+
+        Args:
+            x (Tensor): The image with shape (3, H, W).
+            target (int): The class to explain.
+
+        Returns:
+            str: The id of the saliency map.
+        """
+        with self.saliency_lock:
+            saliency_id = str(self.saliency_count)
+            self.saliency_count += 1
+            self.saliency_maps[saliency_id] = self.saliency_executor.submit(
+                self.__compute_saliency, x, target)
+            while len(self.saliency_maps) > self.max_saliency_maps:
+                self.saliency_maps.popitem(last=False)
+        return saliency_id
+
+    def get_saliency_map(self, saliency_id: str) -> bytes | None:
+        """
+        Get a saliency map encoded in PNG.
+
+        Args:
+            saliency_id (str): The id of the saliency map.
+
+        Raises:
+            KeyError: If the id is unknown (or the map was forgotten).
+
+        Returns:
+            bytes | None: The PNG image, or None if it is not computed yet.
+        """
+        with self.saliency_lock:
+            future = self.saliency_maps[saliency_id]
+        return future.result() if future.done() else None
+
+    def close(self) -> None:
+        """
+        Stop the predictor and the saliency thread.
+        """
+        self.predictor.close()
+        self.saliency_executor.shutdown(wait=True)
+
+    def __compute_saliency(self, x: Tensor, target: int) -> bytes:
+        """ Compute a saliency map and encode it in PNG """
+        x = x.unsqueeze(0).to(self.predictor.device)
+        with self.predictor.model_lock:
+            grayscale_cam = self.saliency.get_cam(image=x,
+                                                  targets=torch.tensor([target]))
+        visualization = self.saliency.get_visualizations(image=x,
+                                                         grayscale_cam=grayscale_cam)[0]
+        return cv2.imencode('.png', visualization)[1].tobytes()
+
+
+def get_request_handler(service: InferenceService) -> type[BaseHTTPRequestHandler]:
+    """
+    Create the HTTP request handler of the service.
+        - POST /predict: classify an image sent as the request body (raw bytes), or the
+          images of a JSON body {"paths": [...]}. Query options: k (default 3) and
+          saliency (true/false).
+        - GET /saliency/<id>: the saliency map in PNG (202 while it is computed).
+        - GET /health: check that the service is running.
+
+    Args:
+        service (InferenceService): The inference service.
+
+    Returns:
+        type[BaseHTTPRequestHandler]: The request handler class.
+    """
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self) -> None:
+            url = urlparse(self.path)
+            if url.path != '/predict':
+                return self.__send_json(404, {'error': f'unknown path {url.path}'})
+
+            query = parse_qs(url.query)
+            try:
+                k = int(query.get('k', ['3'])[0])
+                saliency = query.get('saliency', ['false'])[0].lower() == 'true'
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    images = json.loads(body)['paths']
+                else:
+                    images = [body]
+                output = service.predict(images, k=k, saliency=saliency)
+            except (ValueError, KeyError, FileNotFoundError, OSError) as error:
+                return self.__send_json(400, {'error': str(error)})
+
+            for prediction in output:
+                if prediction['saliency'] is not None:
+                    prediction['saliency'] = f"/saliency/{prediction['saliency']}"
+            self.__send_json(200, {'predictions': output})
+
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+            if url.path == '/health':
+                return self.__send_json(200, {'status': 'ok'})
+            if not url.path.startswith('/saliency/'):
+                return self.__send_json(404, {'error': f'unknown path {url.path}'})
+
+            try:
+                image = service.get_saliency_map(url.path.split('/')[-1])
+            except KeyError:
+                return self.__send_json(404, {'error': 'unknown saliency map'})
+            if image is None:
+                return self.__send_json(202, {'status': 'pending'})
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+
+        def log_message(self, *args) -> None:
+            pass
+
+        def __send_json(self, code: int, content: dict) -> None:
+            data = json.dumps(content, ensure_ascii=False).encode('utf8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return RequestHandler
+
+
+def serve(service: InferenceService, host: str = '127.0.0.1', port: int = 8000) -> None:
+    """
+    Run the HTTP server of the inference service until a keyboard interruption.
+
+    Args:
+        service (InferenceService): The inference service.
+        host (str, optional): The host of the server. Defaults to '127.0.0.1'.
+        port (int, optional): The port of the server. Defaults to 8000.
+    """
+    server = ThreadingHTTPServer((host, port), get_request_handler(service))
+    print(f'inference service running on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    from src.dataloader.infer_dataloader import get_image_from_path
+
+    logging_path = os.path.join('logs', 'resnet_img256_0')
+    datapath = os.path.join('data', 'images_to_predict')
+    service = InferenceService(predictor=Predictor(logging_path=logging_path))
+    print(service.predict(get_image_from_path(datapath)[:4], k=3))
+    service.close()
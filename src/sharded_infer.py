@@ -0,0 +1,135 @@
+import os
+import sys
+from typing import Any, Callable
+from easydict import EasyDict
+from os.path import dirname as up
+
+import torch
+import torch.multiprocessing as mp
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.dataloader.infer_dataloader import get_image_from_path
+from src.model import finetune_resnet
+from src.infer import infer
+from src.result_writer import merge_result_files
+from utils import utils
+
+
+def sharded_infer(infer_datapath: str,
+                  logging_path: str,
+                  config: EasyDict,
+                  dstpath: str,
+                  filename: str,
+                  num_process: int,
+                  threads_per_process: int | None = None,
+                  sep: str = ',',
+                  **infer_kwargs: Any
+                  ) -> None:
+    """
+    Perform an inference with num_process local processes, for the large backlogs on
+    many-core CPU nodes (one process with small batches does not use all the cores). The
+    model is loaded once and its weights are put in shared memory; the images are split
+    into num_process contiguous shards, and each process runs infer on its shard
+    (written in dstpath/<filename>_shard<i>.csv, resumed if the run is interrupted).
+    Once all the shards are done, they are merged into dstpath/filename in the order of
+    the images.
+
+    Args:
+        infer_datapath (str): The path to the inference data.
+        logging_path (str): The path to the logging directory.
+        config (EasyDict): The configuration object (most of times, in the
+            logging_path).
+        dstpath (str): The destination path for saving the inference results.
+        filename (str): The filename for saving the inference results.
+        num_process (int): The number of processes.
+        threads_per_process (int | None, optional): The number of torch threads of each
+            process. Defaults to None (the cpu count divided by num_process).
+        sep (str, optional): The separator for saving the inference results.
+            Defaults to ','.
+        **infer_kwargs (Any): The other options of infer (the saliency maps are saved as
+            png only, and without columnar output).
+
+    Raises:
+        ValueError: If num_process is lower than 1.
+        ValueError: If the raw saliency maps or a columnar output are asked.
+    """
+    if num_process < 1:
+        raise ValueError(f'Expected num_process >= 1 but found {num_process}')
+    if infer_kwargs.get('saliency_output', 'png') != 'png' \
+            or infer_kwargs.get('columnar_output') is not None:
+        raise ValueError('The raw saliency maps and the columnar outputs are not '
+                         'available with several processes')
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or 1) // num_process)
+
+    infer_images_path = get_image_from_path(infer_datapath)
+    num_process = max(1, min(num_process, len(infer_images_path)))
+    bounds = [round(i * len(infer_images_path) / num_process)
+              for i in range(num_process + 1)]
+    shards = [infer_images_path[bounds[i]: bounds[i + 1]] for i in range(num_process)]
+    stem, extension = os.path.splitext(filename)
+    shards_filenames = [f'{stem}_shard{i}{extension}' for i in range(num_process)]
+
+    # the weights are loaded once, the processes map the same memory
+    device = utils.get_device(device_config=config.learning.device)
+    model = finetune_resnet.get_finetuneresnet(config)
+    weight = utils.load_weights(logging_path, device=device, model_name='res')
+    model.load_dict_learnable_parameters(state_dict=weight, strict=True)
+    model = model.to(device)
+    del weight
+    if device.type == 'cpu':
+        model.share_memory()
+
+    print(f'launch {num_process} processes with {threads_per_process} threads each')
+    kwargs = dict(infer_datapath=infer_datapath,
+                  logging_path=logging_path,
+                  config=config,
+                  dstpath=dstpath,
+                  sep=sep,
+                  model=model,
+                  **infer_kwargs)
+    mp.spawn(_worker,
+             args=(shards, shards_filenames, threads_per_process, infer, kwargs),
+             nprocs=num_process,
+             join=True)
+
+    get_image_name: Callable[[str], str] = \
+        lambda img_name: utils.get_relatif_image_path(img_name, infer_datapath)
+    path = os.path.join(dstpath, filename)
+    merge_result_files(paths=[os.path.join(dstpath, shard_filename)
+                              for shard_filename in shards_filenames],
+                       path=path,
+                       image_names=list(map(get_image_name, infer_images_path)),
+                       sep=sep)
+    print(f'Inference results of the {num_process} shards merged at {path}')
+
+
+def _worker(rank: int,
+            shards: list[list[str]],
+            shards_filenames: list[str],
+            threads_per_process: int,
+            infer_fn: Callable[..., None],
+            kwargs: dict[str, Any]
+            ) -> None:
+    """
+    Entry point of each process: run the inference of its shard.
+    """
+    torch.set_num_threads(threads_per_process)
+    infer_fn(infer_images_path=shards[rank], filename=shards_filenames[rank], **kwargs)
+
+
+if __name__ == '__main__':
+    import yaml
+
+    logging_path = os.path.join('logs', 'resnet_img256_0')
+    datapath = os.path.join('data', 'images_to_predict')
+    config = EasyDict(yaml.safe_load(open(os.path.join(logging_path, 'config.yaml'))))
+
+    sharded_infer(infer_datapath=datapath,
+                  logging_path=logging_path,
+                  config=config,
+                  dstpath='',
+                  filename='inference_results.csv',
+                  num_process=2,
+                  plot_saliency=False)
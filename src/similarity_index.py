@@ -0,0 +1,566 @@
+import os
+import sys
+import math
+import numpy as np
+from tqdm import tqdm
+from easydict import EasyDict
+from os.path import dirname as up
+
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.dataloader.dataloader import DataGenerator
+from src.dataloader.labels import LABELS
+from src.model import finetune_resnet
+from src.infer_cache import get_file_hash
+from utils import utils
+
+
+INDEX_NAME = 'similarity_index.npz'
+EMBEDDINGS = ['features', 'fc1']
+
+
+class SimilarityIndex:
+    def __init__(self,
+                 dimension: int,
+                 embedding: str = 'features',
+                 model_key: str = ''
+                 ) -> None:
+        """
+        Index of the embeddings of reference images, to find the most similar references
+        of a query image (cosine similarity). The normalized vectors are stored in a
+        float16 matrix. Optionally, the index is split into inverted lists (IVF: a query
+        only scores the vectors of its nprobe closest lists) and the vectors are encoded
+        with a product quantizer (PQ: the candidates are scored with lookup tables, and
+        the best ones are re-ranked with their float16 vectors). New references can be
+        added at any time; they are assigned to the existing lists and encoded with the
+        existing quantizer.
+
+        Args:
+            dimension (int): The dimension of the vectors.
+            embedding (str, optional): The embedding of the model, in EMBEDDINGS:
+                'features' (the 512 pooled outputs of the resnet) or 'fc1'
+                (the hidden layer). Defaults to 'features'.
+            model_key (str, optional): Identify the model which gave the vectors.
+                Defaults to ''.
+
+        Raises:
+            ValueError: If embedding is not in EMBEDDINGS.
+        """
+        if embedding not in EMBEDDINGS:
+            raise ValueError(f'Expected embedding in {EMBEDDINGS} '
+                             f'but found {embedding}')
+        self.dimension = dimension
+        self.embedding = embedding
+        self.model_key = model_key
+
+        # the arrays have a capacity larger than the number of references, to add
+        # them quickly
+        self.size: int = 0
+        self.vectors = np.zeros((0, dimension), dtype=np.float16)
+        self.labels = np.zeros(0, dtype=np.int16)
+        self.paths: list[str] = []
+        self.path_indexes: dict[str, int] = {}
+
+        # (num_lists, dimension)
+        self.centroids: np.ndarray | None = None
+        self.list_ids = np.zeros(0, dtype=np.int32)
+        # (num_subquantizers, 256, dimension / num_subquantizers)
+        self.codebooks: np.ndarray | None = None
+        self.codes = np.zeros((0, 0), dtype=np.uint8)
+        self.trained_size: int = 0
+        self.is_sorted: bool = False
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.path_indexes
+
+    def add(self, vectors: np.ndarray, paths: list[str], labels: np.ndarray) -> int:
+        """
+        Add references (the paths already in the index are skipped).
+
+        Args:
+            vectors (np.ndarray): The embeddings with shape (B, dimension).
+            paths (list[str]): The paths of the images.
+            labels (np.ndarray): The labels of the images with shape (B).
+
+        Returns:
+            int: The number of added references.
+        """
+        is_new = [path not in self.path_indexes for path in paths]
+        vectors = normalize(np.asarray(vectors, dtype=np.float32)[is_new])
+        paths = [path for path, new in zip(paths, is_new) if new]
+        num_new = len(paths)
+        if num_new == 0:
+            return 0
+
+        start, stop = self.size, self.size + num_new
+        self.vectors = reserve(self.vectors, stop)
+        self.labels = reserve(self.labels, stop)
+        self.vectors[start: stop] = vectors
+        self.labels[start: stop] = np.asarray(labels)[is_new]
+        for i, path in enumerate(paths):
+            self.path_indexes[path] = start + i
+        self.paths += paths
+
+        if self.centroids is not None:
+            self.list_ids = reserve(self.list_ids, stop)
+            self.list_ids[start: stop] = np.argmax(vectors @ self.centroids.T, axis=1)
+            self.is_sorted = False
+        if self.codebooks is not None:
+            self.codes = reserve(self.codes, stop)
+            self.codes[start: stop] = encode(vectors, self.codebooks)
+        self.size = stop
+        return num_new
+
+    def train(self,
+              num_lists: int = 0,
+              num_subquantizers: int = 0,
+              num_iterations: int = 10,
+              sample_size: int = 65536
+              ) -> None:
+        """
+        Train the inverted lists and the product quantizer on the references
+        (k-means on a sample), and assign or encode all the references.
+
+        Args:
+            num_lists (int, optional): The number of inverted lists (0: no IVF).
+                Defaults to 0.
+            num_subquantizers (int, optional): The number of sub-vectors of the product
+                quantizer, which must divide the dimension (0: no PQ). Defaults to 0.
+            num_iterations (int, optional): The number of iterations of the k-means.
+                Defaults to 10.
+            sample_size (int, optional): The maximum number of references used by the
+                k-means. Defaults to 65536.
+
+        Raises:
+            ValueError: If num_subquantizers does not divide the dimension.
+        """
+        if num_subquantizers > 0 and self.dimension % num_subquantizers != 0:
+            raise ValueError(f'Expected num_subquantizers dividing {self.dimension} '
+                             f'but found {num_subquantizers}')
+
+        generator = np.random.default_rng(0)
+        sample = generator.choice(self.size,
+                                  size=min(self.size, sample_size),
+                                  replace=False)
+        sample_vectors = self.vectors[np.sort(sample)].astype(np.float32)
+
+        self.centroids, self.codebooks = None, None
+        if num_lists > 0:
+            centroids = kmeans(sample_vectors,
+                               min(num_lists, len(sample)),
+                               num_iterations=num_iterations,
+                               spherical=True)
+            self.centroids = normalize(centroids)
+            self.list_ids = np.zeros(self.size, dtype=np.int32)
+            for start in range(0, self.size, 65536):
+                chunk = self.vectors[start: start + 65536].astype(np.float32)
+                self.list_ids[start: start + 65536] = \
+                    np.argmax(chunk @ self.centroids.T, axis=1)
+            self.is_sorted = False
+
+        if num_subquantizers > 0:
+            sub_vectors = sample_vectors.reshape(len(sample), num_subquantizers, -1)
+            self.codebooks = np.stack([kmeans(sub_vectors[:, j], min(256, len(sample)),
+                                              num_iterations=num_iterations)
+                                       for j in range(num_subquantizers)])
+            self.codes = np.concatenate([
+                encode(self.vectors[start: start + 65536].astype(np.float32),
+                       self.codebooks)
+                for start in range(0, self.size, 65536)])
+        self.trained_size = self.size
+
+    def search(self,
+               queries: np.ndarray,
+               k: int = 10,
+               nprobe: int = 8,
+               rerank: int = 16
+               ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k most similar references of each query.
+
+        Args:
+            queries (np.ndarray): The embeddings of the queries with shape
+                (B, dimension).
+            k (int, optional): The number of neighbors. Defaults to 10.
+            nprobe (int, optional): The number of inverted lists scored per query
+                (with IVF). Defaults to 8.
+            rerank (int, optional): The k * rerank best candidates of the product
+                quantizer are re-ranked with their float16 vectors (with PQ).
+                Defaults to 16.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The cosine similarities (float32) and the
+                indexes (int64, -1 if there are less than k references) of the
+                neighbors, both with shape (B, k), from the most similar.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dimension)
+        queries = normalize(queries)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indexes = np.full((len(queries), k), -1, dtype=np.int64)
+        if self.size == 0:
+            return scores, indexes
+
+        if self.centroids is None and self.codebooks is None:
+            # exact search on all the references, by chunks of the float16 matrix
+            for start in range(0, self.size, 16384):
+                chunk = self.vectors[start: min(start + 16384, self.size)]
+                chunk_scores = queries @ chunk.astype(np.float32).T
+                chunk_indexes = start + np.arange(chunk_scores.shape[1])
+                scores, indexes = merge_topk(scores, indexes,
+                                             chunk_scores, chunk_indexes, k)
+            return scores, indexes
+
+        if self.centroids is not None and not self.is_sorted:
+            self.__sort_lists()
+        for i, query in enumerate(queries):
+            candidates = self.__get_candidates(query, nprobe=nprobe)
+            if self.codebooks is not None and len(candidates) > k * rerank:
+                num_subquantizers = len(self.codebooks)
+                lookup_tables = np.einsum('md,mcd->mc',
+                                          query.reshape(num_subquantizers, -1),
+                                          self.codebooks)
+                approximations = lookup_tables[np.arange(num_subquantizers),
+                                               self.codes[candidates]].sum(axis=1)
+                best = np.argpartition(-approximations, k * rerank)[:k * rerank]
+                candidates = candidates[best]
+            candidate_scores = self.vectors[candidates].astype(np.float32) @ query
+            scores[i: i + 1], indexes[i: i + 1] = merge_topk(scores[i: i + 1],
+                                                             indexes[i: i + 1],
+                                                             candidate_scores[None],
+                                                             candidates,
+                                                             k)
+        return scores, indexes
+
+    def get_neighbors(self,
+                      queries: np.ndarray,
+                      k: int = 10,
+                      nprobe: int = 8
+                      ) -> list[list[tuple[str, str, float]]]:
+        """
+        Find the k most similar references of each query (see search).
+
+        Args:
+            queries (np.ndarray): The embeddings of the queries with shape
+                (B, dimension).
+            k (int, optional): The number of neighbors. Defaults to 10.
+            nprobe (int, optional): The number of inverted lists scored per query.
+                Defaults to 8.
+
+        Returns:
+            list[list[tuple[str, str, float]]]: The (path, label, similarity) of the
+                neighbors of each query.
+        """
+        scores, indexes = self.search(queries, k=k, nprobe=nprobe)
+        return [[(self.paths[index], LABELS[self.labels[index]], score)
+                 for index, score in zip(row_indexes.tolist(), row_scores.tolist())
+                 if index >= 0]
+                for row_indexes, row_scores in zip(indexes, scores)]
+
+    def save(self, path: str) -> None:
+        """
+        Save the index (written in a temporary file first).
+
+        Args:
+            path (str): The path of the file (.npz).
+        """
+        arrays = {'vectors': self.vectors[:self.size],
+                  'labels': self.labels[:self.size],
+                  'paths': np.array(self.paths, dtype=str),
+                  'meta': np.array([self.embedding,
+                                    self.model_key,
+                                    str(self.trained_size)])}
+        if self.centroids is not None:
+            arrays.update(centroids=self.centroids, list_ids=self.list_ids[:self.size])
+        if self.codebooks is not None:
+            arrays.update(codebooks=self.codebooks, codes=self.codes[:self.size])
+        tmp_path = f'{path}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    def __get_candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """ Get the indexes of the references in the nprobe closest lists of a query """
+        if self.centroids is None:
+            return np.arange(self.size)
+        nprobe = min(nprobe, len(self.centroids))
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        return np.concatenate([self.order[self.offsets[i]: self.offsets[i + 1]]
+                               for i in lists])
+
+    def __sort_lists(self) -> None:
+        """ Group the indexes of the references by inverted list """
+        list_ids = self.list_ids[:self.size]
+        self.order = np.argsort(list_ids, kind='stable')
+        self.offsets = np.searchsorted(list_ids[self.order],
+                                       np.arange(len(self.centroids) + 1))
+        self.is_sorted = True
+
+
+def load_similarity_index(path: str) -> SimilarityIndex:
+    """
+    Load an index saved by SimilarityIndex.save.
+
+    Args:
+        path (str): The path of the file.
+
+    Raises:
+        FileNotFoundError: If the file does not exist.
+
+    Returns:
+        SimilarityIndex: The index.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} wasn't found, build it with: "
+                                f"python main.py --mode build-index --path <model>")
+    with np.load(path) as arrays:
+        embedding, model_key, trained_size = arrays['meta'].tolist()
+        index = SimilarityIndex(dimension=arrays['vectors'].shape[1],
+                                embedding=embedding,
+                                model_key=model_key)
+        index.size = len(arrays['vectors'])
+        index.vectors = arrays['vectors']
+        index.labels = arrays['labels']
+        index.paths = arrays['paths'].tolist()
+        index.path_indexes = {path: i for i, path in enumerate(index.paths)}
+        index.trained_size = int(trained_size)
+        if 'centroids' in arrays:
+            index.centroids = arrays['centroids']
+            index.list_ids = arrays['list_ids']
+        if 'codebooks' in arrays:
+            index.codebooks = arrays['codebooks']
+            index.codes = arrays['codes']
+    return index
+
+
+def build_index(config: EasyDict,
+                logging_path: str,
+                embedding: str = 'features',
+                num_subquantizers: int = 0,
+                ivf_min_size: int = 20000
+                ) -> SimilarityIndex:
+    """
+    Build or update the index of the labelled images (the train, val and test folders of
+    the lab and real data) of a model, in logging_path/similarity_index.npz. Only the
+    images which are not in the index go through the model. The inverted lists (4 *
+    sqrt(N) lists) are trained once the index has ivf_min_size references, and trained
+    again when it has grown 4 times since.
+
+    Args:
+        config (EasyDict): The configuration of the model.
+        logging_path (str): The log folder of the model.
+        embedding (str, optional): The embedding of the index, in EMBEDDINGS.
+            Defaults to 'features'.
+        num_subquantizers (int, optional): The number of sub-vectors of the product
+            quantizer (0: no PQ). Defaults to 0.
+        ivf_min_size (int, optional): The number of references from which the index uses
+            inverted lists. Defaults to 20000.
+
+    Returns:
+        SimilarityIndex: The index.
+    """
+    device = utils.get_device(device_config=config.learning.device)
+    model_key = get_file_hash(utils.get_weights_path(logging_path, model_name='res'))
+    index_path = os.path.join(logging_path, INDEX_NAME)
+
+    index = None
+    if os.path.exists(index_path):
+        index = load_similarity_index(index_path)
+        if index.model_key != model_key or index.embedding != embedding:
+            print('the index was built with another model or embedding: '
+                  'it is built again')
+            index = None
+    if index is None:
+        dimension = 512 if embedding == 'features' else config.model.resnet.hidden_size
+        index = SimilarityIndex(dimension=dimension,
+                                embedding=embedding,
+                                model_key=model_key)
+
+    model = finetune_resnet.get_finetuneresnet(config)
+    weight = utils.load_weights(logging_path, device=device, model_name='res')
+    model.load_dict_learnable_parameters(state_dict=weight, strict=True)
+    model = model.to(device)
+    model.eval()
+    del weight
+
+    data_paths = [(config.data.path, 'real' in config.data.path),
+                  (config.data.real_data_path, True)]
+    for data_path, is_real in data_paths:
+        for mode in ['train', 'val', 'test']:
+            folder = os.path.join(data_path, f'{mode}_{config.data.image_size}')
+            if not os.path.exists(folder):
+                continue
+            generator = DataGenerator(data_path=folder,
+                                      mode='test',
+                                      use_background=not is_real,
+                                      transforms=config.data.transforms)
+            # only the new images
+            generator.data = [item for item in generator.data if item[0] not in index]
+            if len(generator) == 0:
+                continue
+            dataloader = DataLoader(dataset=generator,
+                                    batch_size=config.test.batch_size,
+                                    shuffle=False,
+                                    num_workers=config.test.num_workers)
+            with torch.inference_mode():
+                for item in tqdm(dataloader, desc=f'Indexing {folder}'):
+                    features, intermediare, _ = \
+                        model.forward_and_get_features(item['image'].to(device))
+                    vectors = features if embedding == 'features' else intermediare
+                    index.add(vectors=vectors.cpu().numpy(),
+                              paths=[generator.data[i][0]
+                                     for i in item['index'].tolist()],
+                              labels=item['label'].numpy())
+
+    has_grown = len(index) >= 4 * index.trained_size
+    needs_ivf = len(index) >= ivf_min_size and (index.centroids is None or has_grown)
+    needs_pq = num_subquantizers > 0 and (index.codebooks is None or has_grown)
+    if needs_ivf or needs_pq:
+        num_lists = int(4 * math.sqrt(len(index))) if len(index) >= ivf_min_size else 0
+        index.train(num_lists=num_lists, num_subquantizers=num_subquantizers)
+
+    index.save(index_path)
+    print(f'Similarity index saved at {index_path} ({len(index)} references)')
+    return index
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """ Normalize the vectors (rows) to a unit L2 norm """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def reserve(array: np.ndarray, size: int) -> np.ndarray:
+    """ Get the array with a capacity of at least size rows (doubled if too small) """
+    if len(array) >= size:
+        return array
+    capacity = max(size, 2 * len(array), 1024)
+    output = np.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+    output[:len(array)] = array
+    return output
+
+
+def kmeans(vectors: np.ndarray,
+           num_clusters: int,
+           num_iterations: int = 10,
+           spherical: bool = False
+           ) -> np.ndarray:
+    """
+    Lloyd's k-means.
+
+    Args:
+        vectors (np.ndarray): The vectors with shape (N, d).
+        num_clusters (int): The number of clusters (<= N).
+        num_iterations (int, optional): The number of iterations. Defaults to 10.
+        spherical (bool, optional): Assign with the cosine similarity and normalize the
+            centroids. Defaults to False (euclidean distance).
+
+    Returns:
+        np.ndarray: The centroids with shape (num_clusters, d).
+    """
+    generator = np.random.default_rng(0)
+    sample = generator.choice(len(vectors), size=num_clusters, replace=False)
+    centroids = vectors[sample].copy()
+    for _ in range(num_iterations):
+        # argmin |x - c|^2 = argmax x.c - |c|^2 / 2
+        similarities = vectors @ centroids.T
+        if not spherical:
+            similarities -= (centroids ** 2).sum(axis=1) / 2
+        assignments = np.argmax(similarities, axis=1)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        # the empty clusters keep their centroid
+        is_filled = counts > 0
+        centroids[is_filled] = sums[is_filled] / counts[is_filled, None]
+        if spherical:
+            centroids = normalize(centroids)
+    return centroids
+
+
+def encode(vectors: np.ndarray, codebooks: np.ndarray) -> np.ndarray:
+    """
+    Encode the vectors with a product quantizer.
+
+    Args:
+        vectors (np.ndarray): The vectors with shape (N, d).
+        codebooks (np.ndarray): The codebooks with shape (m, 256, d / m).
+
+    Returns:
+        np.ndarray: The codes (uint8) with shape (N, m).
+    """
+    sub_vectors = vectors.reshape(len(vectors), len(codebooks), -1)
+    similarities = np.einsum('nmd,mcd->nmc', sub_vectors, codebooks) \
+        - (codebooks ** 2).sum(axis=-1) / 2
+    return np.argmax(similarities, axis=-1).astype(np.uint8)
+
+
+def merge_topk(scores: np.ndarray,
+               indexes: np.ndarray,
+               new_scores: np.ndarray,
+               new_indexes: np.ndarray,
+               k: int
+               ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Merge the current top-k with new candidates.
+
+    Args:
+        scores (np.ndarray): The current scores with shape (B, k).
+        indexes (np.ndarray): The current indexes with shape (B, k).
+        new_scores (np.ndarray): The scores of the candidates with shape (B, n).
+        new_indexes (np.ndarray): The indexes of the candidates with shape (n).
+        k (int): The number of neighbors.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The new top-k scores and indexes, from the
+            best.
+    """
+    all_scores = np.concatenate([scores, new_scores], axis=1)
+    new_indexes = np.broadcast_to(new_indexes, new_scores.shape)
+    all_indexes = np.concatenate([indexes, new_indexes], axis=1)
+    if all_scores.shape[1] > k:
+        best = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+    else:
+        best = np.broadcast_to(np.arange(all_scores.shape[1]), all_scores.shape)
+    best_scores = np.take_along_axis(all_scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    best = np.take_along_axis(best, order, axis=1)
+    return np.take_along_axis(all_scores, best, axis=1), \
+        np.take_along_axis(all_indexes, best, axis=1)
+
+
+if __name__ == '__main__':
+    import time
+
+    # clusters of clusters, like the embeddings of the images of several stains
+    num_references = 100000
+    generator = np.random.default_rng(0)
+    centers = generator.standard_normal((100, 512)).astype(np.float32)
+    centers = centers[generator.integers(100, size=5000)] \
+        + 0.5 * generator.standard_normal((5000, 512))
+    vectors = centers[generator.integers(5000, size=num_references)] \
+        + 0.3 * generator.standard_normal((num_references, 512))
+    queries = vectors[:20] + 0.1 * generator.standard_normal((20, 512))
+
+    index = SimilarityIndex(dimension=512)
+    index.add(vectors, paths=[f'image_{i}.jpg' for i in range(num_references)],
+              labels=generator.integers(len(LABELS), size=num_references))
+    start = time.perf_counter()
+    _, exact = index.search(queries, k=10)
+    duration = (time.perf_counter() - start) / len(queries) * 1000
+    print(f'exact search: {duration:.1f} ms per query')
+
+    for num_subquantizers in [0, 16]:
+        index.train(num_lists=int(4 * math.sqrt(num_references)),
+                    num_subquantizers=num_subquantizers)
+        start = time.perf_counter()
+        _, approximate = index.search(queries, k=10)
+        duration = (time.perf_counter() - start) / len(queries) * 1000
+        recall = np.mean([len(set(a) & set(e)) / 10
+                          for a, e in zip(approximate.tolist(), exact.tolist())])
+        print(f'IVF search ({num_subquantizers} subquantizers): '
+              f'{duration:.1f} ms per query, recall@10: {recall:.2f}')
@@ -0,0 +1,82 @@
+import os
+import sys
+from easydict import EasyDict
+from os.path import dirname as up
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.dataloader.stain_dataloader import create_stain_dataloader
+from src.tiled_infer import infer_crops
+
+
+def stain_infer(infer_datapath: str,
+                logging_path: str,
+                config: EasyDict,
+                dstpath: str,
+                filename: str,
+                mask_size: int = 256,
+                min_area: int = 16,
+                run_temperature_optimization: bool = True,
+                sep: str = ',',
+                save_class_maps: bool = True,
+                map_scale: int = 32
+                ) -> None:
+    """
+    Perform an inference on the stains of the images only: the stain regions are found
+    with a red mask at low resolution, cropped from the full resolution images and
+    classified in batches which mix the crops of several images (see
+    src.dataloader.stain_dataloader). The overall prediction of an image (mean of its
+    crops weighted by their area) is written in dstpath/filename like infer, with the
+    number of stains found in a 'Stains' column (0 when no stain is found: the whole
+    image is classified), and its class map has zeros outside of the stains (see
+    src.tiled_infer.infer_crops).
+
+    Args:
+        infer_datapath (str): The path to the inference data.
+        logging_path (str): The path to the logging directory.
+        config (EasyDict): The configuration object (most of times, in the
+            logging_path).
+        dstpath (str): The destination path for saving the inference results.
+        filename (str): The filename for saving the inference results.
+        mask_size (int, optional): The size of the longest side of the mask.
+            Defaults to 256.
+        min_area (int, optional): The minimum number of red pixels of a region in the
+            mask. Defaults to 16.
+        run_temperature_optimization (bool, optional): Whether to run temperature
+            optimization. Defaults to True.
+        sep (str, optional): The separator for saving the inference results.
+            Defaults to ','.
+        save_class_maps (bool, optional): Save the class map of each image.
+            Defaults to True.
+        map_scale (int, optional): The size of a cell of the class maps, in pixels.
+            Defaults to 32.
+    """
+    infer_crops(infer_datapath=infer_datapath,
+                logging_path=logging_path,
+                config=config,
+                dstpath=dstpath,
+                filename=filename,
+                get_dataloader=lambda data: create_stain_dataloader(config=config,
+                                                                    data=data,
+                                                                    mask_size=mask_size,
+                                                                    min_area=min_area),
+                run_name=f'stains-mask{mask_size}-area{min_area}',
+                run_temperature_optimization=run_temperature_optimization,
+                sep=sep,
+                save_class_maps=save_class_maps,
+                map_scale=map_scale,
+                regions_column='Stains')
+
+
+if __name__ == '__main__':
+    import yaml
+
+    logging_path = os.path.join('logs', 'resnet_img256_0')
+    datapath = os.path.join('data', 'images_to_predict')
+    config = EasyDict(yaml.safe_load(open(os.path.join(logging_path, 'config.yaml'))))
+
+    stain_infer(infer_datapath=datapath,
+                logging_path=logging_path,
+                config=config,
+                dstpath='',
+                filename='inference_results.csv')
@@ -1,5 +1,6 @@
 import os
 import sys
+import numpy as np
 from tqdm import tqdm
 from easydict import EasyDict
 from os.path import dirname as up
@@ -14,13 +15,16 @@ from src.dataloader.dataloader import create_dataloader
 from src.model import finetune_resnet
 from src.gradcam import GradCam
 from src.metrics.metrics import Metrics
+from src.metrics.perturbation_metrics import Perturbation_Metrics
 from utils import utils
 
 
 def test(config: EasyDict,
          logging_path: str,
          run_real_data: bool = False,
-         run_silancy_metrics: bool = False
+         run_silancy_metrics: bool = False,
+         run_perturbation_metrics: bool = False,
+         num_perturbation_steps: int = 20
          ) -> None:
     """
     Run the test on the model using the given configuration.
@@ -29,6 +33,13 @@ def test(config: EasyDict,
         config (EasyDict): The configuration object.
         logging_path (str): The path to the logging directory.
         run_real_data (bool, optional): Whether to run the test on real data. Defaults to False.
+        run_silancy_metrics (bool, optional): Whether to run the silancy metrics.
+            Defaults to False.
+        run_perturbation_metrics (bool, optional): Whether to run the deletion and
+            insertion metrics of the saliency maps (see
+            src.metrics.perturbation_metrics). Defaults to False.
+        num_perturbation_steps (int, optional): The number of steps of the deletion and
+            insertion curves. Defaults to 20.
     """
 
     device = utils.get_device(device_config=config.learning.device)
@@ -57,8 +68,12 @@ def test(config: EasyDict,
     metrics.to(device)
 
     # Get GradCam
-    if run_silancy_metrics:
+    if run_silancy_metrics or run_perturbation_metrics:
         gradcam = GradCam(model=model)
+    if run_perturbation_metrics:
+        perturbation_metrics = Perturbation_Metrics(model=model,
+                                                    num_steps=num_perturbation_steps)
+        all_auc: list[Tensor] = []
 
     test_loss = 0
     test_range = tqdm(test_generator)
@@ -85,6 +100,14 @@ def test(config: EasyDict,
             o_pred = gradcam.get_probability_with_mask(model=model, image=x)
             all_o_pred.append(o_pred.to(torch.device('cpu')))
 
+        if run_perturbation_metrics:
+            targets = y_pred.argmax(dim=1)
+            saliency = gradcam.get_low_resolution_cam(image=x, targets=targets)
+            auc = perturbation_metrics.compute(image=x,
+                                               saliency=saliency,
+                                               targets=targets)
+            all_auc.append(auc.to(torch.device('cpu')))
+
         current_loss = test_loss / (i + 1)
         test_range.set_description(f"TEST -> loss: {current_loss:.4f}")
         test_range.refresh()
@@ -105,13 +128,21 @@ def test(config: EasyDict,
     test_metrics = metrics.compute(y_pred=y_pred,
                                    y_true=y_true,
                                    o_pred=all_o_pred)
+    metrics_name = metrics.get_names()
     print(metrics.get_info(metrics_value=test_metrics))
 
+    if run_perturbation_metrics:
+        auc_values = torch.concat(all_auc, dim=0).mean(dim=0).numpy()
+        for name, value in zip(perturbation_metrics.get_metrics_name(), auc_values):
+            print(f'{name[:14]}\t: {value:.2f}')
+        metrics_name = metrics_name + perturbation_metrics.get_metrics_name()
+        test_metrics = np.concatenate((test_metrics, auc_values))
+
     if 'real' in config.data.path:
         run_real_data = True
     dst_file: str = 'test_log.txt' if not run_real_data else 'test_real_log.txt'
     
     test_logger(path=logging_path,
-                metrics=metrics.get_names(),
+                metrics=metrics_name,
                 values=test_metrics,
                 dst_test_name=dst_file)
\ No newline at end of file
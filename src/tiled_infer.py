@@ -0,0 +1,277 @@
+import os
+import sys
+import math
+import numpy as np
+from tqdm import tqdm
+from typing import Callable
+from easydict import EasyDict
+from os.path import dirname as up
+
+import torch
+from torch import Tensor
+from torch.utils.data import DataLoader
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.dataloader.labels import get_topk_arrays, get_topk_records, LABELS
+from src.dataloader.infer_dataloader import create_tile_dataloader, \
+    get_image_from_path, get_output_name
+from src.model import finetune_resnet
+from src.infer_cache import get_run_key
+from src.result_writer import ResultWriter
+from utils import utils
+
+
+class TileAggregator:
+    def __init__(self, num_classes: int, map_scale: int = 32) -> None:
+        """
+        Aggregate the probabilities of the crops (tiles or stain regions) of each image
+        into a spatial class map (the mean probability of the crops which cover each
+        cell, 0 where no crop was classified) and an overall prediction (the mean
+        probability of the crops, weighted by their area). The crops can come in any
+        order: an image is returned once all its crops are added, and the images are
+        returned in the order of their indexes.
+
+        Args:
+            num_classes (int): The number of classes.
+            map_scale (int, optional): The size of a cell of the class maps, in pixels.
+                Defaults to 32.
+        """
+        self.num_classes = num_classes
+        self.map_scale = map_scale
+        self.images: dict[int, dict[str, np.ndarray | int]] = {}
+        self.next_index: int = 0
+
+    def add(self, probabilities: np.ndarray, infos: np.ndarray) -> None:
+        """
+        Add the probabilities of a batch of crops.
+
+        Args:
+            probabilities (np.ndarray): The probabilities of the crops with shape
+                (N, num_classes).
+            infos (np.ndarray): The infos of the crops with shape (N, 8) or more: the
+                index of the image, the box (top, left, bottom, right) of the crop, the
+                number of crops of the image and the height and width of the image
+                (see TileDataGenerator). The other columns are ignored.
+        """
+        for probability, info in zip(probabilities, infos.tolist()):
+            index, top, left, bottom, right, num_crops, height, width = info[:8]
+            if index not in self.images:
+                map_size = (math.ceil(height / self.map_scale),
+                            math.ceil(width / self.map_scale))
+                self.images[index] = {'sum': np.zeros((self.num_classes, *map_size),
+                                                      dtype=np.float32),
+                                      'count': np.zeros(map_size, dtype=np.float32),
+                                      'total': np.zeros(self.num_classes,
+                                                        dtype=np.float64),
+                                      'area': 0,
+                                      'num_crops': num_crops,
+                                      'seen': 0}
+            image = self.images[index]
+            rows = slice(top // self.map_scale, math.ceil(bottom / self.map_scale))
+            cols = slice(left // self.map_scale, math.ceil(right / self.map_scale))
+            image['sum'][:, rows, cols] += probability[:, None, None]
+            image['count'][rows, cols] += 1
+            area = (bottom - top) * (right - left)
+            image['total'] += probability * area
+            image['area'] += area
+            image['seen'] += 1
+
+    def pop_completed(self) -> tuple[list[int], np.ndarray, list[np.ndarray]]:
+        """
+        Get the next images whose crops were all added.
+
+        Returns:
+            tuple[list[int], np.ndarray, list[np.ndarray]]: The indexes of the images,
+                their overall probabilities with shape (N, num_classes), and their class
+                maps with shape (num_classes, h, w).
+        """
+        indexes, probabilities, class_maps = [], [], []
+        while (image := self.images.get(self.next_index)) is not None \
+                and image['seen'] == image['num_crops']:
+            del self.images[self.next_index]
+            indexes.append(self.next_index)
+            probabilities.append(image['total'] / image['area'])
+            class_maps.append(image['sum'] / np.maximum(image['count'], 1))
+            self.next_index += 1
+        probabilities = np.array(probabilities, dtype=np.float32)
+        probabilities = probabilities.reshape(-1, self.num_classes)
+        return indexes, probabilities, class_maps
+
+
+def tiled_infer(infer_datapath: str,
+                logging_path: str,
+                config: EasyDict,
+                dstpath: str,
+                filename: str,
+                stride: int,
+                run_temperature_optimization: bool = True,
+                sep: str = ',',
+                save_class_maps: bool = True,
+                map_scale: int = 32
+                ) -> None:
+    """
+    Perform a sliding-window inference on high resolution images: each image is cut into
+    overlapping tiles of config.data.image_size pixels at its native resolution, the
+    tiles of all the images are batched together through the model, and the
+    probabilities of the tiles are aggregated into an overall prediction per image
+    (written in dstpath/filename like infer) and a spatial class map (see infer_crops).
+
+    Args:
+        infer_datapath (str): The path to the inference data.
+        logging_path (str): The path to the logging directory.
+        config (EasyDict): The configuration object (most of times, in the
+            logging_path).
+        dstpath (str): The destination path for saving the inference results.
+        filename (str): The filename for saving the inference results.
+        stride (int): The distance between two neighbouring tiles, in pixels.
+        run_temperature_optimization (bool, optional): Whether to run temperature
+            optimization. Defaults to True.
+        sep (str, optional): The separator for saving the inference results.
+            Defaults to ','.
+        save_class_maps (bool, optional): Save the class map of each image.
+            Defaults to True.
+        map_scale (int, optional): The size of a cell of the class maps, in pixels.
+            Defaults to 32.
+    """
+    infer_crops(infer_datapath=infer_datapath,
+                logging_path=logging_path,
+                config=config,
+                dstpath=dstpath,
+                filename=filename,
+                get_dataloader=lambda data: create_tile_dataloader(config=config,
+                                                                   data=data,
+                                                                   stride=stride),
+                run_name=f'tiled-stride{stride}',
+                run_temperature_optimization=run_temperature_optimization,
+                sep=sep,
+                save_class_maps=save_class_maps,
+                map_scale=map_scale)
+
+
+def infer_crops(infer_datapath: str,
+                logging_path: str,
+                config: EasyDict,
+                dstpath: str,
+                filename: str,
+                get_dataloader: Callable[[list[str]], DataLoader],
+                run_name: str,
+                run_temperature_optimization: bool = True,
+                sep: str = ',',
+                save_class_maps: bool = True,
+                map_scale: int = 32,
+                regions_column: str | None = None
+                ) -> None:
+    """
+    Classify the crops of the images given by a dataloader, whose batches mix the crops
+    of several images, and aggregate them per image with a TileAggregator. The overall
+    prediction of each image is written in dstpath/filename like infer (an interrupted
+    run is resumed, see src.result_writer).
+
+    Args:
+        infer_datapath (str): The path to the inference data.
+        logging_path (str): The path to the logging directory.
+        config (EasyDict): The configuration object (most of times, in the
+            logging_path).
+        dstpath (str): The destination path for saving the inference results.
+        filename (str): The filename for saving the inference results.
+        get_dataloader (Callable[[list[str]], DataLoader]): Create the dataloader of the
+            crops of a list of images, yielding (crops, infos) (see TileDataGenerator).
+        run_name (str): Identify the crops and their options, e.g. 'tiled-stride128'.
+        run_temperature_optimization (bool, optional): Whether to run temperature
+            optimization. Defaults to True.
+        sep (str, optional): The separator for saving the inference results.
+            Defaults to ','.
+        save_class_maps (bool, optional): Save the class map of each image in
+            dstpath/class_maps/<image>_class_map.npy (float16 with shape
+            (num_classes, h, w)). Defaults to True.
+        map_scale (int, optional): The size of a cell of the class maps, in pixels.
+            Defaults to 32.
+        regions_column (str | None, optional): The name of a column with the number of
+            regions of each image, given by the 9th value of the infos of the dataloader
+            (e.g. 'Stains', see StainCropDataGenerator). Defaults to None (no column).
+    """
+    device = utils.get_device(device_config=config.learning.device)
+    if device.type == 'cpu':
+        config.test.batch_size = 32
+
+    infer_images_path = get_image_from_path(infer_datapath)
+    get_image_name: Callable[[str], str] = \
+        lambda img_name: utils.get_relatif_image_path(img_name, infer_datapath)
+    temperature: float = 1.5 if run_temperature_optimization else 1
+
+    if save_class_maps:
+        class_maps_path = os.path.join(dstpath, 'class_maps')
+        os.makedirs(class_maps_path, exist_ok=True)
+    class_map_name: Callable[[str], str] = \
+        lambda img_name: get_output_name(get_image_name(img_name)) + '_class_map.npy'
+
+    checkpoint_path = utils.get_weights_path(logging_path, model_name='res')
+    run_key = get_run_key(checkpoint_path=checkpoint_path,
+                          image_size=config.data.image_size,
+                          temperature=temperature,
+                          saliency_mode=f'{run_name}-scale{map_scale}')
+    writer = ResultWriter(path=os.path.join(dstpath, filename),
+                          run_key=run_key,
+                          k=3,
+                          sep=sep,
+                          extra_columns=[regions_column]
+                          if regions_column is not None else None)
+    pending = [image_path for image_path in infer_images_path
+               if get_image_name(image_path) not in writer.image_names]
+
+    if pending != []:
+        infer_dataloader = get_dataloader(pending)
+
+        # Get model
+        model = finetune_resnet.get_finetuneresnet(config)
+        weight = utils.load_weights(logging_path, device=device, model_name='res')
+        model.load_dict_learnable_parameters(state_dict=weight, strict=True)
+        model = model.to(device)
+        model.eval()
+        del weight
+
+        aggregator = TileAggregator(num_classes=len(LABELS), map_scale=map_scale)
+        num_regions: dict[int, int] = {}
+        for crops, infos in tqdm(infer_dataloader, desc='Infering crops'):
+            if regions_column is not None:
+                num_regions.update(zip(infos[:, 0].tolist(), infos[:, 8].tolist()))
+            crops: Tensor = crops.to(device)
+            with torch.inference_mode():
+                y_pred = model.forward(crops)
+                probabilities = torch.nn.functional.softmax(y_pred / temperature,
+                                                            dim=-1).cpu().numpy()
+            aggregator.add(probabilities, infos.numpy())
+
+            indexes, image_probabilities, class_maps = aggregator.pop_completed()
+            if indexes == []:
+                continue
+            images_paths = [pending[i] for i in indexes]
+            # the class maps are saved before the rows: a written row has its map
+            if save_class_maps:
+                for image_path, class_map in zip(images_paths, class_maps):
+                    np.save(os.path.join(class_maps_path, class_map_name(image_path)),
+                            class_map.astype(np.float16))
+            topk_indices, topk_values = get_topk_arrays(
+                torch.from_numpy(image_probabilities), k=3)
+            writer.write(list(map(get_image_name, images_paths)),
+                         get_topk_records(topk_indices, topk_values),
+                         extra_values=[[str(num_regions.pop(i))] for i in indexes]
+                         if regions_column is not None else None)
+
+    writer.close()
+
+
+if __name__ == '__main__':
+    import yaml
+
+    logging_path = os.path.join('logs', 'resnet_img256_0')
+    datapath = os.path.join('data', 'images_to_predict')
+    config = EasyDict(yaml.safe_load(open(os.path.join(logging_path, 'config.yaml'))))
+
+    tiled_infer(infer_datapath=datapath,
+                logging_path=logging_path,
+                config=config,
+                dstpath='',
+                filename='inference_results.csv',
+                stride=128)
@@ -0,0 +1,134 @@
+import os
+import socket
+import numpy as np
+from typing import Any, Callable, Iterator
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn import Parameter
+
+
+def launch(train_fn: Callable[..., Any],
+           world_size: int,
+           threads_per_process: int = None,
+           **kwargs: Any
+           ) -> None:
+    """
+    Launch a CPU data-parallel training with world_size local processes (gloo backend).
+    Each process calls train_fn(**kwargs, rank=rank, world_size=world_size).
+
+    Args:
+        train_fn (Callable[..., Any]): The training function (must accept rank and
+            world_size), e.g. train_resnet.train which returns the logging path.
+        world_size (int): The number of processes.
+        threads_per_process (int, optional): The number of torch threads of each
+            process. Defaults to None (the cpu count divided by world_size).
+        **kwargs (Any): The arguments given to train_fn.
+
+    Raises:
+        ValueError: If world_size is lower than 1.
+    """
+    if world_size < 1:
+        raise ValueError(f'Expected world_size >= 1 but found {world_size}')
+
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or 1) // world_size)
+
+    master_port = os.environ.get('MASTER_PORT', str(get_free_port()))
+    print(f'launch {world_size} processes with {threads_per_process} threads each')
+    mp.spawn(_worker,
+             args=(world_size, master_port, threads_per_process, train_fn, kwargs),
+             nprocs=world_size,
+             join=True)
+
+
+def _worker(rank: int,
+            world_size: int,
+            master_port: str,
+            threads_per_process: int,
+            train_fn: Callable[..., Any],
+            kwargs: dict[str, Any]
+            ) -> None:
+    """
+    Entry point of each process: init the process group, run the training and clean up.
+    """
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = master_port
+    torch.set_num_threads(threads_per_process)
+    dist.init_process_group(backend='gloo', rank=rank, world_size=world_size)
+    try:
+        train_fn(**kwargs, rank=rank, world_size=world_size)
+    finally:
+        dist.destroy_process_group()
+
+
+def get_free_port() -> int:
+    """
+    Get a free port on the local machine.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def broadcast_parameters(parameters: Iterator[Parameter], src: int = 0) -> None:
+    """
+    Copy the parameters of the process src into all the other processes.
+
+    Args:
+        parameters (Iterator[Parameter]): The parameters to broadcast.
+        src (int, optional): The rank of the process which sends its parameters.
+            Defaults to 0.
+    """
+    with torch.no_grad():
+        for param in parameters:
+            dist.broadcast(param.data, src=src)
+
+
+def all_reduce_gradients(parameters: Iterator[Parameter], world_size: int) -> None:
+    """
+    Average the gradients of the parameters over all processes.
+    All the gradients are flattened into one buffer to do a single all-reduce.
+
+    Args:
+        parameters (Iterator[Parameter]): The learnable parameters.
+        world_size (int): The number of processes.
+    """
+    grads = [param.grad for param in parameters if param.grad is not None]
+    if grads == []:
+        return None
+
+    buffer = torch.cat([grad.flatten() for grad in grads])
+    dist.all_reduce(buffer, op=dist.ReduceOp.SUM)
+    buffer /= world_size
+
+    offset = 0
+    for grad in grads:
+        numel = grad.numel()
+        grad.copy_(buffer[offset: offset + numel].view_as(grad))
+        offset += numel
+    return None
+
+
+def all_reduce_sum(values: np.ndarray) -> np.ndarray:
+    """
+    Sum a numpy array over all processes.
+
+    Args:
+        values (np.ndarray): The values of the current process.
+
+    Returns:
+        np.ndarray: The sum of the values of all processes.
+    """
+    tensor = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.numpy()
+
+
+def barrier(world_size: int) -> None:
+    """
+    Wait for all processes (do nothing if there is only one process).
+    """
+    if world_size > 1:
+        dist.barrier()
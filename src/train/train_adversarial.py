@@ -20,13 +20,17 @@ from src.model import finetune_resnet, adversarial
 from utils import utils, plot_learning_curves
 
 
-def train(config: EasyDict, logspath: str = 'logs') -> None:
+def train(config: EasyDict, logspath: str = 'logs') -> str | None:
     """
     Train the adversarial model.
 
     Args:
         config (EasyDict): Configuration object containing the model and training parameters.
         logspath (str, optional): The path to the logs directory. Defaults to 'logs'.
+
+    Returns:
+        str | None: The logging path of the experiment (None if the experiment is not
+            saved).
     
     Raises:
         ValueError: If the model name is not adversarial.
@@ -194,6 +198,8 @@ def train(config: EasyDict, logspath: str = 'logs') -> None:
     if save_experiment:
         plot_learning_curves.save_learning_curves(path=logging_path)
 
+    return logging_path if save_experiment else None
+
 
 if __name__ == '__main__':
     import yaml
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import numpy as np
 from tqdm import tqdm
 from easydict import EasyDict
 from os.path import dirname as up
@@ -11,20 +12,34 @@ sys.path.append(up(up(up(os.path.abspath(__file__)))))
 
 from config.utils import train_step_logger, train_logger
 from src.dataloader.dataloader import create_dataloader
+from src.dataloader.sampler import LossBasedSampler
+from src.train import distributed
 from src.metrics.metrics import Metrics
 from src.model import finetune_resnet
 from utils import utils, plot_learning_curves
 
 
 def train(config: EasyDict,
-          logspath: str = 'logs'
-          ) -> None:
+          logspath: str = 'logs',
+          rank: int = 0,
+          world_size: int = 1
+          ) -> str | None:
     """
     Train the ResNet model.
+    If world_size > 1, this function must be run in each process of an initialized gloo
+    process group (see src.train.distributed.launch): each rank trains on its own data
+    shard, the gradients of the learnable parameters are averaged, and only the rank 0
+    logs and saves the checkpoint.
 
     Args:
         config (EasyDict): The configuration object containing the model and training parameters.
         logspath (str, optional): The path to the logs directory. Defaults to 'logs'.
+        rank (int, optional): The rank of the current process. Defaults to 0.
+        world_size (int, optional): The number of processes. Defaults to 1.
+
+    Returns:
+        str | None: The logging path of the experiment (None if the experiment is not
+            saved).
 
     Raises:
         ValueError: If the model name in the config is not 'resnet'.
@@ -32,11 +47,17 @@ def train(config: EasyDict,
     if config.model.name != 'resnet':
         raise ValueError(f"Expected model.name=resnet but found {config.model.name}.")
     
+    is_distributed = world_size > 1
+    is_main_process = rank == 0
     device = utils.get_device(device_config=config.learning.device)
+    if is_distributed:
+        device = torch.device('cpu')
 
     # Get data
-    train_generator = create_dataloader(config=config, mode='train')
-    val_generator = create_dataloader(config=config, mode='val')
+    train_generator = create_dataloader(config=config, mode='train',
+                                        num_replicas=world_size, rank=rank)
+    val_generator = create_dataloader(config=config, mode='val',
+                                      num_replicas=world_size, rank=rank)
     n_train, n_val = len(train_generator), len(val_generator) 
     print(f"Found {n_train} training batches and {n_val} validation batches")
 
@@ -45,9 +66,17 @@ def train(config: EasyDict,
     utils.resume_training(config=config, model=model)
     model = model.to(device)
     print(f"number of trainable parameters {model.get_number_learnable_parameters()}")
+    if is_distributed:
+        distributed.broadcast_parameters(model.get_learned_parameters())
 
     # Loss
     criterion = torch.nn.CrossEntropyLoss(reduction='mean')
+    sample_criterion = torch.nn.CrossEntropyLoss(reduction='none')
+
+    # Data pruning
+    sampler: LossBasedSampler | None = None
+    if isinstance(train_generator.sampler, LossBasedSampler):
+        sampler = train_generator.sampler
 
     # Optimizer
     # optimizer: torch.optim = None
@@ -66,7 +95,7 @@ def train(config: EasyDict,
     metrics.to(device)
 
     # Save experiment
-    save_experiment = config.learning.save_experiment
+    save_experiment = config.learning.save_experiment and is_main_process
     print(f'{save_experiment = }')
     if save_experiment:
         if 'real' not in config.data.path:
@@ -90,7 +119,17 @@ def train(config: EasyDict,
         print("epoch: ", epoch)
         train_loss = 0
         train_metrics = metrics.init_metrics()
-        train_range = tqdm(train_generator)
+
+        if sampler is not None:
+            sampler.set_epoch(epoch)
+            print(f'data pruning: {sampler.get_ratio() * 100:.0f}% of the training set')
+
+        if is_distributed:
+            train_generator.sampler.set_epoch(epoch)
+
+        n_train = max(len(train_generator), 1)
+
+        train_range = tqdm(train_generator, disable=not is_main_process)
 
         # Training
         model.train()
@@ -98,9 +137,18 @@ def train(config: EasyDict,
             x = item['image'].to(device)        # x shape: torch.Size([32, 3, 256, 256])
             y_true = item['label'].to(device)   # y_true shape: torch.Size([32])
             y_pred = model.forward(x)           # y_pred shape: torch.Size([32, 2])
-            loss = criterion(y_pred, y_true)
+
+            if sampler is not None:
+                sample_loss = sample_criterion(y_pred, y_true)
+                sampler.update(indexes=item['index'], losses=sample_loss)
+                loss = sample_loss.mean()
+            else:
+                loss = criterion(y_pred, y_true)
 
             loss.backward()
+            if is_distributed:
+                distributed.all_reduce_gradients(model.get_learned_parameters(),
+                                                 world_size=world_size)
             optimizer.step()
             optimizer.zero_grad()
 
@@ -111,9 +159,15 @@ def train(config: EasyDict,
             train_range.set_description(f"TRAIN -> epoch: {epoch} || loss: {current_loss:.4f}")
             train_range.refresh()
 
+        if is_distributed:
+            train_loss, train_metrics, n_train = reduce_scores(train_loss,
+                                                               train_metrics,
+                                                               n_train)
+
         train_loss = train_loss / n_train
         train_metrics = train_metrics / n_train
-        print(metrics.get_info(metrics_value=train_metrics))
+        if is_main_process:
+            print(metrics.get_info(metrics_value=train_metrics))
 
         ###############################################################
         # Start Validation                                            #
@@ -121,7 +175,7 @@ def train(config: EasyDict,
 
         val_loss = 0
         val_metrics = metrics.init_metrics()
-        val_range = tqdm(val_generator)
+        val_range = tqdm(val_generator, disable=not is_main_process)
 
         model.eval()
 
@@ -142,9 +196,14 @@ def train(config: EasyDict,
                 val_range.set_description(f"VAL   -> epoch: {epoch} || loss: {current_loss:.4f}")
                 val_range.refresh()
 
+        n_val = len(val_generator)
+        if is_distributed:
+            val_loss, val_metrics, n_val = reduce_scores(val_loss, val_metrics, n_val)
+
         val_loss = val_loss / n_val
         val_metrics = val_metrics / n_val   
-        print(metrics.get_info(metrics_value=val_metrics))
+        if is_main_process:
+            print(metrics.get_info(metrics_value=val_metrics))
 
         ###################################################################
         # Save Scores in logs                                             #
@@ -173,6 +232,30 @@ def train(config: EasyDict,
     if save_experiment and config.learning.plot_learning_curves:
         plot_learning_curves.save_learning_curves(path=logging_path)
 
+    distributed.barrier(world_size)
+    return logging_path if save_experiment else None
+
+
+def reduce_scores(loss: float,
+                  metrics_value: np.ndarray,
+                  num_batches: int
+                  ) -> tuple[float, np.ndarray, int]:
+    """
+    Sum the loss, the metrics and the number of batches over all processes.
+
+    Args:
+        loss (float): The sum of the losses of the current process.
+        metrics_value (np.ndarray): The sum of the metrics of the current process.
+        num_batches (int): The number of batches seen by the current process.
+
+    Returns:
+        tuple[float, np.ndarray, int]: The loss, the metrics and the number of batches
+            summed over all processes.
+    """
+    values = np.concatenate((np.array([loss, num_batches]), metrics_value))
+    values = distributed.all_reduce_sum(values)
+    return values[0], values[2:], int(values[1])
+
 
 if __name__ == '__main__':
     import yaml
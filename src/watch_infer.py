@@ -0,0 +1,417 @@
+import os
+import sys
+import time
+import queue
+import signal
+import sqlite3
+import threading
+from typing import Any, Callable
+from os.path import dirname as up
+
+import torch
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.dataloader.labels import get_topk_arrays, get_topk_records
+from src.dataloader.infer_dataloader import get_image_from_path, get_output_name
+from src.predictor import Predictor, INTERACTIVE
+from src.gradcam import get_saliency, upsample_cam
+from src.saliency_writer import SaliencyWriter
+from src.infer_cache import get_run_key
+from src.result_writer import ResultWriter
+from utils import utils
+
+
+WATCH_STATE_NAME = 'watch_state.sqlite'
+
+# status of a file in the state: classified (its saliency map is pending), done, or
+# failed (could not be decoded, tried again at the next polls until max_attempts)
+CLASSIFIED = 'classified'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WatchState:
+    def __init__(self, path: str, run_key: str) -> None:
+        """
+        Persistent state of the watched files (sqlite file), so a restarted daemon does
+        not classify the same files again. A file is identified by its name, its size
+        and its modification time: a replaced file is classified again. The entries of
+        another run_key (another model) are ignored.
+
+        Args:
+            path (str): The path of the state file (created if it does not exist).
+            run_key (str): Identify the model and the options (see
+                src.infer_cache.get_run_key).
+        """
+        self.run_key = run_key
+        # used by the polling thread and the saliency thread
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                'name TEXT PRIMARY KEY, '
+                                'size INTEGER NOT NULL, '
+                                'mtime REAL NOT NULL, '
+                                'run_key TEXT NOT NULL, '
+                                'status TEXT NOT NULL, '
+                                'attempts INTEGER NOT NULL)')
+        self.connection.commit()
+
+    def get(self) -> dict[str, tuple[int, float, str, int]]:
+        """
+        Get the files of the run.
+
+        Returns:
+            dict[str, tuple[int, float, str, int]]: The size, modification time, status
+                and number of attempts of each file name.
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT name, size, mtime, status, attempts '
+                                           'FROM files WHERE run_key = ?',
+                                           (self.run_key,)).fetchall()
+        return {name: (size, mtime, status, attempts)
+                for name, size, mtime, status, attempts in rows}
+
+    def set(self, entries: list[tuple[str, int, float, str, int]]) -> None:
+        """
+        Set the state of files.
+
+        Args:
+            entries (list[tuple[str, int, float, str, int]]): The name, size,
+                modification time, status and number of attempts of each file.
+        """
+        with self.lock:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files '
+                '(name, size, mtime, run_key, status, attempts) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(name, size, mtime, self.run_key, status, attempts)
+                 for name, size, mtime, status, attempts in entries])
+            self.connection.commit()
+
+    def set_status(self, name: str, status: str) -> None:
+        """
+        Set the status of a file.
+
+        Args:
+            name (str): The name of the file.
+            status (str): The new status.
+        """
+        with self.lock:
+            self.connection.execute('UPDATE files SET status = ? '
+                                    'WHERE name = ? AND run_key = ?',
+                                    (status, name, self.run_key))
+            self.connection.commit()
+
+    def close(self) -> None:
+        """
+        Close the state file.
+        """
+        self.connection.close()
+
+    def __enter__(self) -> 'WatchState':
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.close()
+
+
+class SaliencyLane:
+    def __init__(self,
+                 predictor: Predictor,
+                 state: WatchState,
+                 dstpath: str,
+                 method: str = 'gradcam',
+                 smooth: str = 'full'
+                 ) -> None:
+        """
+        Lower priority lane of the saliency maps: a background thread computes the maps
+        of the classified images one by one, only while no batch is being classified
+        (see idle), so the saliency maps never delay the classification of new images. A
+        file is marked as done in the state once its map is computed.
+
+        Args:
+            predictor (Predictor): The predictor which keeps the model.
+            state (WatchState): The state of the watched files.
+            dstpath (str): The folder of the saliency maps.
+            method (str, optional): The saliency method, 'gradcam' or 'fastcam'.
+                Defaults to 'gradcam'.
+            smooth (str, optional): The smoothing preset of gradcam. Defaults to 'full'.
+        """
+        self.predictor = predictor
+        self.state = state
+        self.saliency = get_saliency(model=predictor.model,
+                                     method=method,
+                                     smooth=smooth)
+        self.saliency_writer = SaliencyWriter(dstpath=dstpath)
+        # set when no batch is being classified
+        self.idle = threading.Event()
+        self.idle.set()
+        self.queue: queue.Queue[tuple[str, str, str] | None] = queue.Queue()
+        self.is_running = True
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def submit(self, name: str, image_path: str, filename: str) -> None:
+        """
+        Queue the saliency map of an image (the image is loaded again when its turn
+        comes).
+
+        Args:
+            name (str): The name of the image in the state.
+            image_path (str): The path of the image.
+            filename (str): The filename of the saliency map.
+        """
+        self.queue.put((name, image_path, filename))
+
+    def close(self) -> None:
+        """
+        Stop the thread after the running map (the other images stay classified in the
+        state, their maps are computed after a restart).
+        """
+        self.is_running = False
+        self.queue.put(None)
+        self.thread.join()
+        self.saliency_writer.close()
+
+    def __run(self) -> None:
+        """ Compute the saliency maps until the lane is closed """
+        while (item := self.queue.get()) is not None:
+            self.idle.wait()
+            if not self.is_running:
+                break
+            name, image_path, filename = item
+            try:
+                x = self.predictor.load_image(image_path).unsqueeze(0)
+                x = x.to(self.predictor.device)
+                with self.predictor.model_lock:
+                    cam = self.saliency.get_low_resolution_cam(image=x)
+                grayscale_cam = upsample_cam(cam, size=x.shape[-2:]).cpu().numpy()
+                visualizations = self.saliency.get_visualizations(
+                    image=x, grayscale_cam=grayscale_cam)
+                self.saliency_writer.write(visualizations=visualizations,
+                                           filenames=[filename])
+                self.state.set_status(name, DONE)
+            except Exception as error:
+                # e.g. the image was deleted, the map is tried again after a restart
+                print(f'the saliency map of {image_path} failed: {error}')
+
+
+def watch_infer(watch_path: str,
+                logging_path: str,
+                dstpath: str,
+                filename: str,
+                plot_saliency: bool = True,
+                saliency_method: str = 'gradcam',
+                saliency_smooth: str = 'full',
+                poll_interval: float = 5,
+                settle_time: float = 2,
+                batch_size: int = 16,
+                max_attempts: int = 3,
+                sep: str = ',',
+                stop_event: threading.Event | None = None
+                ) -> None:
+    """
+    Daemon which watches a folder (and its sub folders) and classifies the new images as
+    they arrive, with the model kept in memory (see src.predictor). The folder is polled
+    every poll_interval seconds; a file is classified once its size and modification
+    time did not change between two polls and for settle_time seconds (a file being
+    copied is not read). The new images are classified by batches and appended to
+    dstpath/filename, and their saliency maps are computed on a lower priority lane
+    (see SaliencyLane). A replaced file (same name, new size or modification time) is
+    classified again: its new row is appended with 'yes' in the 'Replaced' column, and
+    the last row of a name is its current result. The processed files are recorded in
+    dstpath/watch_state.sqlite, so a restarted daemon goes on where it stopped. It runs
+    until Ctrl+C, SIGTERM or stop_event.
+
+    Args:
+        watch_path (str): The watched folder.
+        logging_path (str): The path to the logging directory.
+        dstpath (str): The destination path for saving the inference results.
+        filename (str): The filename for saving the inference results.
+        plot_saliency (bool, optional): Compute the saliency maps. Defaults to True.
+        saliency_method (str, optional): The saliency method, 'gradcam' or 'fastcam'.
+            Defaults to 'gradcam'.
+        saliency_smooth (str, optional): The smoothing preset of gradcam.
+            Defaults to 'full'.
+        poll_interval (float, optional): The time between two polls, in seconds.
+            Defaults to 5.
+        settle_time (float, optional): The time since the last modification of a file
+            before it is read, in seconds. Defaults to 2.
+        batch_size (int, optional): The maximum number of images in a batch.
+            Defaults to 16.
+        max_attempts (int, optional): The number of polls a file which can't be decoded
+            is tried (e.g. a partial copy) before it is ignored until it changes.
+            Defaults to 3.
+        sep (str, optional): The separator for saving the inference results.
+            Defaults to ','.
+        stop_event (threading.Event | None, optional): Stop the daemon when it is set.
+            Defaults to None (Ctrl+C only).
+    """
+    stop_event = threading.Event() if stop_event is None else stop_event
+    if threading.current_thread() is threading.main_thread():
+        # a service manager stops the daemon with SIGTERM
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    os.makedirs(dstpath, exist_ok=True)
+    predictor = Predictor(logging_path=logging_path, max_batch_size=batch_size)
+    checkpoint_path = utils.get_weights_path(logging_path, model_name='res')
+    run_key = get_run_key(checkpoint_path=checkpoint_path,
+                          image_size=predictor.config.data.image_size,
+                          temperature=predictor.temperature,
+                          saliency_mode='watch')
+    writer = ResultWriter(path=os.path.join(dstpath, filename),
+                          run_key=run_key,
+                          k=3,
+                          sep=sep,
+                          extra_columns=['Replaced'],
+                          append=True)
+    state = WatchState(path=os.path.join(dstpath, WATCH_STATE_NAME), run_key=run_key)
+
+    get_image_name: Callable[[str], str] = \
+        lambda img_name: utils.get_relatif_image_path(img_name, watch_path)
+    saliency_fun_name: Callable[[str], str] = \
+        lambda img_name: get_output_name(get_image_name(img_name)) + '_saliency.png'
+    if plot_saliency:
+        lane = SaliencyLane(predictor=predictor,
+                            state=state,
+                            dstpath=os.path.join(dstpath, 'saliency_maps'),
+                            method=saliency_method,
+                            smooth=saliency_smooth)
+        # the saliency maps which were pending when the daemon stopped
+        names = {name for name, (_, _, status, _) in state.get().items()
+                 if status == CLASSIFIED}
+        for image_path in get_image_from_path(watch_path):
+            if get_image_name(image_path) in names:
+                lane.submit(get_image_name(image_path),
+                            image_path,
+                            saliency_fun_name(image_path))
+
+    # the size and modification time of the files at the previous poll
+    previous: dict[str, tuple[int, float]] = {}
+    # the classified files wait for their saliency maps
+    status = CLASSIFIED if plot_saliency else DONE
+    print(f'Watching {watch_path} every {poll_interval} s (Ctrl+C to stop)')
+    try:
+        while not stop_event.is_set():
+            known = state.get()
+            ready: list[tuple[str, int, float]] = []
+            current: dict[str, tuple[int, float]] = {}
+            for image_path in get_image_from_path(watch_path):
+                try:
+                    stat = os.stat(image_path)
+                except FileNotFoundError:
+                    continue
+                current[image_path] = (stat.st_size, stat.st_mtime)
+                entry = known.get(get_image_name(image_path))
+                if entry is not None and entry[:2] == current[image_path] \
+                        and (entry[2] != FAILED or entry[3] >= max_attempts):
+                    continue
+                is_settled = previous.get(image_path) == current[image_path] \
+                    and time.time() - stat.st_mtime >= settle_time
+                if is_settled:
+                    ready.append((image_path, *current[image_path]))
+            previous = current
+
+            for start in range(0, len(ready), batch_size):
+                if plot_saliency:
+                    lane.idle.clear()
+                try:
+                    classified = classify_batch(files=ready[start: start + batch_size],
+                                                predictor=predictor,
+                                                writer=writer,
+                                                state=state,
+                                                known=known,
+                                                get_image_name=get_image_name,
+                                                status=status,
+                                                max_attempts=max_attempts)
+                finally:
+                    if plot_saliency:
+                        lane.idle.set()
+                if plot_saliency:
+                    for image_path in classified:
+                        lane.submit(get_image_name(image_path),
+                                    image_path,
+                                    saliency_fun_name(image_path))
+            stop_event.wait(poll_interval)
+    except KeyboardInterrupt:
+        print('Stop watching')
+    finally:
+        if plot_saliency:
+            lane.close()
+        predictor.close()
+        writer.close()
+        state.close()
+
+
+def classify_batch(files: list[tuple[str, int, float]],
+                   predictor: Predictor,
+                   writer: ResultWriter,
+                   state: WatchState,
+                   known: dict[str, tuple[int, float, str, int]],
+                   get_image_name: Callable[[str], str],
+                   status: str = DONE,
+                   max_attempts: int = 3
+                   ) -> list[str]:
+    """
+    Classify a batch of new files, append their rows and record them in the state (the
+    files which can't be decoded get one more attempt). The row of a replaced file
+    supersedes its previous row, and is marked in the 'Replaced' column.
+
+    Args:
+        files (list[tuple[str, int, float]]): The path, size and modification time of
+            the files.
+        predictor (Predictor): The predictor which keeps the model.
+        writer (ResultWriter): The writer of the results file.
+        state (WatchState): The state of the watched files.
+        known (dict[str, tuple[int, float, str, int]]): The state of the files at this
+            poll.
+        get_image_name (Callable[[str], str]): Get the name of an image from its path.
+        status (str, optional): The status of the classified files, 'classified' if
+            their saliency maps are pending. Defaults to 'done'.
+        max_attempts (int, optional): The number of attempts of a file. Defaults to 3.
+
+    Returns:
+        list[str]: The paths of the classified images.
+    """
+    images, loaded, failed = [], [], []
+    for image_path, size, mtime in files:
+        name = get_image_name(image_path)
+        try:
+            images.append(predictor.load_image(image_path))
+            loaded.append((image_path, name, size, mtime))
+        except (OSError, SyntaxError) as error:
+            # a partial or corrupted file
+            entry = known.get(name)
+            is_same = entry is not None and entry[:2] == (size, mtime)
+            attempts = entry[3] + 1 if is_same else 1
+            failed.append((name, size, mtime, FAILED, attempts))
+            if attempts >= max_attempts:
+                print(f"{image_path} can't be read ({error}), "
+                      "it is ignored until it changes")
+    if failed != []:
+        state.set(failed)
+    if images == []:
+        return []
+
+    futures = [predictor.submit(image, priority=INTERACTIVE) for image in images]
+    probabilities = torch.stack([future.result() for future in futures])
+    topk_indices, topk_values = get_topk_arrays(probabilities, k=3)
+    # the rows are written before the state, so a crash can't lose a classified image
+    names = [name for _, name, _, _ in loaded]
+    writer.write(names,
+                 get_topk_records(topk_indices, topk_values),
+                 extra_values=[['yes' if name in writer.image_names else 'no']
+                               for name in names])
+    state.set([(name, size, mtime, status, 0) for _, name, size, mtime in loaded])
+    print(f'{len(loaded)} new images classified')
+    return [image_path for image_path, _, _, _ in loaded]
+
+
+if __name__ == '__main__':
+    logging_path = os.path.join('logs', 'resnet_img256_0')
+    watch_path = os.path.join('data', 'images_to_predict')
+
+    watch_infer(watch_path=watch_path,
+                logging_path=logging_path,
+                dstpath=os.path.join(watch_path, 'inference_results'),
+                filename='inference_results.csv')
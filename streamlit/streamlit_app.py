@@ -10,16 +10,15 @@ from os.path import dirname as up
 
 import torch
 from torch import Tensor
-from torchvision import transforms
-from torch.nn.functional import softmax
 
 sys.path.append(up(up(os.path.abspath(__file__))))
 
-from utils import utils
 from src.dataloader.labels import LABELS
-from config.utils import load_config
-from src.model import finetune_resnet
+from src.predictor import Predictor
 from src.gradcam import GradCam
+from src.similarity_index import SimilarityIndex, load_similarity_index, INDEX_NAME
+from src.infer_cache import get_file_hash
+from utils import utils
 
 # Set page config
 st.set_page_config(page_title="Blood Stain Classification App", layout="centered")
@@ -31,6 +30,10 @@ st.sidebar.title("Parameters")
 save_results = st.sidebar.checkbox('Save Results', value=False)
 global_path = st.sidebar.text_input('Global Path')
 plot_saliency = st.sidebar.checkbox('Plot Saliency Map', value=True)
+num_similar = st.sidebar.number_input('Similar Cases',
+                                      min_value=0,
+                                      max_value=10,
+                                      value=3)
 
 # Image upload
 image_files = st.file_uploader("Upload Image",
@@ -50,39 +53,38 @@ if st.session_state["image_files"] is not None:
         image = Image.open(image_file)
         st.image(image, caption=f'Uploaded Image {i+1}.',width=500)
 
-# Temperature parameter
-temperature = 1.5
-config_file = os.path.join('logs', 'retrain_resnet_allw_img256_2', 'config.yaml')
+logging_path = os.path.join('logs', 'retrain_resnet_allw_img256_2')
+
+
+@st.cache_resource
+def get_predictor(logging_path: str) -> tuple[Predictor, GradCam]:
+    """ Load the model once per process, it is shared by all the sessions """
+    predictor = Predictor(logging_path=logging_path)
+    return predictor, GradCam(model=predictor.model)
+
+
+@st.cache_resource
+def get_similarity_index(logging_path: str) -> SimilarityIndex | None:
+    """ Load the similarity index once per process (None if it was not built) """
+    path = os.path.join(logging_path, INDEX_NAME)
+    return load_similarity_index(path) if os.path.exists(path) else None
+
 
 # Inference
 if st.button("Inference"):
     if st.session_state["image_files"] is not None:
-        config = load_config(config_file)
-        device = utils.get_device(device_config="cuda:0")
-        config_in_log_dir = os.path.dirname(config_file)
-        model = finetune_resnet.get_finetuneresnet(config)
-        weight = utils.load_weights(config_in_log_dir, device=device)
-        model.load_dict_learnable_parameters(state_dict=weight, strict=True)
-        model = model.to(device)
-        model.eval()
-        transform =  transforms.Compose([transforms.ToTensor(), transforms.Resize((256, 256))])
+        predictor, gradcam = get_predictor(logging_path)
         results_df = pd.DataFrame(columns=['Image Name', 'Predicted Label'])
 
-        if plot_saliency:
-            gradcam = GradCam(model=model)
-
         for i,image in enumerate(image_files):
             st.write(f"Inferring on image {i+1}...")
             st.write("##############################################")
             st.write("Plotting the probability distribution of the classes...")
-            model = model.to(device)
 
             with st.spinner('Inferring...'):
-                image = Image.open(image)
-                image: Tensor = transform(image).unsqueeze(0).to(device)
-                with torch.no_grad():
-                    y_pred = model.forward(image)
-                y_pred = softmax(y_pred / temperature, dim=-1)
+                image: Tensor = predictor.load_image(image.getvalue())
+                y_pred = predictor.submit(image).result().unsqueeze(0)
+                image = image.unsqueeze(0).to(predictor.device)
                 numpy_y_pred_prob = y_pred.cpu().numpy()[0].reshape(1, -1)
                 y_pred_df = pd.DataFrame(numpy_y_pred_prob, columns=LABELS)
                 y_pred_df = y_pred_df.T
@@ -91,6 +93,33 @@ if st.button("Inference"):
                 st.success(f"**This image is classified as:** {res}")
                 results_df.loc[len(results_df)] = {'Image Name': image_files[i].name, 'Predicted Label': res}
 
+                if num_similar > 0:
+                    index = get_similarity_index(logging_path)
+                    build_command = 'python main.py --mode build-index ' \
+                                    f'--path {logging_path}'
+                    checkpoint_path = utils.get_weights_path(logging_path,
+                                                             model_name='res')
+                    if index is None:
+                        st.warning("No similarity index, build it with: "
+                                   f"{build_command}")
+                    elif index.model_key != get_file_hash(checkpoint_path):
+                        st.warning("The similarity index was built with another "
+                                   f"checkpoint, build it again with: {build_command}")
+                    else:
+                        with predictor.model_lock, torch.inference_mode():
+                            features, intermediare, _ = \
+                                predictor.model.forward_and_get_features(image)
+                        vectors = features if index.embedding == 'features' \
+                            else intermediare
+                        neighbors = index.get_neighbors(vectors.cpu().numpy(),
+                                                        k=int(num_similar))[0]
+                        st.write("Most similar labelled images:")
+                        columns = st.columns(len(neighbors))
+                        for column, (path, label, score) in zip(columns, neighbors):
+                            column.image(Image.open(path),
+                                         caption=f'{label} ({score:.2f})',
+                                         use_column_width=True)
+
                 if save_results:
                     path = global_path if global_path else os.getcwd()
                     os.makedirs(path, exist_ok=True)
@@ -99,7 +128,8 @@ if st.button("Inference"):
                     os.makedirs(saliency_maps_path, exist_ok=True)
 
                 if plot_saliency:
-                    visualizations = gradcam.forward(image)
+                    with predictor.model_lock:
+                        visualizations = gradcam.forward(image)
                     saliency_map: np.ndarray = visualizations[0]
                     saliency_map = saliency_map / 255
                     np_image: np.ndarray = image.cpu().numpy().squeeze().transpose(1, 2, 0)
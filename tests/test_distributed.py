@@ -0,0 +1,72 @@
+import os
+import sys
+from os.path import dirname as up
+
+import pytest
+import torch
+import torch.distributed as dist
+from torch import nn
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.train.distributed import launch, broadcast_parameters, all_reduce_gradients
+
+WORLD_SIZE = 2
+LEARNING_RATE = 0.1
+
+
+def get_batch() -> tuple[torch.Tensor, torch.Tensor]:
+    """ The full batch, split between the ranks """
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(8, 4, generator=generator)
+    y = torch.randn(8, 3, generator=generator)
+    return x, y
+
+
+def train_step(model: nn.Module,
+               x: torch.Tensor,
+               y: torch.Tensor,
+               world_size: int = 1
+               ) -> None:
+    """ One SGD step on the mean squared error, with the gradients averaged """
+    loss = nn.functional.mse_loss(model(x), y)
+    loss.backward()
+    if world_size > 1:
+        all_reduce_gradients(model.parameters(), world_size=world_size)
+    with torch.no_grad():
+        for param in model.parameters():
+            param -= LEARNING_RATE * param.grad
+
+
+def train(dstpath: str, rank: int, world_size: int) -> None:
+    """ Train function of launch: other weights and a shard of the batch per rank """
+    torch.manual_seed(rank)
+    model = nn.Linear(4, 3)
+    broadcast_parameters(model.parameters(), src=0)
+
+    x, y = get_batch()
+    shard = slice(rank * len(x) // world_size, (rank + 1) * len(x) // world_size)
+    train_step(model, x[shard], y[shard], world_size=world_size)
+    torch.save(model.state_dict(), os.path.join(dstpath, f'rank{rank}.pt'))
+
+
+@pytest.mark.skipif(not dist.is_available() or not dist.is_gloo_available(),
+                    reason='gloo is not available')
+def test_launch_matches_a_single_process_step(tmp_path) -> None:
+    launch(train_fn=train,
+           world_size=WORLD_SIZE,
+           threads_per_process=1,
+           dstpath=str(tmp_path))
+    states = [torch.load(tmp_path / f'rank{rank}.pt') for rank in range(WORLD_SIZE)]
+
+    # the parameters are identical across the ranks after the step
+    for name, value in states[0].items():
+        for state in states[1:]:
+            assert torch.equal(state[name], value)
+
+    # and match a single process step on the concatenated batch (rank 0 weights)
+    torch.manual_seed(0)
+    model = nn.Linear(4, 3)
+    train_step(model, *get_batch())
+    for name, value in model.state_dict().items():
+        assert torch.allclose(states[0][name], value, atol=1e-6)
@@ -0,0 +1,143 @@
+import os
+import sys
+import json
+import shutil
+import yaml
+import numpy as np
+from PIL import Image
+from easydict import EasyDict
+from os.path import dirname as up
+
+import pytest
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from config.utils import load_config, find_config
+from src.infer import infer, get_contiguous_segments
+from src.model import finetune_resnet
+from src.infer_cache import CACHE_NAME
+from src.saliency_store import SaliencyStore
+from utils import utils
+
+MODEL_PATH = os.path.join(up(up(os.path.abspath(__file__))), 'logs', 'resnet_img256_0')
+NUM_IMAGES = 7
+
+
+@pytest.fixture
+def infer_setup(tmp_path) -> tuple[str, EasyDict, str]:
+    """ A folder of random images and a copy of a model (small images, no workers) """
+    datapath = tmp_path / 'images'
+    datapath.mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(NUM_IMAGES):
+        image = rng.integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+        Image.fromarray(image).save(datapath / f'{i}.png')
+
+    logging_path = tmp_path / 'model'
+    shutil.copytree(MODEL_PATH, logging_path,
+                    ignore=shutil.ignore_patterns('*.png', '*.txt', '*.csv'))
+    config = load_config(find_config(experiment_path=str(logging_path)))
+    config.data.image_size = 64
+    config.test.num_workers = 0
+    return str(datapath), config, str(logging_path)
+
+
+def run_infer(datapath: str,
+              config: EasyDict,
+              logging_path: str,
+              dstpath: str,
+              **kwargs
+              ) -> list[str]:
+    """ Run infer on the images of datapath and return the image names of the rows """
+    images_paths = [os.path.join(datapath, f'{i}.png') for i in range(NUM_IMAGES)]
+    infer(infer_images_path=images_paths,
+          infer_datapath=datapath,
+          logging_path=logging_path,
+          config=config,
+          dstpath=dstpath,
+          filename='inference_results.csv',
+          cache_path=os.path.join(dstpath, CACHE_NAME),
+          **kwargs)
+    with open(os.path.join(dstpath, 'inference_results.csv'), encoding='utf8') as f:
+        return [line.split(',')[0] for line in f.read().splitlines()[1:]]
+
+
+def test_get_contiguous_segments() -> None:
+    assert get_contiguous_segments([]) == []
+    assert get_contiguous_segments([2, 3, 4]) == [(0, 3)]
+    assert get_contiguous_segments([1, 4, 5, 9]) == [(0, 1), (1, 3), (3, 4)]
+
+
+@pytest.mark.skipif(not os.path.exists(MODEL_PATH),
+                    reason='the model resnet_img256_0 is missing')
+def test_infer_mixed_cache_keeps_all_rows_in_order(infer_setup, tmp_path) -> None:
+    datapath, config, logging_path = infer_setup
+    dstpath = str(tmp_path / 'output')
+    os.makedirs(dstpath)
+    expected = [f'{os.sep}{i}.png' for i in range(NUM_IMAGES)]
+    saliency_options = dict(plot_saliency=True,
+                            saliency_method='fastcam',
+                            saliency_output='both')
+
+    rows = run_infer(datapath, config, logging_path, dstpath, **saliency_options)
+    assert rows == expected
+
+    # the images 1 and 4 lost their saliency map: they run again between cached images
+    for i in [1, 4]:
+        os.remove(os.path.join(dstpath, 'saliency_maps', f'_{i}_saliency.png'))
+    os.remove(os.path.join(dstpath, 'inference_results.csv'))
+    os.remove(os.path.join(dstpath, 'inference_results.csv.state.json'))
+    os.remove(os.path.join(dstpath, 'saliency_maps.npz'))
+
+    rows = run_infer(datapath, config, logging_path, dstpath, **saliency_options)
+    assert rows == expected
+    assert len(SaliencyStore(os.path.join(dstpath, 'saliency_maps.npz'))) == NUM_IMAGES
+    assert all(os.path.exists(os.path.join(dstpath, 'saliency_maps',
+                                           f'_{i}_saliency.png'))
+               for i in range(NUM_IMAGES))
+
+
+@pytest.mark.skipif(not os.path.exists(MODEL_PATH),
+                    reason='the model resnet_img256_0 is missing')
+@pytest.mark.parametrize('cascade_threshold', [None, 1.0])
+def test_fastcam_reuses_the_classification_forward(infer_setup,
+                                                   tmp_path,
+                                                   cascade_threshold) -> None:
+    datapath, config, logging_path = infer_setup
+    config.test.batch_size = 4
+    dstpath = str(tmp_path / 'output')
+    os.makedirs(dstpath)
+
+    model = finetune_resnet.get_finetuneresnet(config)
+    weight = utils.load_weights(logging_path, device='cpu', model_name='res')
+    model.load_dict_learnable_parameters(state_dict=weight, strict=True)
+    image_sizes: list[int] = []
+    model.resnet_begin.register_forward_pre_hook(
+        lambda module, inputs: image_sizes.extend(x.shape[-1] for x in inputs[0]))
+
+    # with a threshold of 1, the first stage (the same model at 32px) sends all the
+    # images to the second stage
+    run_infer(datapath, config, logging_path, dstpath,
+              plot_saliency=True, saliency_method='fastcam', saliency_output='raw',
+              cascade_threshold=cascade_threshold, cascade_image_size=32, model=model)
+
+    # one backbone forward per image at the full resolution: the saliency maps reuse it
+    assert image_sizes.count(config.data.image_size) == NUM_IMAGES
+    assert image_sizes.count(32) == (0 if cascade_threshold is None else NUM_IMAGES)
+
+
+@pytest.mark.skipif(not os.path.exists(MODEL_PATH),
+                    reason='the model resnet_img256_0 is missing')
+def test_cascade_model_with_another_hidden_size(infer_setup, tmp_path) -> None:
+    datapath, config, logging_path = infer_setup
+    cascade_logging_path = str(tmp_path / 'cascade_model')
+    shutil.copytree(logging_path, cascade_logging_path)
+    config_path = find_config(experiment_path=cascade_logging_path)
+    cascade_config = load_config(config_path)
+    cascade_config.model.resnet.hidden_size *= 2
+    with open(config_path, 'w', encoding='utf8') as f:
+        yaml.safe_dump(json.loads(json.dumps(cascade_config)), f)
+
+    with pytest.raises(ValueError, match='hidden size'):
+        run_infer(datapath, config, logging_path, str(tmp_path), plot_saliency=False,
+                  cascade_threshold=0.5, cascade_logging_path=cascade_logging_path)
@@ -0,0 +1,71 @@
+import os
+import sys
+import tarfile
+import zipfile
+import numpy as np
+from PIL import Image
+from os.path import dirname as up
+
+import pytest
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from src.dataloader.infer_dataloader import get_image_from_path, get_output_name, \
+    open_image
+from utils import utils
+
+IMAGES = ['a.png', os.path.join('case.2024', 'a.png'),
+          os.path.join('case.2024', 'b.jpg')]
+
+
+@pytest.fixture
+def images_folder(tmp_path) -> str:
+    """ A folder of small images, one of them in a sub folder with a dot in its name """
+    folder = tmp_path / 'images'
+    for i, name in enumerate(IMAGES):
+        os.makedirs(os.path.dirname(folder / name), exist_ok=True)
+        Image.fromarray(np.full((8, 8, 3), i * 50, dtype=np.uint8)).save(folder / name)
+    return str(folder)
+
+
+def make_archive(folder: str, path: str) -> str:
+    """ Archive the content of folder like `tar czf path .` or `zip -r path .` """
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path, 'w') as archive:
+            for name in IMAGES:
+                archive.write(os.path.join(folder, name), arcname=name)
+    else:
+        with tarfile.open(path, 'w:gz' if path.endswith('.gz') else 'w') as archive:
+            archive.add(folder, arcname='.')
+    return path
+
+
+def test_get_output_name() -> None:
+    image_name = os.sep + os.path.join('case.2024', 'a.png')
+    assert get_output_name(image_name) == '_case.2024_a'
+    assert get_output_name('/images.tar.gz!./case.2024/a.png') == '_images_case.2024_a'
+    assert get_output_name('images.zip!b.v2.jpg') == 'images_b.v2'
+
+
+@pytest.mark.parametrize('archive_name', ['images.tar.gz', 'images.tar', 'images.zip'])
+def test_archive_images(images_folder, tmp_path, archive_name) -> None:
+    archive_path = make_archive(images_folder, str(tmp_path / archive_name))
+    images_paths = get_image_from_path(archive_path)
+    assert len(images_paths) == len(IMAGES)
+
+    images_names = [utils.get_relatif_image_path(image_path, archive_path)
+                    for image_path in images_paths]
+    assert all(name.startswith(f'{os.sep}{archive_name}!') for name in images_names)
+
+    # each image has its own outputs, also with the './' prefix of `tar czf x.tar.gz .`
+    output_names = list(map(get_output_name, images_names))
+    assert len(set(output_names)) == len(IMAGES)
+    assert all(name.startswith('_images_') for name in output_names)
+
+    # the images are read from the archive, in any order (a compressed tar restarts
+    # its stream)
+    for image_path in images_paths[::-1]:
+        member = image_path.split('!', 1)[1]
+        member_path = os.path.join(images_folder, os.path.normpath(member))
+        expected = np.array(Image.open(member_path))
+        assert np.array_equal(np.array(open_image(image_path)), expected)
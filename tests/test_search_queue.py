@@ -0,0 +1,57 @@
+import os
+import sys
+import json
+from easydict import EasyDict
+from os.path import dirname as up
+
+sys.path.append(up(up(os.path.abspath(__file__))))
+
+from config.search_queue import FileLock, SearchQueue, RUNNING, DONE
+
+
+def read_trial(queue: SearchQueue, trial_id: int) -> dict:
+    """ The experiment as written in the queue file """
+    with open(queue.queue_path, 'r', encoding='utf8') as f:
+        return json.load(f)['trials'][trial_id]
+
+
+def get_worker(search_path: str, worker_name: str) -> SearchQueue:
+    """ A worker of the queue with a given name (the workers of a process share it) """
+    queue = SearchQueue(search_path=search_path, stale_timeout=0)
+    queue.worker_name = worker_name
+    return queue
+
+
+def test_mark_done_of_a_stale_experiment_claimed_again(tmp_path) -> None:
+    first = get_worker(str(tmp_path), 'first')
+    second = get_worker(str(tmp_path), 'second')
+    first.create(configs=[EasyDict({'learning': {'learning_rate': 0.1}})],
+                 hyperparameters={'learning_rate': ['learning', 'learning_rate']},
+                 model_name='resnet')
+    assert first.claim()[0] == 0
+    # the experiment of first is stale, because stale_timeout=0
+    assert second.claim()[0] == 0
+
+    # first finishes while second is still running the experiment: nothing is compared
+    assert not first.mark_done(trial_id=0, logging_path='first_log')
+    trial = read_trial(first, trial_id=0)
+    assert (trial['status'], trial['worker'], trial['logging_path']) \
+        == (RUNNING, 'second', None)
+
+    assert second.mark_done(trial_id=0, logging_path='second_log')
+    trial = read_trial(second, trial_id=0)
+    assert (trial['status'], trial['logging_path']) == (DONE, 'second_log')
+
+
+def test_file_lock_keeps_the_lock_of_another_holder(tmp_path) -> None:
+    lock_path = str(tmp_path / 'lock')
+    with FileLock(lock_path):
+        assert os.path.exists(lock_path)
+    assert not os.path.exists(lock_path)
+
+    with FileLock(lock_path):
+        # the lock was removed as stale and taken by another process
+        os.remove(lock_path)
+        with open(lock_path, 'w', encoding='utf8') as f:
+            f.write('another_process')
+    assert os.path.exists(lock_path)
@@ -89,13 +89,36 @@ def load_weights(logging_path: str,
             A dictionary containing the loaded weights.
 
     """
+    weight_path = get_weights_path(logging_path, model_name=model_name, endfile=endfile)
+    weight = torch.load(weight_path, map_location=device)
+    return weight
+
+
+def get_weights_path(logging_path: str,
+                     model_name: str = 'res',
+                     endfile: str = '.pt'
+                     ) -> str:
+    """
+    Find the weight file of a given model in the logging path.
+
+    Args:
+        logging_path (str): The path where the weight files are stored.
+        model_name (str, optional): The name of the model. Defaults to 'res'.
+        endfile (str, optional): The file extension of the weight files.
+            Defaults to '.pt'.
+
+    Raises:
+        FileExistsError: If there are several weight files with the name of the model.
+        FileNotFoundError: If there are no weight files with the name of the model.
+
+    Returns:
+        str: The path of the weight file.
+    """
     weight_files = list(filter(lambda x: x.endswith(endfile),
                                os.listdir(logging_path)))
 
     if len(weight_files) == 1:
-        weight = torch.load(os.path.join(logging_path, weight_files[0]),
-                            map_location=device)
-        return weight
+        return os.path.join(logging_path, weight_files[0])
 
     model_name_files = list(filter(lambda x: model_name in x, weight_files))
 
@@ -103,9 +126,7 @@ def load_weights(logging_path: str,
         raise FileExistsError(f'Confused by multiple weights for the {model_name} model')
     if len(model_name_files) < 1:
         raise FileNotFoundError(f'No weights was found in {logging_path} with the name {model_name}')
-    weight = torch.load(os.path.join(logging_path, model_name_files[0]),
-                        map_location=device)
-    return weight
+    return os.path.join(logging_path, model_name_files[0])
 
 
 def get_random_img(data_path: str = 'data/data_labo/test_256',
@@ -206,7 +227,9 @@ def get_relatif_image_path(image_path: str,
                            dst_path: str
                            ) -> str:
     """
-    Get the relative image path by replacing the destination path with an empty string.
+    Get the relative image path by replacing the destination path with an empty
+    string. The images of an archive dst_path keep the name of the archive
+    ('archive!member').
 
     Args:
         image_path (str): The absolute path of the image.
@@ -215,4 +238,6 @@ def get_relatif_image_path(image_path: str,
     Returns:
         str: The relative image path.
     """
+    if image_path.startswith(f'{dst_path}!'):
+        return image_path.replace(os.path.dirname(dst_path), '', 1)
     return image_path.replace(dst_path, '')
\ No newline at end of file